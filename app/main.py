@@ -1,341 +1,152 @@
 # app/main.py
 
 import streamlit as st
+import streamlit.components.v1 as components
+import numpy as np
 import pandas as pd
-import geopandas as gpd
-import plotly.express as px
+import scipy.sparse as sp
 import plotly.graph_objects as go
 import sys, os
+import functools
+from urllib.parse import urlsplit
+
+# Rende importabili i moduli in app/utils indipendentemente dalla directory di avvio
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from utils.data_cache import FEED_SCRUTINIO, LOG_TRACCE, SORGENTI, TILE_DIR, carica_crosswalk, colonne_id, carica_layer, carica_tabella, carica_voti, chiavi_layer, colonne_layer, esporta_geometria, esporta_mbtiles, esporta_plotlyjs, esporta_topojson, prepara_sorgenti, sorgente_presente, versione_sorgente
+from utils.aggregazioni import aggiungi_quote_coalizioni, colonne_base_coalizioni, costruisci_indice
+from utils.coalizioni import SCHEMI_COALIZIONI, applica_scenario, colonne_partiti, compila_schema, partiti_coalizione, quote_coalizioni
+from utils.crosswalk import matrice_chiavi
+from utils.elezioni import ELEZIONI, confronta_elezioni, costruisci_archivio
+from utils.rollup import COLONNA_VOTI_VALIDI, colonne_conteggio, rollup_spaziale, rollup_tabella, tabella_livello
+from utils.chart_utils import grafico_torta_csx, grafico_barre_partiti, grafico_swing
+from utils.map_utils import BACKEND_DECK, BACKEND_GEO, BACKEND_MAP, BACKEND_MVT, BACKEND_TOPO, aggiorna_valori_mappa, area_selezionata_nel_browser, applica_stile_mappa, centro_zoom, costruisci_figura_mappa, dimensione_payload, evidenzia_area, html_mappa_topojson, id_selezione_mappa, scegli_backend
+from utils.geometrie import PIRAMIDE_TOLLERANZE_M, tolleranza_per_zoom
+from utils.scrutinio import INTERVALLO_SCRUTINIO, FeedJsonl, Scrutinio
+from utils.tile_server import avvia_server_tile
+from utils.tracciamento import avvia_traccia, dettagliata, leggi_tracce, span, termina_traccia, traccia
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+# Copy-on-write: chi aggiunge colonne ai dati condivisi lavora su una vista,
+# senza mai modificare l'originale (sempre attivo da pandas 3)
+if int(pd.__version__.split(".")[0]) < 3:
+    pd.set_option("mode.copy_on_write", True)
 
 # Configurazione pagina
 st.set_page_config(layout="wide", page_title="Dashboard Elezioni Regionali 2024", page_icon="🗳️")
 
 st.title("🗳️ Dashboard Elezioni Regionali 2024 - Genova")
 
-# Funzioni di utilità incorporate direttamente
-def formatta_percentuale(valore):
-    """Formatta un valore numerico come percentuale con 1 decimale"""
-    if pd.isna(valore):
-        return "N/A"
-    return f"{valore:.1f}%"
+# Tracce dei tempi: ogni esecuzione dello script (o di un frammento) registra
+# i suoi span in una riga del log LOG_TRACCE; con il pannello "Tempi del
+# rerun" aperto si registrano anche le misure costose (dimensione del
+# payload della mappa)
+def id_sessione():
+    ctx = get_script_run_ctx()
+    return ctx.session_id if ctx else None
+
+def traccia_frammento(nome, **attributi):
+    return traccia(nome, LOG_TRACCE, st.session_state.get("pannello_tempi", False), sessione=id_sessione(), **attributi)
+
+traccia_rerun = avvia_traccia("rerun", st.session_state.get("pannello_tempi", False), sessione=id_sessione())
+
+# Caricamento dati: i dati sono condivisi in sola lettura tra tutte le sessioni
+# (st.cache_resource non crea copie per sessione o per rerun)
+def _errore_caricamento(e, sorgente=None, ferma=True):
+    st.error(f"Errore nel caricamento {f'di {sorgente}' if sorgente else 'dei dati'}: {str(e)}")
+    if "No such file or directory" in str(e):
+        st.error("File non trovato. Verifica che i file dati siano nella directory 'data'.")
+    if ferma:
+        st.stop()
 
-def crea_mappa_plotly(gdf, colonna_id, colore, opacita, df_voti=None, join_col=None, partiti_cols=None):
-    """
-    Crea una mappa Plotly con i dati GeoJSON e informazioni sui voti.
-    """
+@st.cache_resource(max_entries=2)
+def carica_dati(versione):
+    """Carica la tabella dei voti (una voce di cache per versione dei dati)"""
     try:
-        # Converti a WGS84 se necessario
-        if gdf.crs and str(gdf.crs) != "EPSG:4326":
-            gdf = gdf.to_crs("EPSG:4326")
-        
-        # Unisci i dati di voto se disponibili
-        if df_voti is not None and join_col is not None:
-            # Crea una copia per evitare di modificare l'originale
-            gdf_copy = gdf.copy()
-            gdf_copy = gdf_copy.reset_index(drop=True)  # Resetta l'indice per assicurare un indice sequenziale
-            
-            # Preparazione dei dati per il join
-            if join_col not in df_voti.columns:
-                print(f"Colonna di join '{join_col}' non trovata in df_voti")
-                gdf_copy['id_map'] = gdf_copy.index.astype(str)  # Crea una colonna per l'id
-                hover_data = {colonna_id: True}
-                color_col = None
-            else:
-                # Converte la colonna di join in string per entrambi i dataframe
-                gdf_copy[colonna_id] = gdf_copy[colonna_id].astype(str)
-                df_voti[join_col] = df_voti[join_col].astype(str)
-                
-                try:
-                    # Assicurati che tutte le colonne percentuali siano numeriche
-                    numeric_df = df_voti.copy()
-                    for col in numeric_df.columns:
-                        if "%" in col:
-                            numeric_df[col] = pd.to_numeric(numeric_df[col], errors='coerce')
-                    
-                    # Calcola percentuali CSX e CDX se non presenti
-                    if 'CSX %' not in numeric_df.columns and partiti_cols:
-                        csx_cols = [col for col in partiti_cols if any(p in col for p in ["PD", "M5S", "AVS", "Orlando"])]
-                        numeric_df['CSX %'] = numeric_df[csx_cols].sum(axis=1)
-                    
-                    if 'CDX %' not in numeric_df.columns and partiti_cols:
-                        cdx_cols = [col for col in partiti_cols if any(p in col for p in ["Bucci", "Lega", "FI", "FdI"])]
-                        numeric_df['CDX %'] = numeric_df[cdx_cols].sum(axis=1)
-                    
-                    # Raggruppa i dati per la colonna di join - solo colonne numeriche
-                    numeric_cols = numeric_df.select_dtypes(include=['number']).columns
-                    grouped_df = numeric_df.groupby(join_col)[numeric_cols].mean().reset_index()
-                    
-                    # Unisci con i dati geografici
-                    gdf_copy = gdf_copy.merge(grouped_df, how='left', left_on=colonna_id, right_on=join_col)
-                    gdf_copy['id_map'] = gdf_copy.index.astype(str)  # Crea una colonna per l'id
-                    
-                    # Crea la differenza per la colorazione
-                    if 'CSX %' in gdf_copy.columns and 'CDX %' in gdf_copy.columns:
-                        gdf_copy['Diff'] = gdf_copy['CSX %'] - gdf_copy['CDX %']
-                        print(f"Range Diff: min={gdf_copy['Diff'].min()}, max={gdf_copy['Diff'].max()}")
-                        color_col = 'Diff'
-                    else:
-                        color_col = None
-                    
-                    # Crea dati per hover più leggibili
-                    hover_data = {}
-                    
-                    # Aggiungi le colonne di percentuali se disponibili
-                    for col in ['CSX %', 'CDX %', 'Diff']:
-                        if col in gdf_copy.columns:
-                            hover_data[col] = ':.1f'
-                    
-                    # Aggiungi solo le colonne principali dei partiti per non sovraccaricare il tooltip
-                    partiti_principali = [
-                        "PD %", "M5S %", "FdI %", "Lega %", "FI %"
-                    ]
-                    for col in partiti_principali:
-                        if col in gdf_copy.columns:
-                            hover_data[col] = ':.1f'
-                    
-                except Exception as e:
-                    print(f"Errore nel join dei dati: {str(e)}")
-                    gdf_copy['id_map'] = gdf_copy.index.astype(str)  # Crea una colonna per l'id
-                    hover_data = {colonna_id: True}
-                    color_col = None
-        else:
-            # Se non ci sono dati di voto, usa il GeoDataFrame originale
-            gdf_copy = gdf.copy()
-            gdf_copy = gdf_copy.reset_index(drop=True)  # Resetta l'indice
-            gdf_copy['id_map'] = gdf_copy.index.astype(str)  # Crea una colonna per l'id
-            hover_data = {colonna_id: True}
-            color_col = None
-        
-        # Crea una mappa con Plotly - usiamo la versione semplificata per evitare problemi
-        if color_col and 'Diff' in gdf_copy.columns:
-            # Mappa colorata in base alla differenza CSX-CDX
-            # Verifica che ci siano effettivamente differenze da visualizzare
-            if gdf_copy['Diff'].notna().any():
-                # Usa una scala di colori migliorata e range adattato ai dati
-                max_abs_diff = max(
-                    abs(gdf_copy['Diff'].min() if not pd.isna(gdf_copy['Diff'].min()) else 0), 
-                    abs(gdf_copy['Diff'].max() if not pd.isna(gdf_copy['Diff'].max()) else 0)
-                )
-                if max_abs_diff == 0:
-                    max_abs_diff = 10  # Valore di default se non ci sono differenze
-                range_color = [-max_abs_diff, max_abs_diff]  # Scala simmetrica
-                
-                # Usiamo px.choropleth invece di choropleth_mapbox
-                fig = px.choropleth(
-                    gdf_copy,
-                    geojson=gdf_copy.__geo_interface__,
-                    featureidkey='properties.id_map',  # Usa questa chiave per collegare i dati alla geometria
-                    locations='id_map',
-                    color='Diff',
-                    color_continuous_scale=[
-                        [0, "rgb(0, 0, 255)"],       # Blu forte per CDX molto avanti
-                        [0.4, "rgb(180, 180, 255)"], # Blu chiaro per CDX poco avanti
-                        [0.5, "rgb(255, 255, 255)"], # Bianco per parità
-                        [0.6, "rgb(255, 180, 180)"], # Rosso chiaro per CSX poco avanti
-                        [1, "rgb(255, 0, 0)"]        # Rosso forte per CSX molto avanti
-                    ],
-                    range_color=range_color,
-                    hover_name=gdf_copy[colonna_id],
-                    hover_data=hover_data
-                )
-                
-                # Configura la mappa per renderla simile a mapbox
-                fig.update_geos(
-                    fitbounds="locations",
-                    visible=False,
-                    resolution=110,
-                    showcountries=True,
-                    countrycolor="Black",
-                    showsubunits=True,
-                    subunitcolor="Black"
-                )
-                
-                # Aggiungi una title per la colorbar
-                fig.update_layout(
-                    coloraxis_colorbar=dict(
-                        title="Differenza % CSX-CDX",
-                        tickvals=[-20, -10, 0, 10, 20],
-                        ticktext=["-20%", "-10%", "0%", "+10%", "+20%"]
-                    )
-                )
-            else:
-                # Se non ci sono differenze valide, usa il colore predefinito
-                fig = px.choropleth(
-                    gdf_copy,
-                    geojson=gdf_copy.__geo_interface__,
-                    featureidkey='properties.id_map',
-                    locations='id_map',
-                    hover_name=gdf_copy[colonna_id],
-                    hover_data=hover_data,
-                    color_discrete_sequence=[colore]
-                )
-                
-                # Configura la mappa
-                fig.update_geos(
-                    fitbounds="locations",
-                    visible=False,
-                    resolution=110,
-                    showcountries=True,
-                    countrycolor="Black",
-                    showsubunits=True,
-                    subunitcolor="Black"
-                )
-        else:
-            # Mappa con colore fisso
-            fig = px.choropleth(
-                gdf_copy,
-                geojson=gdf_copy.__geo_interface__,
-                featureidkey='properties.id_map',
-                locations='id_map',
-                hover_name=gdf_copy[colonna_id],
-                hover_data=hover_data,
-                color_discrete_sequence=[colore]
-            )
-            
-            # Configura la mappa
-            fig.update_geos(
-                fitbounds="locations",
-                visible=False,
-                resolution=110,
-                showcountries=True,
-                countrycolor="Black",
-                showsubunits=True,
-                subunitcolor="Black"
-            )
-        
-        # Aumenta le dimensioni della mappa
-        fig.update_layout(
-            margin={"r": 0, "t": 0, "l": 0, "b": 0},
-            height=600  # Altezza aumentata
-        )
-        
-        return fig
+        return carica_voti()
     except Exception as e:
-        print(f"Errore nella creazione della mappa Plotly: {str(e)}")
-        fig = go.Figure()
-        fig.update_layout(title=f"Errore: {str(e)}")
-        return fig
+        _errore_caricamento(e)
 
-def grafico_torta_csx(df, livello, valore):
+@st.cache_resource
+def carica_layer_mappa(nome, tolleranza=0):
     """
-    Funzione per mostrare un grafico a torta del voto CSX.
+    Carica un singolo layer geografico ("municipi", "sezioni" o "uu") al
+    livello di semplificazione indicato (tolleranza in metri).
+    Ogni layer e livello ha una voce di cache separata e viene letto solo la
+    prima volta che viene selezionato.
     """
-    col_pd = "PD %"
-    col_m5s = "M5S %"
-    col_avs = "AVS - Lista Sansa - Possibile %"
-    col_orlando = "liste Orlando %"
-
-    df_filtrato = df[df[livello] == valore]
-
-    if df_filtrato.empty:
-        return None
-
-    media_pd = df_filtrato[col_pd].mean()
-    media_m5s = df_filtrato[col_m5s].mean()
-    media_avs = df_filtrato[col_avs].mean()
-    media_orlando = df_filtrato[col_orlando].mean()
-
-    dati = pd.DataFrame({
-        "Partito": ["PD", "M5S", "AVS", "Liste Orlando"],
-        "Percentuale": [media_pd, media_m5s, media_avs, media_orlando]
-    })
-
-    fig = px.pie(
-        dati,
-        names="Partito",
-        values="Percentuale",
-        title=f"Spaccato CSX - {livello}: {valore}",
-        hole=0.3,
-        color_discrete_sequence=["#235789", "#F1D302", "#C1292E", "#6a0dad"]
-    )
-
-    fig.update_traces(textinfo="label+percent", pull=[0.05] * 4)
-    fig.update_layout(height=400, margin={"t": 50, "b": 0, "l": 0, "r": 0})
-
-    return fig
+    try:
+        return carica_layer(nome, tolleranza)
+    except Exception as e:
+        _errore_caricamento(e)
 
-def grafico_barre_partiti(df, livello, valore):
+@st.cache_resource
+def carica_chiavi_layer(nome, colonna):
     """
-    Funzione per grafico a barre comparativo partiti.
+    Colonna identificativa di un layer, nell'ordine delle sue righe, letta
+    senza geometrie (per rollup e corrispondenze che usano solo le chiavi)
     """
-    df_filtrato = df[df[livello] == valore]
-    if df_filtrato.empty:
-        return None
-
-    partiti = [
-        "PD %", "M5S %", "AVS - Lista Sansa - Possibile %",
-        "liste Orlando %", "liste Bucci %", "Lega %", "FI %", "FdI %"
-    ]
-
-    medie = {partito: df_filtrato[partito].mean() for partito in partiti if partito in df_filtrato.columns}
-
-    df_bar = pd.DataFrame({
-        "Partito": list(medie.keys()),
-        "Percentuale": list(medie.values())
-    })
-
-    fig = px.bar(
-        df_bar,
-        x="Partito",
-        y="Percentuale",
-        title=f"Confronto Partiti - {livello}: {valore}",
-        text_auto=".1f"
-    )
-
-    fig.update_layout(height=400, margin={"t": 50, "b": 0, "l": 0, "r": 0})
-    return fig
+    try:
+        return chiavi_layer(nome, colonna)
+    except Exception as e:
+        _errore_caricamento(e)
 
-# Caricamento dati
 @st.cache_data
-def carica_dati():
+def carica_colonne_layer(nome):
+    """Nomi delle colonne di un layer, letti dallo schema senza geometrie"""
     try:
-        # Ottieni il percorso assoluto della directory corrente
-        current_dir = os.path.dirname(os.path.abspath(__file__))
-        # Vai alla directory principale del progetto
-        project_dir = os.path.abspath(os.path.join(current_dir, ".."))
-        # Percorso alla directory data
-        data_dir = os.path.join(project_dir, "data")
-        
-        # Carica i file con percorsi assoluti
-        municipi = gpd.read_file(os.path.join(data_dir, "municipi.geojson"))
-        sezioni = gpd.read_file(os.path.join(data_dir, "sezioni.geojson"))
-        uu = gpd.read_file(os.path.join(data_dir, "unita_urbanistiche.geojson"))
-        voti = pd.read_excel(os.path.join(data_dir, "voti_rielaborati.xlsx"))
-        
-        return municipi, sezioni, uu, voti
+        return colonne_layer(nome)
     except Exception as e:
-        st.error(f"Errore nel caricamento dei dati: {str(e)}")
-        if "No such file or directory" in str(e):
-            st.error("File non trovato. Verifica che i file dati siano nella directory 'data'.")
-        st.stop()
+        _errore_caricamento(e)
 
-# Calcola le percentuali di CSX e CDX
-def calcola_percentuali_coalizioni(df):
-    """Calcola le percentuali di CSX e CDX e aggiunge le colonne al DataFrame"""
-    # Identifica le colonne dei partiti di CSX e CDX
-    csx_cols = []
-    cdx_cols = []
-    
-    for col in df.columns:
-        if "%" in col:
-            if any(p in col for p in ["PD", "M5S", "AVS", "Orlando"]):
-                csx_cols.append(col)
-            elif any(p in col for p in ["Bucci", "Lega", "FI", "FdI"]):
-                cdx_cols.append(col)
-    
-    # Calcola le percentuali totali
-    if csx_cols:
-        df['CSX %'] = df[csx_cols].sum(axis=1)
-    if cdx_cols:
-        df['CDX %'] = df[cdx_cols].sum(axis=1)
-    
-    return df, csx_cols, cdx_cols
+# Schema di coalizioni compilato sulle colonne disponibili: una sola volta
+# per schema e insieme di colonne, condiviso tra sessioni e rerun
+@st.cache_resource
+def carica_schema(nome, colonne):
+    return compila_schema(SCHEMI_COALIZIONI[nome], list(colonne))
 
-# Carica i dati
-municipi, sezioni, uu, voti = carica_dati()
+# Calcola le percentuali delle coalizioni
+def calcola_percentuali_coalizioni(df, schema):
+    """
+    Aggiunge le percentuali delle coalizioni dello schema a una vista del
+    DataFrame (vedi aggiungi_quote_coalizioni)
+    """
+    return aggiungi_quote_coalizioni(df, carica_schema(schema, tuple(colonne_base_coalizioni(df))))
+
+# Carica i dati: le sorgenti della dashboard vengono preparate in parallelo
+# (a freddo, la conversione nella cache colonnare; poi solo un controllo
+# del manifest), i layer geografici caricati solo quando selezionati. Gli
+# errori di tutte le sorgenti vengono mostrati insieme.
+SORGENTI_DASHBOARD = ("voti", "municipi", "sezioni", "uu")
+with span("caricamento") as attributi_caricamento:
+    esiti_sorgenti = prepara_sorgenti(SORGENTI_DASHBOARD)
+    attributi_caricamento["sorgenti_ms"] = {nome: esito["durata_ms"] for nome, esito in esiti_sorgenti.items()}
+    errori_sorgenti = {nome: esito["errore"] for nome, esito in esiti_sorgenti.items() if esito["errore"] is not None}
+    if errori_sorgenti:
+        attributi_caricamento["errori"] = {nome: repr(e) for nome, e in errori_sorgenti.items()}
+        for nome, e in errori_sorgenti.items():
+            _errore_caricamento(e, SORGENTI[nome][0], ferma=False)
+        st.stop()
+    versione_voti = versione_sorgente("voti")
+    voti = carica_dati(versione_voti)
+    colonne_municipi = carica_colonne_layer("municipi")
+    colonne_sezioni = carica_colonne_layer("sezioni")
+    colonne_uu = carica_colonne_layer("uu")
+
+# Raggruppamento dei partiti in coalizioni: cambiarlo ricalcola solo le
+# quote dai totali già aggregati, con un prodotto matriciale
+schema_coalizioni = st.sidebar.selectbox("Raggruppamento coalizioni", list(SCHEMI_COALIZIONI))
+
+# Scrutinio in diretta: i risultati arrivano sezione per sezione dal flusso
+# JSONL e vengono applicati come differenze ai totali già aggregati
+scrutinio_attivo = st.sidebar.checkbox(
+    "📡 Scrutinio in diretta",
+    help=f"Legge i risultati delle sezioni man mano che vengono aggiunti a {os.path.basename(FEED_SCRUTINIO)} nella cartella data",
+)
 
 # Aggiungi le percentuali delle coalizioni
-voti, csx_cols, cdx_cols = calcola_percentuali_coalizioni(voti)
+with span("coalizioni", schema=schema_coalizioni):
+    voti = calcola_percentuali_coalizioni(voti, schema_coalizioni)
 
 # Debug per differenze CSX-CDX
 if st.sidebar.checkbox("Debug differenze CSX-CDX"):
@@ -350,65 +161,11 @@ if st.sidebar.checkbox("Debug differenze CSX-CDX"):
         st.sidebar.write("Top 5 CDX:")
         st.sidebar.write(voti.nsmallest(5, 'Diff')[['Municipio', 'Diff']].reset_index(drop=True))
 
-# Determina automaticamente quali colonne usare
-def determine_columns():
-    # Per i municipi
-    municipio_col = None
-    for col in ["MUNICIPIO", "Municipio", "municipio", "NOME_MUNIC", "NOME_MUNICIPIO"]:
-        if col in municipi.columns:
-            municipio_col = col
-            break
-    if not municipio_col:
-        # Se non troviamo una colonna con nome specifico, cerchiamo una colonna che contiene "MUNI" o "NOME"
-        for col in municipi.columns:
-            if "MUNI" in col.upper() or "NOME" in col.upper():
-                municipio_col = col
-                break
-        if not municipio_col:
-            # Usa la prima colonna che non è 'geometry' o '_umap_options'
-            for col in municipi.columns:
-                if col not in ['geometry', '_umap_options']:
-                    municipio_col = col
-                    break
-
-    # Per le sezioni
-    sezione_col = None
-    for col in ["SEZIONE", "Sezione", "sezione", "SEZ", "NUM_SEZIONE"]:
-        if col in sezioni.columns:
-            sezione_col = col
-            break
-    if not sezione_col:
-        for col in sezioni.columns:
-            if "SEZ" in col.upper() or "NUM" in col.upper():
-                sezione_col = col
-                break
-        if not sezione_col:
-            for col in sezioni.columns:
-                if col not in ['geometry', '_umap_options']:
-                    sezione_col = col
-                    break
-
-    # Per le unità urbanistiche
-    uu_col = None
-    for col in ["UNITA_URBANISTICA", "Unita_Urbanistica", "NOME_UU"]:
-        if col in uu.columns:
-            uu_col = col
-            break
-    if not uu_col:
-        for col in uu.columns:
-            if "UNIT" in col.upper() or "NOME" in col.upper() or "UU" in col.upper():
-                uu_col = col
-                break
-        if not uu_col:
-            for col in uu.columns:
-                if col not in ['geometry', '_umap_options']:
-                    uu_col = col
-                    break
-    
-    return municipio_col, sezione_col, uu_col
-
-# Ottieni i nomi delle colonne
-municipio_col, sezione_col, uu_col = determine_columns()
+# Colonne identificative dei layer, rilevate all'ingest e lette dal manifest
+# della cache
+municipio_col = colonne_id("municipi").get("municipio")
+sezione_col = colonne_id("sezioni").get("sezione")
+uu_col = colonne_id("uu").get("uu")
 
 # Debug delle colonne trovate
 st.sidebar.markdown("### 🔍 Colonne trovate")
@@ -419,82 +176,493 @@ st.sidebar.write(f"Colonna unità urbanistica: {uu_col}")
 # Mostra informazioni sulle colonne disponibili
 st.sidebar.markdown("### 📊 Colonne nei dati")
 if st.sidebar.checkbox("Mostra nomi colonne"):
-    st.sidebar.write("Colonne in municipi:", municipi.columns.tolist())
-    st.sidebar.write("Colonne in sezioni:", sezioni.columns.tolist())
-    st.sidebar.write("Colonne in uu:", uu.columns.tolist())
+    st.sidebar.write("Colonne in municipi:", colonne_municipi)
+    st.sidebar.write("Colonne in sezioni:", colonne_sezioni)
+    st.sidebar.write("Colonne in uu:", colonne_uu)
     st.sidebar.write("Colonne in voti:", voti.columns.tolist())
 
 # Verifica che le colonne siano state trovate
 if not municipio_col or not sezione_col or not uu_col:
     st.error("Non sono state trovate tutte le colonne necessarie nei dati. Verifica i nomi delle colonne nei file GeoJSON.")
     if not municipio_col:
-        st.error(f"Colonna municipio non trovata. Colonne disponibili: {municipi.columns.tolist()}")
+        st.error(f"Colonna municipio non trovata. Colonne disponibili: {colonne_municipi}")
     if not sezione_col:
-        st.error(f"Colonna sezione non trovata. Colonne disponibili: {sezioni.columns.tolist()}")
+        st.error(f"Colonna sezione non trovata. Colonne disponibili: {colonne_sezioni}")
     if not uu_col:
-        st.error(f"Colonna unità urbanistica non trovata. Colonne disponibili: {uu.columns.tolist()}")
+        st.error(f"Colonna unità urbanistica non trovata. Colonne disponibili: {colonne_uu}")
     st.stop()
 
-# Funzione per trovare le colonne dei partiti
+# Funzione per trovare le colonne dei partiti (percentuali dei partiti
+# presenti negli schemi di coalizione)
 def trova_colonne_partiti(df):
-    partiti_cols = []
-    for col in df.columns:
-        if "%" in col and any(partito in col for partito in ["PD", "M5S", "AVS", "Orlando", "Bucci", "Lega", "FI", "FdI"]):
-            partiti_cols.append(col)
-    return partiti_cols
+    return colonne_partiti([col for col in df.columns if "%" in col])
 
 # Trova le colonne dei partiti
 partiti_cols = trova_colonne_partiti(voti)
 
+# Colonne del file voti corrispondenti ai livelli territoriali (dal
+# manifest, come quelle dei layer)
+id_voti = colonne_id("voti")
+municipio_voti_col = id_voti.get("municipio", "Municipio")
+sezione_voti_col = id_voti.get("sezione", "SEZIONE")
+uu_voti_col = id_voti.get("uu", "UNITA_URBANISTICA")
+
+# Totali per sezione, unità urbanistica e municipio e relativi indici per
+# unità: i conteggi assoluti delle sezioni vengono sommati livello per
+# livello (rollup) e le percentuali ricavate dai totali, quindi pesate per i
+# voti validi. Calcolati una sola volta per versione dei dati e condivisi
+# tra sessioni e rerun
+@st.cache_resource(max_entries=2)
+def carica_rollup(_voti, gerarchia, versione):
+    return rollup_tabella(_voti, gerarchia[0], list(gerarchia[1:]), colonne_conteggio(_voti, gerarchia))
+
+# Le tabelle per schema di coalizioni vengono ricavate dai totali in cache
+@st.cache_resource(max_entries=6)
+def carica_cubo(_voti, gerarchia, partiti_cols, versione, schema):
+    rollup = carica_rollup(_voti, gerarchia, versione)
+    coalizioni = carica_schema(schema, tuple(rollup["colonne"]))
+    cubo = {livello: tabella_livello(rollup, livello, partiti_cols, coalizioni) for livello in gerarchia}
+    indici = {livello: costruisci_indice(aggregati) for livello, aggregati in cubo.items()}
+    return cubo, indici
+
+with span("aggregati"):
+    cubo, indici = carica_cubo(voti, (sezione_voti_col, uu_voti_col, municipio_voti_col), partiti_cols, versione_voti, schema_coalizioni)
+
+# Totali per la mappa, indicizzati dalle chiavi dei layer: i voti sono
+# assegnati alle sezioni per numero di sezione e sommati su unità
+# urbanistiche e poi municipi con il crosswalk spaziale (quote di area),
+# senza dipendere dalle colonne territoriali del file voti. Il rollup di un
+# layer arriva solo fino a quel layer e usa solo le colonne delle chiavi:
+# le geometrie non vengono lette
+LIVELLI_MAPPA = ("sezioni", "uu", "municipi")
+colonne_mappa = {"sezioni": sezione_col, "uu": uu_col, "municipi": municipio_col}
+
+@st.cache_resource(max_entries=6)
+def carica_rollup_spaziale(_voti, colonne_layer, livello, versione):
+    livelli = LIVELLI_MAPPA[:LIVELLI_MAPPA.index(livello) + 1]
+    chiavi = {nome: carica_chiavi_layer(nome, colonne_layer[nome]) for nome in livelli}
+    return rollup_spaziale(
+        _voti, sezione_voti_col, colonne_conteggio(_voti, (sezione_voti_col, municipio_voti_col)),
+        (livelli[0], chiavi[livelli[0]]),
+        [(nome, chiavi[nome], carica_crosswalk(figlio, nome)) for figlio, nome in zip(livelli, livelli[1:])],
+    )
+
+@st.cache_resource(max_entries=6)
+def carica_cubo_spaziale(_voti, colonne_layer, nome, partiti_cols, versione, schema):
+    rollup = carica_rollup_spaziale(_voti, colonne_layer, nome, versione)
+    coalizioni = carica_schema(schema, tuple(rollup["colonne"]))
+    return tabella_livello(rollup, nome, partiti_cols, coalizioni).rename_axis(colonne_layer[nome])
+
+versione_mappa = (versione_voti, versione_sorgente("sezioni"), versione_sorgente("uu"), versione_sorgente("municipi"))
+
+def cubo_mappa(nome):
+    """Totali del layer per la mappa, con lo schema di coalizioni scelto"""
+    with span("aggregati_mappa", livello=nome):
+        return carica_cubo_spaziale(voti, colonne_mappa, nome, partiti_cols, versione_mappa, schema_coalizioni)
+
+# Archivio di tutte le elezioni disponibili in data/, allineate sulla
+# numerazione di riferimento delle sezioni (con la tabella di
+# armonizzazione, se presente): i confronti tra due elezioni sono
+# differenze tra colonne dello stesso archivio, senza join
+elezioni_disponibili = {elezione: sorgente for elezione, sorgente in ELEZIONI.items() if sorgente_presente(sorgente)}
+versione_archivio = tuple(
+    versione_sorgente(sorgente)
+    for sorgente in [*elezioni_disponibili.values(), "armonizzazione"]
+    if sorgente_presente(sorgente)
+)
+
+@st.cache_resource(max_entries=2)
+def carica_archivio(versione):
+    tabelle = {elezione: carica_tabella(sorgente) for elezione, sorgente in elezioni_disponibili.items()}
+    armonizzazione = carica_tabella("armonizzazione") if sorgente_presente("armonizzazione") else None
+    return costruisci_archivio(tabelle, sezione_voti_col, armonizzazione, (uu_voti_col, municipio_voti_col))
+
+# Variazioni tra due elezioni per ogni livello della mappa: i conteggi di
+# tutte le elezioni salgono insieme lungo lo stesso rollup spaziale
+@st.cache_resource(max_entries=6)
+def carica_confronto(colonne_layer, nome, versione, schema, da, a):
+    archivio = carica_archivio(versione[1])
+    rollup = carica_rollup_spaziale(archivio.reset_index(), colonne_layer, nome, versione)
+    return confronta_elezioni(tabella_livello(rollup, nome), da, a, SCHEMI_COALIZIONI[schema], partiti_cols)
+
+# Stato dello scrutinio: uno per processo, condiviso da tutte le sessioni.
+# Parte da totali vuoti con la stessa gerarchia dei rollup dei dati completi
+@st.cache_resource
+def carica_scrutinio(versione_voti, versione_mappa):
+    return Scrutinio(FeedJsonl(FEED_SCRUTINIO), {
+        "grafici": carica_rollup(voti, (sezione_voti_col, uu_voti_col, municipio_voti_col), versione_voti),
+        "mappa": carica_rollup_spaziale(voti, colonne_mappa, LIVELLI_MAPPA[-1], versione_mappa),
+    }, sezione_voti_col)
+
+def tabella_scrutinio(rollup, livello):
+    """Totali di un livello con i risultati scrutinati finora"""
+    coalizioni = carica_schema(schema_coalizioni, tuple(scrutinio.rollups[rollup]["colonne"]))
+    return scrutinio.tabella(rollup, livello, partiti_cols, coalizioni)
+
+scrutinio = None
+if scrutinio_attivo:
+    scrutinio = carica_scrutinio(versione_voti, versione_mappa)
+    scrutinio.aggiorna()
+    cubo = {livello: tabella_scrutinio("grafici", livello) for livello in cubo}
+    indici = {livello: costruisci_indice(aggregati) for livello, aggregati in cubo.items()}
+
+# Partiti della coalizione CSX dello schema scelto, per lo spaccato a torta
+partiti_csx = partiti_coalizione(carica_schema(schema_coalizioni, tuple(partiti_cols)), "CSX")
+
 # Sidebar
 st.sidebar.title("🧭 Filtri")
 mappa_tipo = st.sidebar.selectbox("Scegli la mappa:", ["Municipi", "Sezioni Elettorali", "Unità Urbanistiche"])
 colore = st.sidebar.color_picker("Colore poligoni (per aree senza dati)", "#2563eb")
 opacita = st.sidebar.slider("Opacità", 0.0, 1.0, 0.6)
+motori_mappa = {
+    "Automatico": None,
+    "SVG (geo)": BACKEND_GEO,
+    "WebGL (MapLibre)": BACKEND_MAP,
+    "WebGL (pydeck)": BACKEND_DECK,
+    "WebGL (TopoJSON)": BACKEND_TOPO,
+    "Tile vettoriali (MVT)": BACKEND_MVT,
+}
+motore_mappa = motori_mappa[st.sidebar.selectbox("Motore mappa", list(motori_mappa))]
+zoom_mappa = st.sidebar.select_slider("Zoom mappa", options=["Adatta", 11, 12, 13, 14, 15, 16])
+
+# Scenario "what-if": variazioni dei partiti e trasferimenti verso una
+# coalizione. Lo scenario è una nuova matrice dei pesi applicata ai totali
+# già aggregati di ogni livello (è lineare nei conteggi): la figura della
+# mappa resta quella in cache e cambia solo il vettore dei colori
+with st.sidebar.expander("🔀 Scenario (what-if)"):
+    schema_partiti = carica_schema(schema_coalizioni, tuple(partiti_cols))
+    nomi_partiti = [col.replace("%", "").strip() for col in schema_partiti["colonne"]]
+    variazioni = {}
+    for partito in nomi_partiti:
+        variazione = st.slider(f"Variazione {partito}", -50, 50, 0, format="%d%%")
+        if variazione:
+            variazioni[partito] = variazione / 100
+    trasferimenti = {}
+    origine = st.selectbox("Trasferimento da", ["Nessuno"] + nomi_partiti)
+    if origine != "Nessuno":
+        destinazione = st.selectbox("verso la coalizione", schema_partiti["coalizioni"])
+        quota = st.slider("Quota trasferita", 0, 100, 0, format="%d%%")
+        if quota:
+            trasferimenti[origine] = {destinazione: quota / 100}
+
+def scenario_compilato(colonne):
+    """Schema scelto con lo scenario applicato (None senza scenario)"""
+    if not variazioni and not trasferimenti:
+        return None
+    return applica_scenario(carica_schema(schema_coalizioni, tuple(colonne)), trasferimenti, variazioni)
+
+def quote_scenario(tabella):
+    """Quote delle coalizioni di una tabella di totali con lo scenario"""
+    conteggi = [col for col in tabella.columns if "%" not in col]
+    return quote_coalizioni(tabella, scenario_compilato(conteggi), tabella[COLONNA_VOTI_VALIDI])
+
+if scenario_compilato(cubo[municipio_voti_col].columns) is not None:
+    # Confronto sull'intera città: totali di tutti i municipi
+    citta = cubo[municipio_voti_col].sum(numeric_only=True).to_frame().T
+    prima, dopo = quote_coalizioni(citta, carica_schema(schema_coalizioni, tuple(citta.columns)), citta[COLONNA_VOTI_VALIDI]), quote_scenario(citta)
+    for col in [c for c in dopo.columns if c != 'Diff']:
+        st.sidebar.metric(f"{col} (scenario)", f"{dopo[col].iloc[0]:.1f}%", f"{dopo[col].iloc[0] - prima[col].iloc[0]:+.1f}")
+
+# Confronto tra due elezioni: la mappa mostra la variazione del distacco
+# CSX-CDX (ha la precedenza sullo scenario)
+confronto = None
+with st.sidebar.expander("📈 Confronto tra elezioni"):
+    if len(elezioni_disponibili) < 2:
+        st.caption("Per confrontare più elezioni aggiungi in data/ i file delle altre elezioni (ad es. voti_regionali_2020.xlsx).")
+    else:
+        elenco_elezioni = list(elezioni_disponibili)
+        da = st.selectbox("Dall'elezione", elenco_elezioni, index=1)
+        a = st.selectbox("All'elezione", elenco_elezioni, index=0)
+        if da != a:
+            confronto = (da, a)
+
+if confronto:
+    archivio = carica_archivio(versione_archivio)
+    citta = archivio.sum().to_frame().T
+    variazioni_citta = confronta_elezioni(citta, *confronto, SCHEMI_COALIZIONI[schema_coalizioni], partiti_cols).iloc[0]
+    st.subheader(f"📈 Variazioni da {confronto[0]} a {confronto[1]}")
+    st.caption("Sulla mappa: variazione del distacco CSX-CDX, in punti percentuali.")
+    fig_swing = grafico_swing(variazioni_citta, "Intera città")
+    if fig_swing: st.plotly_chart(fig_swing, use_container_width=True)
+
+# Figura della mappa: geometrie e join con i voti sono costruiti una sola
+# volta per (layer, versione dei dati); colore e opacità vengono applicati
+# come modifica di stile sulla figura in cache
+# Se il server serve i file statici, la geometria viene inviata al browser una
+# sola volta come file GeoJSON e le figure trasportano solo i valori
+# La geometria usata è il livello della piramide di semplificazione adatto
+# allo zoom: la risoluzione piena solo agli zoom più alti
+# Server locale delle tile vettoriali: uno per processo, condiviso da tutte
+# le sessioni; il browser scarica solo le tile dell'area visibile
+@st.cache_resource
+def server_tile():
+    return avvia_server_tile(TILE_DIR)
+
+def tile_raggiungibili():
+    """
+    Indica se il browser può scaricare le tile: sempre se è configurato un
+    URL pubblico (DASHBOARD_URL_TILE), altrimenti solo se la pagina è
+    aperta sulla macchina stessa (senza intestazione Host, come nei test,
+    si assume di sì)
+    """
+    if server_tile().url_pubblico:
+        return True
+    host = urlsplit(f"//{st.context.headers.get('Host', '')}").hostname
+    return host in (None, "localhost", "127.0.0.1", "::1")
+
+def url_tile(nome, fissa=False):
+    """
+    Funzione valori -> modello di URL delle tile del layer con quei valori.
+    Con 'fissa' i valori restano registrati nel server (per le figure in
+    cache, il cui URL viene riusato a ogni rerun).
+    """
+    server = server_tile()
+    tileset = esporta_mbtiles(nome)
+    return lambda valori, base=None: server.url_tile(tileset, server.registra_valori(valori, base, fissa))
+
+@st.cache_resource(max_entries=12)
+def carica_figura_mappa(nome, colonna_id, versione, geometria_statica, backend, tolleranza, zoom, schema):
+    return costruisci_figura_mappa(
+        carica_layer_mappa(nome, tolleranza),
+        colonna_id,
+        df_voti=voti,
+        join_col=colonna_id,
+        partiti_cols=partiti_cols,
+        aggregati=cubo_mappa(nome),
+        geojson_url=esporta_geometria(nome, tolleranza) if geometria_statica else None,
+        topojson_url=esporta_topojson(nome, tolleranza) if geometria_statica else None,
+        url_tile=url_tile(nome, fissa=True) if backend == BACKEND_MVT else None,
+        backend=backend,
+        zoom=zoom
+    )
+
+def valori_aggregati(aggregati):
+    """Valori della mappa da una tabella di totali, con lo scenario se c'è"""
+    return quote_scenario(aggregati) if scenario_compilato(aggregati.columns) is not None else aggregati
+
+def valori_per_area(nome, colonna_id, valori):
+    """Colonne della mappa nell'ordine delle geometrie del layer"""
+    chiavi = carica_chiavi_layer(nome, colonna_id).astype(str)
+    valori = valori.reindex(chiavi).reset_index(drop=True)
+    return valori[[col for col in ['CSX %', 'CDX %', 'Diff', *partiti_cols] if col in valori.columns]]
+
+def mappa_livello(nome, colonna_id, aggregati=None, evidenziata=None):
+    """
+    Figura della mappa di un livello, con i valori per area applicati (None
+    se sono quelli della figura in cache) e il motore usato
+    """
+    versione = (versione_voti, versione_sorgente(nome))
+    geometria_statica = bool(st.get_option("server.enableStaticServing"))
+    # Numero di poligoni ed estensione dal livello più leggero della piramide
+    anteprima = carica_layer_mappa(nome, PIRAMIDE_TOLLERANZE_M[-1])
+    centro, zoom_adattato = centro_zoom(anteprima.to_crs("EPSG:4326"))
+    zoom = None if zoom_mappa == "Adatta" else zoom_mappa
+    tolleranza = tolleranza_per_zoom(zoom_adattato if zoom is None else zoom, centro["lat"])
+    # Con "Automatico" si passa a WebGL oltre una soglia di poligoni (alle
+    # tile vettoriali solo se il browser raggiunge il loro server)
+    backend = scegli_backend(len(anteprima), motore_mappa, tile=tile_raggiungibili())
+    if motore_mappa == BACKEND_MVT and backend != BACKEND_MVT:
+        st.caption("Tile vettoriali non raggiungibili da questo browser (vedi DASHBOARD_URL_TILE): la mappa usa un altro motore")
+    with span("figura", livello=nome, motore=backend, tolleranza=tolleranza):
+        fig = carica_figura_mappa(nome, colonna_id, versione, geometria_statica, backend, tolleranza, zoom, schema_coalizioni)
+    valori = range_color = None
+    if confronto:
+        versione_confronto = ("archivio", versione_archivio, *versione_mappa[1:])
+        valori = carica_confronto(colonne_mappa, nome, versione_confronto, schema_coalizioni, *confronto)
+        massimo = np.nanmax(np.abs(valori['Diff'].to_numpy(dtype=float)), initial=0) or 10
+        range_color = [-massimo, massimo]
+    elif aggregati is not None or scenario_compilato(cubo_mappa(nome).columns) is not None:
+        # Totali diversi da quelli della figura (scrutinio) e/o scenario
+        valori = valori_aggregati(cubo_mappa(nome) if aggregati is None else aggregati)
+    if valori is not None:
+        # Valori nell'ordine delle geometrie del layer: cambia solo il
+        # vettore dei colori (e dei tooltip) della figura in cache
+        with span("valori_mappa", unita=len(valori)):
+            valori = valori_per_area(nome, colonna_id, valori)
+            fig = aggiorna_valori_mappa(fig, valori, url_tile(nome) if backend == BACKEND_MVT else None, range_color)
+    fig = evidenzia_area(fig, evidenziata)
+    return applica_stile_mappa(fig, colore, opacita), valori, backend
+
+# Durante lo scrutinio la mappa si aggiorna da sola: a ogni intervallo viene
+# rieseguita solo questa funzione. La figura inviata resta nello stato della
+# sessione con la versione dello scrutinio: se la versione non cambia viene
+# riusata la stessa figura (il messaggio è identico e il browser, che lo ha
+# già, ne riceve solo il riferimento), altrimenti nella figura inviata
+# cambiano solo le aree con nuovi risultati. L'area evidenziata è letta a
+# ogni esecuzione: può essere cambiata da un clic senza rieseguire la mappa
+@st.fragment(run_every=INTERVALLO_SCRUTINIO)
+def mappa_scrutinio(nome, colonna_id, chiave, al_clic):
+    with traccia_frammento("mappa_scrutinio", livello=nome):
+        with span("scrutinio") as attributi:
+            versione = attributi["versione"] = scrutinio.aggiorna()
+        st.metric("Sezioni scrutinate", f"{len(scrutinio.scrutinate)} / {scrutinio.totale_sezioni}")
+        evidenziata = st.session_state.get(f"area_mappa_{nome}")
+        inviata = st.session_state.get(f"scrutinio_{chiave}")
+        if inviata is None or inviata["evidenziata"] != evidenziata or inviata["valori"] is None:
+            fig, valori, backend = mappa_livello(nome, colonna_id, tabella_scrutinio("mappa", nome), evidenziata)
+        elif inviata["versione"] != versione and not confronto:
+            backend = inviata["backend"]
+            valori = valori_per_area(nome, colonna_id, valori_aggregati(tabella_scrutinio("mappa", nome)))
+            with span("valori_mappa", unita=len(valori)):
+                fig = aggiorna_valori_mappa(
+                    inviata["fig"], valori, url_tile(nome) if backend == BACKEND_MVT else None, precedenti=inviata["valori"]
+                )
+        else:
+            fig, valori, backend = inviata["fig"], inviata["valori"], inviata["backend"]
+        st.session_state[f"scrutinio_{chiave}"] = dict(
+            versione=versione, evidenziata=evidenziata, fig=fig, valori=valori, backend=backend
+        )
+        mostra_mappa(fig, chiave, al_clic)
+
+def mostra_mappa_livello(nome, colonna_id, chiave=None, al_clic="ignore"):
+    if scrutinio is None:
+        fig, _, _ = mappa_livello(nome, colonna_id, evidenziata=st.session_state.get(f"area_mappa_{nome}"))
+        mostra_mappa(fig, chiave, al_clic)
+    else:
+        # Motore, stile, scenario e confronto possono essere cambiati: la
+        # prima esecuzione del frammento ricostruisce la figura
+        st.session_state.pop(f"scrutinio_{chiave}", None)
+        mappa_scrutinio(nome, colonna_id, chiave, al_clic)
+
+def mostra_mappa(fig, chiave=None, al_clic="ignore"):
+    # Lo span comprende la serializzazione della figura da parte di Streamlit
+    with span("invio_mappa") as attributi:
+        if dettagliata():
+            attributi["payload_byte"] = dimensione_payload(fig)
+        if isinstance(fig, go.Figure):
+            st.plotly_chart(fig, use_container_width=True, key=chiave, on_select=al_clic, selection_mode="points")
+        elif isinstance(fig, dict):
+            # Mappa TopoJSON: disegnata nel browser da un componente HTML (senza
+            # selezione con un clic)
+            components.html(html_mappa_topojson(fig, esporta_plotlyjs()), height=fig["altezza"])
+        else:
+            st.pydeck_chart(fig, use_container_width=True, key=chiave, on_select=al_clic, selection_mode="single-object")
+
+# Grafici dell'unità scelta (selectbox e grafici), in un frammento a sé: la
+# scelta di un'unità dal menu riesegue solo questo frammento (e la mappa
+# solo se cambia l'area da evidenziare). Dipende soltanto da ciò che
+# riceve: il layer e il livello, le unità selezionabili (etichetta mostrata
+# -> valore) e, dall'ultima esecuzione completa, voti, indici e partiti
+# della coalizione
+@st.fragment(key="grafici_unita")
+def grafici_unita(nome, livello, etichetta, unita):
+    with traccia_frammento("grafici_unita", livello=livello):
+        scelta = st.selectbox(
+            etichetta, list(unita), key=f"unita_{livello}",
+            on_change=functools.partial(cambia_unita, nome, livello, unita),
+        )
+        valore = unita[scelta]
+        with span("grafici", unita=str(valore)):
+            fig_torta = grafico_torta_csx(voti, livello, valore, indici.get(livello), partiti_csx)
+            fig_barre = grafico_barre_partiti(voti, livello, valore, indici.get(livello))
+        if fig_torta: st.plotly_chart(fig_torta, use_container_width=True)
+        if fig_barre: st.plotly_chart(fig_barre, use_container_width=True)
+
+LEGENDA_MAPPA = """
+<div style="display: flex; justify-content: center; align-items: center; margin: 20px 0;">
+    <div style="display: flex; align-items: center;">
+        <div style="width: 20px; height: 20px; background-color: blue; margin-right: 5px;"></div>
+        <span>CDX avanti</span>
+    </div>
+    <div style="margin: 0 15px; border-top: 1px solid #ccc; width: 50px;"></div>
+    <div style="display: flex; align-items: center;">
+        <div style="width: 20px; height: 20px; background-color: white; border: 1px solid #ccc; margin-right: 5px;"></div>
+        <span>Parità</span>
+    </div>
+    <div style="margin: 0 15px; border-top: 1px solid #ccc; width: 50px;"></div>
+    <div style="display: flex; align-items: center;">
+        <div style="width: 20px; height: 20px; background-color: red; margin-right: 5px;"></div>
+        <span>CSX avanti</span>
+    </div>
+</div>
+"""
+
+# Corrispondenza tra le aree di un layer e le unità del file voti: le
+# sezioni del file sono assegnate alle sezioni del layer per numero e
+# ripartite sulle aree del livello con il crosswalk spaziale, quindi ogni
+# area corrisponde all'unità del file che vi ricade di più (e viceversa),
+# qualunque sia la colonna identificativa del layer (ad es. i nomi dei
+# municipi nel layer e i codici nel file voti)
+@st.cache_resource(max_entries=6)
+def carica_aree_unita(nome, livello, versione):
+    sezioni = matrice_chiavi(voti[sezione_voti_col], carica_chiavi_layer("sezioni", sezione_col))
+    sezioni_aree = sezioni if nome == "sezioni" else sezioni @ carica_crosswalk("sezioni", nome)
+    codici, valori = pd.factorize(voti[livello].astype(str).where(voti[livello].notna()))
+    presenti = codici >= 0
+    unita_sezioni = sp.csr_matrix(
+        (np.ones(presenti.sum()), (codici[presenti], np.flatnonzero(presenti))), shape=(len(valori), len(codici))
+    )
+    pesi = (unita_sezioni @ sezioni_aree).toarray()
+    aree = [valori[i] if pesi[i, j] > 0 else None for j, i in enumerate(pesi.argmax(axis=0))]
+    unita_area = {valori[i]: int(j) for i, j in enumerate(pesi.argmax(axis=1)) if pesi[i, j] > 0}
+    return aree, unita_area
+
+def seleziona_da_mappa(chiave_mappa, nome, livello, unita):
+    """
+    Clic su un'area della mappa: dall'id della feature (posizione nel
+    layer) ricava l'unità corrispondente tra quelle del menu e la seleziona
+    """
+    evento = st.session_state.get(chiave_mappa)
+    id_area = id_selezione_mappa(evento)
+    if id_area is None:
+        return
+    aree, _ = carica_aree_unita(nome, livello, versione_mappa)
+    valore = aree[id_area] if id_area < len(aree) else None
+    etichetta = next((etichetta for etichetta, v in unita.items() if str(v) == valore), None)
+    if etichetta is not None:
+        st.session_state[f"unita_{livello}"] = etichetta
+        mostrata = area_selezionata_nel_browser(evento)
+        riesegui_dopo_scelta(nome, livello, unita, st.session_state.get(f"area_mappa_{nome}") if mostrata is None else mostrata)
+
+def cambia_unita(nome, livello, unita):
+    """Scelta di un'unità dal menu"""
+    riesegui_dopo_scelta(nome, livello, unita, st.session_state.get(f"area_mappa_{nome}"))
+
+def riesegui_dopo_scelta(nome, livello, unita, mostrata):
+    """
+    Dopo la scelta di un'unità riesegue i grafici e, solo se l'area da
+    evidenziare non è quella già mostrata nel browser ('mostrata'), anche
+    la mappa
+    """
+    area = area_selezionata(nome, livello, unita)
+    st.session_state[f"area_mappa_{nome}"] = area
+    st.rerun("grafici_unita" if area == mostrata else ["mappa_unita", "grafici_unita"])
+
+def area_selezionata(nome, livello, unita):
+    """Id (posizione nel layer) dell'area dell'unità scelta nel menu"""
+    scelta = st.session_state.get(f"unita_{livello}")
+    if scelta not in unita:
+        scelta = next(iter(unita))
+    _, unita_area = carica_aree_unita(nome, livello, versione_mappa)
+    return unita_area.get(str(unita[scelta]))
+
+# Mappa di un livello, con l'area dell'unità scelta evidenziata (una
+# modifica sulla copia della figura in cache). Viene rieseguita solo quando
+# cambia l'area da evidenziare: dopo un clic Plotly mostra già selezionata
+# l'area cliccata e si rieseguono solo i grafici
+@st.fragment(key="mappa_unita")
+def mappa_unita(nome, colonna_id, livello, unita):
+    with traccia_frammento("mappa_unita", livello=nome):
+        chiave_mappa = f"mappa_{nome}"
+        al_clic = "ignore"
+        evidenziata = None
+        if unita:
+            al_clic = functools.partial(seleziona_da_mappa, chiave_mappa, nome, livello, unita)
+            evidenziata = area_selezionata(nome, livello, unita)
+        st.session_state[f"area_mappa_{nome}"] = evidenziata
+        mostra_mappa_livello(nome, colonna_id, chiave_mappa, al_clic)
+
+def mappa_e_grafici(nome, colonna_id, livello, etichetta, unita):
+    mappa_unita(nome, colonna_id, livello, unita)
+    st.markdown(LEGENDA_MAPPA, unsafe_allow_html=True)
+    if unita:
+        grafici_unita(nome, livello, etichetta, unita)
 
 # Mappa + grafici
 if mappa_tipo == "Municipi":
     st.subheader("🗺️ Mappa dei Municipi")
     
-    # Verifica la colonna corretta nel DataFrame voti
-    municipio_voti_col = "Municipio"  # Colonna predefinita
-    if municipio_voti_col not in voti.columns:
-        for col in voti.columns:
-            if "MUNI" in col.upper() or "municipio" in col.lower():
-                municipio_voti_col = col
-                break
-    
-    fig = crea_mappa_plotly(
-        municipi, 
-        municipio_col, 
-        colore, 
-        opacita, 
-        df_voti=voti, 
-        join_col=municipio_voti_col,
-        partiti_cols=partiti_cols
-    )
-    st.plotly_chart(fig, use_container_width=True)
-    
-    # Aggiungi legenda per la colorazione della mappa
-    st.markdown("""
-    <div style="display: flex; justify-content: center; align-items: center; margin: 20px 0;">
-        <div style="display: flex; align-items: center;">
-            <div style="width: 20px; height: 20px; background-color: blue; margin-right: 5px;"></div>
-            <span>CDX avanti</span>
-        </div>
-        <div style="margin: 0 15px; border-top: 1px solid #ccc; width: 50px;"></div>
-        <div style="display: flex; align-items: center;">
-            <div style="width: 20px; height: 20px; background-color: white; border: 1px solid #ccc; margin-right: 5px;"></div>
-            <span>Parità</span>
-        </div>
-        <div style="margin: 0 15px; border-top: 1px solid #ccc; width: 50px;"></div>
-        <div style="display: flex; align-items: center;">
-            <div style="width: 20px; height: 20px; background-color: red; margin-right: 5px;"></div>
-            <span>CSX avanti</span>
-        </div>
-    </div>
-    """, unsafe_allow_html=True)
-    
+    unita = None
     if municipio_voti_col in voti.columns:
         # Conversione da numeri a nomi letterali per i municipi
         municipi_map = {
@@ -527,122 +695,60 @@ if mappa_tipo == "Municipi":
             except:
                 municipi_display.append(str(val))
         
-        municipio_scelto_display = st.selectbox("Seleziona un municipio", municipi_display)
-        
-        # Estrai il valore numerico se presente
-        if " - " in municipio_scelto_display:
-            municipio_scelto = municipio_scelto_display.split(" - ")[0]
-        else:
-            municipio_scelto = municipio_scelto_display
-        
-        fig_torta = grafico_torta_csx(voti, municipio_voti_col, municipio_scelto)
-        fig_barre = grafico_barre_partiti(voti, municipio_voti_col, municipio_scelto)
-        if fig_torta: st.plotly_chart(fig_torta, use_container_width=True)
-        if fig_barre: st.plotly_chart(fig_barre, use_container_width=True)
-    else:
+        # Il valore è il numero del municipio se presente
+        unita = {
+            display: display.split(" - ")[0] if " - " in display else display
+            for display in municipi_display
+        }
+
+    mappa_e_grafici("municipi", municipio_col, municipio_voti_col, "Seleziona un municipio", unita)
+    if unita is None:
         st.error(f"Colonna 'Municipio' non trovata nel file voti. Colonne disponibili: {voti.columns.tolist()}")
 
 elif mappa_tipo == "Sezioni Elettorali":
     st.subheader("🗺️ Mappa delle Sezioni Elettorali")
     
-    # Verifica la colonna corretta nel DataFrame voti
-    sezione_voti_col = "SEZIONE"  # Colonna predefinita
-    if sezione_voti_col not in voti.columns:
-        for col in voti.columns:
-            if "SEZ" in col.upper() or "sezione" in col.lower():
-                sezione_voti_col = col
-                break
-    
-    fig = crea_mappa_plotly(
-        sezioni, 
-        sezione_col, 
-        colore, 
-        opacita, 
-        df_voti=voti, 
-        join_col=sezione_voti_col,
-        partiti_cols=partiti_cols
-    )
-    st.plotly_chart(fig, use_container_width=True)
-    
-    # Aggiungi legenda per la colorazione della mappa
-    st.markdown("""
-    <div style="display: flex; justify-content: center; align-items: center; margin: 20px 0;">
-        <div style="display: flex; align-items: center;">
-            <div style="width: 20px; height: 20px; background-color: blue; margin-right: 5px;"></div>
-            <span>CDX avanti</span>
-        </div>
-        <div style="margin: 0 15px; border-top: 1px solid #ccc; width: 50px;"></div>
-        <div style="display: flex; align-items: center;">
-            <div style="width: 20px; height: 20px; background-color: white; border: 1px solid #ccc; margin-right: 5px;"></div>
-            <span>Parità</span>
-        </div>
-        <div style="margin: 0 15px; border-top: 1px solid #ccc; width: 50px;"></div>
-        <div style="display: flex; align-items: center;">
-            <div style="width: 20px; height: 20px; background-color: red; margin-right: 5px;"></div>
-            <span>CSX avanti</span>
-        </div>
-    </div>
-    """, unsafe_allow_html=True)
-    
+    unita = None
     if sezione_voti_col in voti.columns:
-        sezione_scelta = st.selectbox("Seleziona una sezione elettorale", sorted(voti[sezione_voti_col].dropna().unique()))
-        fig_torta = grafico_torta_csx(voti, sezione_voti_col, sezione_scelta)
-        fig_barre = grafico_barre_partiti(voti, sezione_voti_col, sezione_scelta)
-        if fig_torta: st.plotly_chart(fig_torta, use_container_width=True)
-        if fig_barre: st.plotly_chart(fig_barre, use_container_width=True)
-    else:
+        sezioni_valori = sorted(voti[sezione_voti_col].dropna().unique())
+        unita = dict(zip(sezioni_valori, sezioni_valori))
+
+    mappa_e_grafici("sezioni", sezione_col, sezione_voti_col, "Seleziona una sezione elettorale", unita)
+    if unita is None:
         st.error(f"Colonna 'SEZIONE' non trovata nel file voti. Colonne disponibili: {voti.columns.tolist()}")
 
 elif mappa_tipo == "Unità Urbanistiche":
     st.subheader("🗺️ Mappa delle Unità Urbanistiche")
     
-    # Verifica la colonna corretta nel DataFrame voti
-    uu_voti_col = "UNITA_URBANISTICA"  # Colonna predefinita
-    if uu_voti_col not in voti.columns:
-        for col in voti.columns:
-            if "UNIT" in col.upper() or "UU" in col.upper() or "urbanistica" in col.lower():
-                uu_voti_col = col
-                break
-    
-    fig = crea_mappa_plotly(
-        uu, 
-        uu_col, 
-        colore, 
-        opacita, 
-        df_voti=voti, 
-        join_col=uu_voti_col,
-        partiti_cols=partiti_cols
-    )
-    st.plotly_chart(fig, use_container_width=True)
-    
-    # Aggiungi legenda per la colorazione della mappa
-    st.markdown("""
-    <div style="display: flex; justify-content: center; align-items: center; margin: 20px 0;">
-        <div style="display: flex; align-items: center;">
-            <div style="width: 20px; height: 20px; background-color: blue; margin-right: 5px;"></div>
-            <span>CDX avanti</span>
-        </div>
-        <div style="margin: 0 15px; border-top: 1px solid #ccc; width: 50px;"></div>
-        <div style="display: flex; align-items: center;">
-            <div style="width: 20px; height: 20px; background-color: white; border: 1px solid #ccc; margin-right: 5px;"></div>
-            <span>Parità</span>
-        </div>
-        <div style="margin: 0 15px; border-top: 1px solid #ccc; width: 50px;"></div>
-        <div style="display: flex; align-items: center;">
-            <div style="width: 20px; height: 20px; background-color: red; margin-right: 5px;"></div>
-            <span>CSX avanti</span>
-        </div>
-    </div>
-    """, unsafe_allow_html=True)
-    
+    unita = None
     if uu_voti_col in voti.columns:
-        uu_scelta = st.selectbox("Seleziona un'unità urbanistica", sorted(voti[uu_voti_col].dropna().unique()))
-        fig_torta = grafico_torta_csx(voti, uu_voti_col, uu_scelta)
-        fig_barre = grafico_barre_partiti(voti, uu_voti_col, uu_scelta)
-        if fig_torta: st.plotly_chart(fig_torta, use_container_width=True)
-        if fig_barre: st.plotly_chart(fig_barre, use_container_width=True)
-    else:
+        uu_valori = sorted(voti[uu_voti_col].dropna().unique())
+        unita = dict(zip(uu_valori, uu_valori))
+
+    mappa_e_grafici("uu", uu_col, uu_voti_col, "Seleziona un'unità urbanistica", unita)
+    if unita is None:
         st.error(f"Colonna 'UNITA_URBANISTICA' non trovata nel file voti. Colonne disponibili: {voti.columns.tolist()}")
 
 st.markdown("---")
 st.markdown("Dashboard per AVS Genova 2025")
+
+# Pannello dei tempi: gli span dell'esecuzione appena conclusa e le
+# esecuzioni più lente registrate nel log
+termina_traccia(traccia_rerun, LOG_TRACCE)
+if st.sidebar.checkbox("⏱️ Tempi del rerun", key="pannello_tempi"):
+    st.sidebar.metric("Durata dell'esecuzione", f"{traccia_rerun.durata_ms:.0f} ms")
+    for errore in traccia_rerun.attributi.get("errori", []):
+        st.sidebar.warning(errore)
+    st.sidebar.dataframe(pd.DataFrame([
+        {
+            "Fase": "\u2003" * voce["livello"] + voce["nome"],
+            "ms": voce["durata_ms"],
+            "Dettagli": ", ".join(f"{chiave}={valore}" for chiave, valore in voce["attributi"].items()),
+        }
+        for voce in traccia_rerun.span
+    ]), hide_index=True)
+    lente = sorted(leggi_tracce(LOG_TRACCE), key=lambda t: t.get("durata_ms") or 0, reverse=True)[:5]
+    st.sidebar.caption("Esecuzioni più lente nel log")
+    st.sidebar.dataframe(pd.DataFrame([
+        {"Ora": t["ts"], "Esecuzione": t["nome"], "ms": t["durata_ms"]} for t in lente
+    ]), hide_index=True)
@@ -0,0 +1,55 @@
+# utils/aggregazioni.py
+
+from utils.coalizioni import quote_coalizioni
+from utils.rollup import COLONNA_VOTI_VALIDI
+
+
+def colonne_base_coalizioni(df):
+    """
+    Colonne su cui compilare lo schema di coalizioni: i conteggi se c'è il
+    totale dei voti validi, altrimenti le percentuali dei partiti
+    """
+    if COLONNA_VOTI_VALIDI in df.columns:
+        return [col for col in df.columns if "%" not in col]
+    return [col for col in df.columns if "%" in col]
+
+
+def aggiungi_quote_coalizioni(df, compilato):
+    """
+    Aggiunge a una vista del DataFrame le percentuali delle coalizioni dello
+    schema compilato (su colonne_base_coalizioni): dai voti di lista sui voti
+    validi, oppure sommando le percentuali dei partiti.
+    Il DataFrame ricevuto (condiviso tra le sessioni) non viene modificato.
+    """
+    df = df.copy(deep=False)
+    denominatore = df[COLONNA_VOTI_VALIDI] if COLONNA_VOTI_VALIDI in df.columns else None
+    quote = quote_coalizioni(df, compilato, denominatore)
+    for col in quote.columns:
+        if col != 'Diff':
+            df[col] = quote[col]
+    return df
+
+
+def costruisci_indice(aggregati):
+    """
+    Costruisce l'indice di un livello: chiave dell'unità -> posizione della
+    riga nella matrice dei valori aggregati. La ricerca di un'unità costa
+    quindi O(1), qualunque sia il numero di unità del livello.
+    """
+    return {
+        "posizioni": {chiave: i for i, chiave in enumerate(aggregati.index)},
+        "colonne": {col: j for j, col in enumerate(aggregati.columns)},
+        "valori": aggregati.to_numpy(dtype=float),
+    }
+
+
+def valori_unita(indice, valore, colonne):
+    """
+    Restituisce i valori aggregati di un'unità per le colonne richieste,
+    oppure None se l'unità non è presente nell'indice.
+    """
+    pos = indice["posizioni"].get(str(valore))
+    if pos is None:
+        return None
+    riga = indice["valori"][pos]
+    return {col: riga[indice["colonne"][col]] for col in colonne if col in indice["colonne"]}
@@ -3,27 +3,46 @@
 import pandas as pd
 import plotly.express as px
 
-# Funzione per mostrare un grafico a torta del voto CSX
+from utils.aggregazioni import valori_unita
+from utils.rollup import COLONNA_VOTI_VALIDI, aggiungi_percentuali, colonne_conteggio
+
+PARTITI_CSX = ["PD %", "M5S %", "AVS - Lista Sansa - Possibile %", "liste Orlando %"]
+ETICHETTE_PARTITI = {"AVS - Lista Sansa - Possibile %": "AVS", "liste Orlando %": "Liste Orlando"}
+PARTITI = [
+    "PD %", "M5S %", "AVS - Lista Sansa - Possibile %",
+    "liste Orlando %", "liste Bucci %", "Lega %", "FI %", "FdI %"
+]
 
-def grafico_torta_csx(df: pd.DataFrame, livello: str, valore: str):
-    col_pd = "PD %"
-    col_m5s = "M5S %"
-    col_avs = "AVS - Lista Sansa - Possibile %"
-    col_orlando = "liste Orlando %"
+# Percentuali dei partiti per un'unità: dall'indice precalcolato se
+# disponibile, altrimenti sommando i voti delle sezioni dell'unità (le
+# percentuali sono pesate per i voti validi, non medie delle sezioni)
 
-    df_filtrato = df[df[livello] == valore]
+def medie_unita(df: pd.DataFrame, livello: str, valore, partiti, indice=None):
+    if indice is not None:
+        return valori_unita(indice, valore, partiti)
 
+    df_filtrato = df[df[livello].astype(str) == str(valore)]
     if df_filtrato.empty:
         return None
+    if COLONNA_VOTI_VALIDI not in df_filtrato.columns:
+        return {partito: df_filtrato[partito].mean() for partito in partiti if partito in df_filtrato.columns}
+
+    totali = df_filtrato[colonne_conteggio(df_filtrato, (livello,))].sum().to_frame().T
+    riga = aggiungi_percentuali(totali, partiti).iloc[0]
+    return {partito: riga[partito] for partito in partiti if partito in riga.index}
 
-    media_pd = df_filtrato[col_pd].mean()
-    media_m5s = df_filtrato[col_m5s].mean()
-    media_avs = df_filtrato[col_avs].mean()
-    media_orlando = df_filtrato[col_orlando].mean()
+# Funzione per mostrare un grafico a torta del voto CSX
+
+def grafico_torta_csx(df: pd.DataFrame, livello: str, valore: str, indice=None, partiti=None):
+    partiti = partiti or PARTITI_CSX
+    medie = medie_unita(df, livello, valore, partiti, indice)
+
+    if not medie:
+        return None
 
     dati = pd.DataFrame({
-        "Partito": ["PD", "M5S", "AVS", "Liste Orlando"],
-        "Percentuale": [media_pd, media_m5s, media_avs, media_orlando]
+        "Partito": [ETICHETTE_PARTITI.get(col, col.replace("%", "").strip()) for col in partiti],
+        "Percentuale": [medie.get(col) for col in partiti]
     })
 
     fig = px.pie(
@@ -35,25 +54,18 @@ def grafico_torta_csx(df: pd.DataFrame, livello: str, valore: str):
         color_discrete_sequence=["#235789", "#F1D302", "#C1292E", "#6a0dad"]
     )
 
-    fig.update_traces(textinfo="label+percent", pull=[0.05] * 4)
+    fig.update_traces(textinfo="label+percent", pull=[0.05] * len(partiti))
     fig.update_layout(height=400, margin={"t": 50, "b": 0, "l": 0, "r": 0})
 
     return fig
 
 # Funzione per grafico a barre comparativo partiti
 
-def grafico_barre_partiti(df: pd.DataFrame, livello: str, valore: str):
-    df_filtrato = df[df[livello] == valore]
-    if df_filtrato.empty:
+def grafico_barre_partiti(df: pd.DataFrame, livello: str, valore: str, indice=None):
+    medie = medie_unita(df, livello, valore, PARTITI, indice)
+    if not medie:
         return None
 
-    partiti = [
-        "PD %", "M5S %", "AVS - Lista Sansa - Possibile %",
-        "liste Orlando %", "liste Bucci %", "Lega %", "FI %", "FdI %"
-    ]
-
-    medie = {partito: df_filtrato[partito].mean() for partito in partiti if partito in df_filtrato.columns}
-
     df_bar = pd.DataFrame({
         "Partito": list(medie.keys()),
         "Percentuale": list(medie.values())
@@ -69,3 +81,30 @@ def grafico_barre_partiti(df: pd.DataFrame, livello: str, valore: str):
 
     fig.update_layout(height=400, margin={"t": 50, "b": 0, "l": 0, "r": 0})
     return fig
+
+# Grafico delle variazioni tra due elezioni (punti percentuali), in rosso
+# gli aumenti e in blu i cali
+
+def grafico_swing(variazioni: pd.Series, titolo: str):
+    variazioni = variazioni.drop(labels=['Diff'], errors="ignore").dropna()
+    if variazioni.empty:
+        return None
+
+    df_bar = pd.DataFrame({
+        "Voce": [ETICHETTE_PARTITI.get(col, col.replace("%", "").strip()) for col in variazioni.index],
+        "Variazione": variazioni.to_numpy(),
+    })
+    df_bar["Segno"] = df_bar["Variazione"].map(lambda v: "Aumento" if v >= 0 else "Calo")
+
+    fig = px.bar(
+        df_bar,
+        x="Voce",
+        y="Variazione",
+        color="Segno",
+        color_discrete_map={"Aumento": "#dc2626", "Calo": "#2563eb"},
+        title=f"Variazioni (punti percentuali) - {titolo}",
+        text_auto="+.1f"
+    )
+
+    fig.update_layout(height=400, margin={"t": 50, "b": 0, "l": 0, "r": 0}, showlegend=False)
+    return fig
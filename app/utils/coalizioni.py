@@ -0,0 +1,144 @@
+# utils/coalizioni.py
+
+import numpy as np
+import pandas as pd
+
+# Schemi di raggruppamento: coalizione -> partiti (nomi delle liste come
+# nel file voti, senza "%"; confronto esatto a meno di maiuscole e spazi).
+# Un partito può comparire con un peso (dizionario partito -> peso) se va
+# ripartito tra più coalizioni. 'Diff' è sempre CSX - CDX.
+SCHEMI_COALIZIONI = {
+    "Coalizioni regionali 2024": {
+        "CSX": ["PD", "M5S", "AVS - Lista Sansa - Possibile", "liste Orlando"],
+        "CDX": ["Lega", "FdI", "FI", "liste Bucci"],
+        "Altri": ["altro"],
+    },
+    "CSX senza M5S": {
+        "CSX": ["PD", "AVS - Lista Sansa - Possibile", "liste Orlando"],
+        "M5S": ["M5S"],
+        "CDX": ["Lega", "FdI", "FI", "liste Bucci"],
+        "Altri": ["altro"],
+    },
+    "Solo partiti (senza liste civiche)": {
+        "CSX": ["PD", "M5S", "AVS - Lista Sansa - Possibile"],
+        "CDX": ["Lega", "FdI", "FI"],
+        "Civiche": ["liste Orlando", "liste Bucci"],
+        "Altri": ["altro"],
+    },
+}
+SCHEMA_PREDEFINITO = "Coalizioni regionali 2024"
+
+
+def _nome_partito(colonna):
+    return colonna.replace("%", "").strip().casefold()
+
+
+def compila_schema(schema, colonne):
+    """
+    Compila uno schema di coalizioni sulle colonne disponibili (conteggi
+    o percentuali dei partiti): restituisce le colonne dei partiti trovati,
+    i nomi delle coalizioni e la matrice dei pesi partiti x coalizioni.
+    I partiti dello schema senza colonna corrispondente vengono ignorati.
+    """
+    per_nome = {}
+    for col in colonne:
+        per_nome.setdefault(_nome_partito(col), col)
+
+    coalizioni = list(schema)
+    partiti = []
+    pesi = []
+    for j, membri in enumerate(schema.values()):
+        if not isinstance(membri, dict):
+            membri = {partito: 1.0 for partito in membri}
+        for partito, peso in membri.items():
+            col = per_nome.get(_nome_partito(partito))
+            if col is None:
+                continue
+            if col not in partiti:
+                partiti.append(col)
+            pesi.append((partiti.index(col), j, float(peso)))
+
+    matrice = np.zeros((len(partiti), len(coalizioni)))
+    for i, j, peso in pesi:
+        matrice[i, j] += peso
+    return {"colonne": partiti, "coalizioni": coalizioni, "matrice": matrice}
+
+
+def colonne_partiti(colonne, schemi=SCHEMI_COALIZIONI):
+    """Colonne che corrispondono a un partito di almeno uno schema"""
+    nomi = {_nome_partito(partito) for schema in schemi.values() for membri in schema.values() for partito in membri}
+    return [col for col in colonne if _nome_partito(col) in nomi]
+
+
+def partiti_coalizione(compilato, coalizione):
+    """Colonne dei partiti che contribuiscono a una coalizione"""
+    if coalizione not in compilato["coalizioni"]:
+        return []
+    j = compilato["coalizioni"].index(coalizione)
+    return [col for col, peso in zip(compilato["colonne"], compilato["matrice"][:, j]) if peso]
+
+
+def applica_scenario(compilato, trasferimenti=None, variazioni=None):
+    """
+    Scenario "what-if" su uno schema compilato, senza toccare i voti:
+    - 'trasferimenti': partito -> {coalizione: quota}, la quota (0-1) dei
+      voti del partito che passa alla coalizione (ad es. {"M5S": {"CSX": 0.3}});
+    - 'variazioni': partito -> variazione relativa dei suoi voti (0.1 = +10%),
+      che cambia anche il totale dei voti validi.
+    Entrambi sono lineari nei conteggi, quindi diventano una nuova matrice
+    dei pesi (più un vettore per i voti validi) e si applicano allo stesso
+    modo ai conteggi delle sezioni e ai totali già aggregati.
+    """
+    matrice = compilato["matrice"].copy()
+    validi = np.zeros(len(compilato["colonne"]))
+    per_nome = {_nome_partito(col): i for i, col in enumerate(compilato["colonne"])}
+
+    for partito, quote in (trasferimenti or {}).items():
+        i = per_nome.get(_nome_partito(partito))
+        if i is None:
+            continue
+        quote = {c: q for c, q in quote.items() if c in compilato["coalizioni"] and q > 0}
+        totale = sum(quote.values())
+        if not totale:
+            continue
+        # Quote che sommano a più di 1 vengono riscalate: si sposta al più
+        # l'intero partito
+        scala = min(totale, 1.0) / totale
+        matrice[i] *= 1.0 - totale * scala
+        for coalizione, quota in quote.items():
+            matrice[i, compilato["coalizioni"].index(coalizione)] += quota * scala
+
+    for partito, variazione in (variazioni or {}).items():
+        i = per_nome.get(_nome_partito(partito))
+        if i is not None:
+            matrice[i] *= 1.0 + variazione
+            validi[i] += variazione
+
+    return dict(compilato, matrice=matrice, variazione_validi=validi)
+
+
+def quote_coalizioni(tabella, compilato, denominatore=None):
+    """
+    Quote di tutte le coalizioni per tutte le unità con un solo prodotto
+    matriciale (unità x partiti) @ (partiti x coalizioni). Con un
+    denominatore (ad es. i voti validi) i conteggi diventano percentuali;
+    senza, le colonne sono già percentuali e vengono solo sommate.
+    Con uno scenario (applica_scenario) il denominatore viene corretto per
+    le variazioni dei voti dei partiti.
+    Restituisce le colonne "<coalizione> %" e 'Diff' (CSX - CDX).
+    """
+    partiti = np.nan_to_num(tabella[compilato["colonne"]].to_numpy(dtype=float))
+    valori = partiti @ compilato["matrice"]
+    variazione = compilato.get("variazione_validi")
+    if variazione is not None and variazione.any():
+        # Senza denominatore le colonne sono percentuali: il totale è 100
+        base = 100.0 if denominatore is None else np.asarray(denominatore, dtype=float)
+        denominatore = base + partiti @ variazione
+    if denominatore is not None:
+        denominatore = np.asarray(denominatore, dtype=float)[:, None]
+        valori = np.divide(valori * 100, denominatore, out=np.full(valori.shape, np.nan), where=denominatore > 0)
+
+    quote = pd.DataFrame(valori, index=tabella.index, columns=[f"{c} %" for c in compilato["coalizioni"]])
+    if 'CSX %' in quote.columns and 'CDX %' in quote.columns:
+        quote['Diff'] = quote['CSX %'] - quote['CDX %']
+    return quote
@@ -0,0 +1,100 @@
+# utils/crosswalk.py
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+import shapely
+
+# Quote di sovrapposizione sotto questa soglia sono considerate errori di
+# digitalizzazione dei bordi (poligoni adiacenti che si toccano appena)
+SOGLIA_SOVRAPPOSIZIONE = 0.01
+
+
+def _geometrie_metriche(gdf):
+    """Geometrie valide in una proiezione metrica (UTM locale)"""
+    metrico = gdf.to_crs(gdf.estimate_utm_crs())
+    return shapely.make_valid(np.asarray(metrico.geometry.values))
+
+
+def matrice_sovrapposizione(gdf_fine, gdf_grossa, soglia=SOGLIA_SOVRAPPOSIZIONE):
+    """
+    Calcola la matrice sparsa (righe di gdf_fine x righe di gdf_grossa) con
+    la quota dell'area di ogni unità fine che ricade in ogni unità grossa.
+    Le coppie candidate vengono trovate con un indice STRtree e le
+    intersezioni calcolate in blocco; le quote sotto 'soglia' sono scartate
+    e ogni riga viene normalizzata a 1 (le unità fuori da tutte le unità
+    grosse restano con riga vuota).
+    """
+    fini = _geometrie_metriche(gdf_fine)
+    grosse = _geometrie_metriche(gdf_grossa.to_crs(gdf_fine.crs))
+
+    albero = shapely.STRtree(grosse)
+    i, j = albero.query(fini, predicate="intersects")
+    aree = shapely.area(shapely.intersection(fini[i], grosse[j]))
+    aree_fini = shapely.area(fini)
+    quote = np.divide(aree, aree_fini[i], out=np.zeros_like(aree), where=aree_fini[i] > 0)
+
+    tenute = quote >= soglia
+    matrice = sp.csr_matrix((quote[tenute], (i[tenute], j[tenute])), shape=(len(fini), len(grosse)))
+    totali = np.asarray(matrice.sum(axis=1)).ravel()
+    scala = np.divide(1.0, totali, out=np.zeros_like(totali), where=totali > 0)
+    return sp.csr_matrix(sp.diags(scala) @ matrice)
+
+
+def appartenenza(matrice):
+    """
+    Unità grossa prevalente (quota maggiore) per ogni unità fine, come
+    posizione nel layer grosso; -1 per le unità senza sovrapposizioni.
+    """
+    prevalente = np.asarray(matrice.argmax(axis=1)).ravel()
+    prevalente[np.diff(matrice.indptr) == 0] = -1
+    return prevalente
+
+
+def _normalizza_chiavi(chiavi):
+    # Chiavi numeriche confrontate come numeri (276 == 276.0), le altre
+    # come testo senza differenze di maiuscole e spazi
+    serie = pd.Series(chiavi).reset_index(drop=True)
+    numeri = pd.to_numeric(serie, errors="coerce")
+    if numeri.notna().sum() == serie.notna().sum():
+        return numeri.astype(float)
+    return serie.astype("string").str.strip().str.upper()
+
+
+def matrice_chiavi(chiavi_righe, chiavi_layer):
+    """
+    Matrice sparsa di assegnazione (righe della tabella x righe del layer)
+    che collega ogni riga della tabella alla feature con la stessa chiave.
+    Le righe senza corrispondenza restano vuote.
+    """
+    righe = _normalizza_chiavi(chiavi_righe)
+    layer = _normalizza_chiavi(chiavi_layer)
+    if righe.dtype != layer.dtype:
+        righe, layer = righe.astype("string").str.upper(), layer.astype("string").str.upper()
+    posizioni = pd.Series(np.arange(len(layer)), index=layer)
+    posizioni = posizioni[posizioni.index.notna() & ~posizioni.index.duplicated()]
+    colonne = righe.map(posizioni)
+    trovate = colonne.notna().to_numpy()
+    return sp.csr_matrix(
+        (np.ones(trovate.sum()), (np.flatnonzero(trovate), colonne[trovate].astype(int).to_numpy())),
+        shape=(len(righe), len(layer)),
+    )
+
+
+def aggrega_somma(matrice, valori):
+    """Somma dei valori (righe x colonne) ripartiti secondo la matrice"""
+    valori = np.nan_to_num(np.asarray(valori, dtype=float))
+    return matrice.T @ valori
+
+
+def aggrega_media(matrice, valori):
+    """
+    Media pesata dei valori (righe x colonne) per ogni unità di destinazione,
+    con pesi dati dalla matrice e ignorando i valori mancanti. Con
+    un'appartenenza netta (pesi 0/1) coincide con groupby().mean().
+    """
+    valori = np.asarray(valori, dtype=float)
+    presenti = ~np.isnan(valori)
+    somme = matrice.T @ np.where(presenti, valori, 0.0)
+    pesi = matrice.T @ presenti.astype(float)
+    return np.divide(somme, pesi, out=np.full(somme.shape, np.nan), where=pesi > 0)
@@ -0,0 +1,514 @@
+# utils/data_cache.py
+
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import geopandas as gpd
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
+import scipy.sparse as sp
+
+# pyogrio è opzionale: con pyogrio i GeoJSON si leggono con il lettore Arrow
+# di GDAL, senza, con il motore predefinito di geopandas
+try:
+    import pyogrio
+except ImportError:
+    pyogrio = None
+
+# Eseguito come script: rende importabile il pacchetto utils
+if __package__ in (None, ""):
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.crosswalk import matrice_sovrapposizione
+from utils.geometrie import PIRAMIDE_TOLLERANZE_M, VERSIONE_PIRAMIDE, semplifica_layer, tolleranza_per_zoom
+from utils.mvt import ZOOM_MAX_TILE, ZOOM_MIN_TILE, scrivi_mbtiles
+from utils.schema_dati import rileva_colonne_id, tipizza_layer, tipizza_tabella
+from utils.topojson import scrivi_topojson
+from utils.tracciamento import span
+
+# Percorsi dei dati sorgente e della cache colonnare
+DATA_DIR = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "data"))
+CACHE_DIR = os.path.join(DATA_DIR, "cache")
+MANIFEST_PATH = os.path.join(CACHE_DIR, "manifest.json")
+
+# Flusso JSONL dei risultati dello scrutinio in diretta (una sezione per riga)
+FEED_SCRUTINIO = os.path.join(DATA_DIR, "scrutinio.jsonl")
+
+# Log delle tracce dei tempi (una riga JSON per esecuzione dello script o di
+# un frammento, vedi utils/tracciamento.py)
+LOG_TRACCE = os.path.join(DATA_DIR, "logs", "tracce.jsonl")
+
+# Archivi MBTiles delle tile vettoriali, letti dal server locale delle tile
+TILE_DIR = os.path.join(CACHE_DIR, "tiles")
+
+# Geometrie servite come file statici da Streamlit (server.enableStaticServing):
+# i file in app/static sono raggiungibili all'URL relativo "app/static/..."
+STATIC_DIR = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "static"))
+GEO_STATIC_DIR = os.path.join(STATIC_DIR, "geo")
+JS_STATIC_DIR = os.path.join(STATIC_DIR, "js")
+
+# Sorgenti gestite dalla cache: nome logico -> (file sorgente, tipo)
+SORGENTI = {
+    "municipi": ("municipi.geojson", "geo"),
+    "sezioni": ("sezioni.geojson", "geo"),
+    "uu": ("unita_urbanistiche.geojson", "geo"),
+    "voti": ("voti_rielaborati.xlsx", "tabella"),
+    # Altre elezioni e tabella di armonizzazione delle sezioni (facoltative,
+    # vedi utils/elezioni.py)
+    "regionali_2020": ("voti_regionali_2020.xlsx", "tabella"),
+    "comunali_2021": ("voti_comunali_2021.xlsx", "tabella"),
+    "europee_2024": ("voti_europee_2024.xlsx", "tabella"),
+    "armonizzazione": ("armonizzazione_sezioni.csv", "tabella"),
+}
+
+# Versione dello schema dei tipi applicato all'ingest (utils/schema_dati.py):
+# fa parte del nome dei file della cache, che vengono rigenerati quando
+# cambia
+VERSIONE_SCHEMA = 1
+
+# Versione del taglio delle tile vettoriali (livello della piramide scelto
+# per ogni zoom): fa parte del nome del tileset, rigenerato quando cambia
+VERSIONE_TILE = 3
+
+# Gerarchia dei layer, dal più fine al più grosso, per il crosswalk spaziale
+GERARCHIA_LAYER = ("sezioni", "uu", "municipi")
+
+# Sorgenti convertite in parallelo (vedi prepara_sorgenti): la lettura dei
+# GeoJSON con GDAL e la scrittura dei file Arrow/Parquet rilasciano il GIL,
+# quella dell'Excel no, quindi bastano pochi thread
+MAX_LETTORI = 4
+
+
+def hash_file(path, dimensione_blocco=1 << 20):
+    """Calcola lo SHA-256 del contenuto di un file leggendolo a blocchi"""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for blocco in iter(lambda: f.read(dimensione_blocco), b""):
+            h.update(blocco)
+    return h.hexdigest()
+
+
+def _leggi_manifest():
+    try:
+        with open(MANIFEST_PATH, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _scrivi_manifest(manifest):
+    # Scrittura atomica: più processi possono fare ingest in parallelo
+    tmp = f"{MANIFEST_PATH}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp, MANIFEST_PATH)
+
+
+def _digest_sorgente(nome, manifest):
+    """
+    Restituisce l'hash del file sorgente. Se dimensione e mtime coincidono
+    con quelli registrati nel manifest, il file non viene riletto.
+    """
+    path = os.path.join(DATA_DIR, SORGENTI[nome][0])
+    stat = os.stat(path)
+    voce = manifest.get(nome, {})
+    if voce.get("size") == stat.st_size and voce.get("mtime_ns") == stat.st_mtime_ns and voce.get("sha256"):
+        return voce["sha256"], stat
+    return hash_file(path), stat
+
+
+def percorso_cache(nome, digest, tolleranza=0):
+    """
+    Percorso del file colonnare corrispondente a una versione della sorgente:
+    GeoParquet per i layer (un file per livello della piramide di
+    semplificazione), Arrow IPC non compresso (mappabile in memoria) per le
+    tabelle.
+    """
+    if SORGENTI[nome][1] != "geo":
+        return os.path.join(CACHE_DIR, f"{nome}-{digest[:16]}-v{VERSIONE_SCHEMA}.arrow")
+    suffisso = f"-s{tolleranza}p{VERSIONE_PIRAMIDE}" if tolleranza else ""
+    return os.path.join(CACHE_DIR, f"{nome}-{digest[:16]}-v{VERSIONE_SCHEMA}{suffisso}.parquet")
+
+
+def _rimuovi_versioni_precedenti(directory, nome, digest, versione=""):
+    """
+    Elimina i file derivati da versioni precedenti della stessa sorgente
+    (o, con 'versione', da versioni precedenti dello schema dei tipi)
+    """
+    for file in os.listdir(directory):
+        if file.startswith(f"{nome}-") and not file.startswith(f"{nome}-{digest[:16]}{versione}"):
+            try:
+                os.remove(os.path.join(directory, file))
+            except OSError:
+                pass
+
+
+def _converti(nome, destinazione):
+    """
+    Converte una sorgente nel file della cache applicando lo schema dei tipi
+    e restituisce le colonne identificative rilevate
+    """
+    file_sorgente, tipo = SORGENTI[nome]
+    path = os.path.join(DATA_DIR, file_sorgente)
+    # Più thread dello stesso processo possono convertire la stessa sorgente
+    tmp = f"{destinazione}.{os.getpid()}.{threading.get_ident()}.tmp"
+    if tipo == "geo":
+        gdf = gpd.read_file(path, engine="pyogrio", use_arrow=True) if pyogrio else gpd.read_file(path)
+        colonne_id = rileva_colonne_id(nome, gdf.columns, tipo)
+        tipizza_layer(gdf, colonne_id).to_parquet(tmp)
+    else:
+        tabella = pd.read_csv(path) if path.endswith(".csv") else pd.read_excel(path)
+        colonne_id = rileva_colonne_id(nome, [str(col) for col in tabella.columns], tipo)
+        feather.write_feather(tipizza_tabella(tabella, colonne_id), tmp, compression="uncompressed")
+    os.replace(tmp, destinazione)
+    return colonne_id
+
+
+def _nomi_colonne(path):
+    if path.endswith(".arrow"):
+        return pa.ipc.open_file(pa.memory_map(path, "r")).schema.names
+    return pq.read_schema(path).names
+
+
+def sorgente_presente(nome):
+    """Indica se il file di una sorgente facoltativa è presente"""
+    return os.path.exists(os.path.join(DATA_DIR, SORGENTI[nome][0]))
+
+
+def _aggiorna_sorgente(nome, manifest):
+    """
+    Converte la sorgente se la cache non corrisponde al suo contenuto e
+    restituisce la voce del manifest, senza scriverla
+    """
+    digest, stat = _digest_sorgente(nome, manifest)
+    destinazione = percorso_cache(nome, digest)
+
+    precedente = manifest.get(nome, {})
+    colonne_id = precedente.get("id") if precedente.get("cache") == os.path.basename(destinazione) else None
+    if not os.path.exists(destinazione):
+        colonne_id = _converti(nome, destinazione)
+        _rimuovi_versioni_precedenti(CACHE_DIR, nome, digest, f"-v{VERSIONE_SCHEMA}")
+    elif colonne_id is None:
+        colonne_id = rileva_colonne_id(nome, _nomi_colonne(destinazione), SORGENTI[nome][1])
+
+    return {
+        "sorgente": SORGENTI[nome][0],
+        "sha256": digest,
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "cache": os.path.basename(destinazione),
+        "id": colonne_id,
+    }
+
+
+def prepara_sorgente(nome):
+    """
+    Garantisce che la cache colonnare di una sorgente sia aggiornata e ne
+    restituisce il percorso. La conversione avviene solo se l'hash del file
+    sorgente è cambiato rispetto all'ultima ingest. Il manifest registra
+    anche le colonne identificative rilevate (vedi colonne_id).
+    """
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    manifest = _leggi_manifest()
+    voce = _aggiorna_sorgente(nome, manifest)
+    if manifest.get(nome) != voce:
+        manifest[nome] = voce
+        _scrivi_manifest(manifest)
+    return os.path.join(CACHE_DIR, voce["cache"])
+
+
+def prepara_sorgenti(nomi):
+    """
+    Come prepara_sorgente per più sorgenti, convertite in parallelo su un
+    pool di thread: a freddo il tempo totale si avvicina a quello della
+    sorgente più lenta invece che alla somma. Un errore in una sorgente non
+    interrompe le altre. Restituisce per ogni sorgente un dizionario con il
+    percorso della cache (None se la sorgente non è stata preparata), la
+    durata in ms e l'eventuale eccezione.
+    """
+    nomi = list(nomi)
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    manifest = _leggi_manifest()
+
+    def prepara(nome):
+        inizio = time.perf_counter()
+        try:
+            voce, errore = _aggiorna_sorgente(nome, manifest), None
+        except Exception as e:
+            voce, errore = None, e
+        return voce, errore, (time.perf_counter() - inizio) * 1000
+
+    with ThreadPoolExecutor(max_workers=max(1, min(len(nomi), MAX_LETTORI))) as pool:
+        risultati = dict(zip(nomi, pool.map(prepara, nomi)))
+
+    # Il manifest viene scritto una sola volta, dal thread chiamante
+    aggiornate = {nome: voce for nome, (voce, _, _) in risultati.items() if voce is not None and manifest.get(nome) != voce}
+    if aggiornate:
+        manifest = _leggi_manifest()
+        manifest.update(aggiornate)
+        _scrivi_manifest(manifest)
+
+    return {
+        nome: {
+            "percorso": None if voce is None else os.path.join(CACHE_DIR, voce["cache"]),
+            "durata_ms": round(durata, 1),
+            "errore": errore,
+        }
+        for nome, (voce, errore, durata) in risultati.items()
+    }
+
+
+def versione_sorgente(nome):
+    """
+    Restituisce l'hash del contenuto della sorgente, da usare come chiave di
+    versione per le cache derivate (aggregati, figure, ...).
+    """
+    prepara_sorgente(nome)
+    return _leggi_manifest()[nome]["sha256"]
+
+
+def colonne_id(nome):
+    """
+    Colonne identificative di una sorgente (livello -> colonna, ad es.
+    {"sezione": "SEZIONE"}), rilevate una sola volta all'ingest e lette dal
+    manifest
+    """
+    prepara_sorgente(nome)
+    return _leggi_manifest()[nome]["id"]
+
+
+def prepara_piramide(nome, tolleranza):
+    """
+    Garantisce che esista il livello della piramide di semplificazione con
+    la tolleranza indicata (in metri) e ne restituisce il percorso. I livelli
+    vengono ricavati dalla geometria a risoluzione piena e condividono con
+    essa l'ordine delle righe.
+    """
+    completo = prepara_sorgente(nome)
+    if not tolleranza:
+        return completo
+    destinazione = percorso_cache(nome, versione_sorgente(nome), tolleranza)
+    if not os.path.exists(destinazione):
+        tmp = f"{destinazione}.{os.getpid()}.tmp"
+        semplifica_layer(gpd.read_parquet(completo), tolleranza).to_parquet(tmp)
+        os.replace(tmp, destinazione)
+    return destinazione
+
+
+def carica_layer(nome, tolleranza=0):
+    """
+    Carica un layer geografico dalla cache GeoParquet, a risoluzione piena
+    o al livello di semplificazione indicato (tolleranza in metri).
+    """
+    with span("lettura_layer", sorgente=nome, tolleranza=tolleranza):
+        return gpd.read_parquet(prepara_piramide(nome, tolleranza))
+
+
+def colonne_layer(nome):
+    """
+    Restituisce i nomi delle colonne di un layer leggendo solo lo schema
+    Parquet, senza caricare le geometrie.
+    """
+    return list(pq.read_schema(prepara_sorgente(nome)).names)
+
+
+def chiavi_layer(nome, colonna):
+    """
+    Legge la sola colonna identificativa di un layer (proiezione Parquet,
+    senza geometrie). L'ordine è quello delle righe del layer, condiviso da
+    tutti i livelli della piramide e dai crosswalk.
+    """
+    with span("lettura_chiavi", sorgente=nome, colonna=colonna):
+        return pq.read_table(prepara_sorgente(nome), columns=[colonna]).to_pandas()[colonna]
+
+
+def carica_tabella(nome):
+    """
+    Carica una sorgente tabellare mappando in memoria il file Arrow della
+    cache. Le colonne numeriche restano viste in sola lettura sul file,
+    condivise da tutti i lettori del processo senza copie. I tipi sono
+    quelli dello schema applicato all'ingest (percentuali float32, chiavi
+    intere, nomi come categorie).
+    """
+    with span("lettura_tabella", sorgente=nome):
+        return leggi_arrow(prepara_sorgente(nome))
+
+
+def leggi_arrow(path):
+    """Legge un file Arrow IPC della cache mappandolo in memoria"""
+    tabella = pa.ipc.open_file(pa.memory_map(path, "r")).read_all()
+    return tabella.to_pandas(split_blocks=True)
+
+
+def carica_voti():
+    """Carica la tabella dei voti (vedi carica_tabella)"""
+    return carica_tabella("voti")
+
+
+def carica_crosswalk(fine, grossa):
+    """
+    Restituisce la matrice sparsa di sovrapposizione tra due layer (quota
+    dell'area di ogni feature di 'fine' che ricade in ogni feature di
+    'grossa'). È calcolata una sola volta per versione delle due geometrie
+    e salvata nella cache.
+    """
+    digest = hashlib.sha256((versione_sorgente(fine) + versione_sorgente(grossa)).encode("utf-8")).hexdigest()
+    nome = f"crosswalk-{fine}-{grossa}"
+    destinazione = os.path.join(CACHE_DIR, f"{nome}-{digest[:16]}.npz")
+
+    if not os.path.exists(destinazione):
+        matrice = matrice_sovrapposizione(carica_layer(fine), carica_layer(grossa))
+        # save_npz aggiunge l'estensione se manca: il file temporaneo la mantiene
+        tmp = f"{destinazione[:-4]}.{os.getpid()}.tmp.npz"
+        sp.save_npz(tmp, matrice)
+        os.replace(tmp, destinazione)
+        _rimuovi_versioni_precedenti(CACHE_DIR, nome, digest)
+
+    return sp.load_npz(destinazione).tocsr()
+
+
+def esporta_geometria(nome, tolleranza=0):
+    """
+    Scrive le sole geometrie di un layer (WGS84, senza attributi) in un file
+    GeoJSON statico e ne restituisce l'URL relativo. Ogni feature ha come
+    'id' la posizione della riga nel layer, stabile per una data versione
+    della sorgente e uguale per tutti i livelli della piramide: il browser
+    scarica la geometria una sola volta e le figure trasportano solo i
+    valori per id.
+    """
+    digest = versione_sorgente(nome)
+    suffisso = f"-s{tolleranza}p{VERSIONE_PIRAMIDE}" if tolleranza else ""
+    nome_file = f"{nome}-{digest[:16]}{suffisso}.json"
+    destinazione = os.path.join(GEO_STATIC_DIR, nome_file)
+
+    if not os.path.exists(destinazione):
+        os.makedirs(GEO_STATIC_DIR, exist_ok=True)
+        gdf = carica_layer(nome, tolleranza)
+        if gdf.crs and str(gdf.crs) != "EPSG:4326":
+            gdf = gdf.to_crs("EPSG:4326")
+        tmp = f"{destinazione}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(gdf.geometry.reset_index(drop=True).to_json())
+        os.replace(tmp, destinazione)
+        _rimuovi_versioni_precedenti(GEO_STATIC_DIR, nome, digest)
+
+    return f"app/static/geo/{nome_file}"
+
+
+def esporta_topojson(nome, tolleranza=0):
+    """
+    Scrive la topologia di un layer (archi condivisi, coordinate quantizzate)
+    in un file statico e ne restituisce l'URL relativo. Gli 'id' delle
+    geometrie coincidono con quelli del GeoJSON statico.
+    """
+    digest = versione_sorgente(nome)
+    suffisso = f"-s{tolleranza}p{VERSIONE_PIRAMIDE}" if tolleranza else ""
+    nome_file = f"{nome}-{digest[:16]}{suffisso}.topo.json"
+    destinazione = os.path.join(GEO_STATIC_DIR, nome_file)
+
+    if not os.path.exists(destinazione):
+        os.makedirs(GEO_STATIC_DIR, exist_ok=True)
+        gdf = carica_layer(nome, tolleranza)
+        if gdf.crs and str(gdf.crs) != "EPSG:4326":
+            gdf = gdf.to_crs("EPSG:4326")
+        tmp = f"{destinazione}.{os.getpid()}.tmp"
+        scrivi_topojson(gdf.reset_index(drop=True), tmp)
+        os.replace(tmp, destinazione)
+        _rimuovi_versioni_precedenti(GEO_STATIC_DIR, nome, digest)
+
+    return f"app/static/geo/{nome_file}"
+
+
+def esporta_mbtiles(nome):
+    """
+    Taglia un layer in tile vettoriali (Mapbox Vector Tile) per i livelli
+    di zoom da ZOOM_MIN_TILE a ZOOM_MAX_TILE e le salva in un archivio
+    MBTiles. A ogni zoom si usa il livello della piramide di
+    semplificazione adatto, così le tile a basso zoom restano leggere.
+    Restituisce il nome del tileset (nome del file senza estensione).
+    """
+    digest = versione_sorgente(nome)
+    tileset = f"{nome}-{digest[:16]}-v{VERSIONE_TILE}"
+    destinazione = os.path.join(TILE_DIR, f"{tileset}.mbtiles")
+
+    if not os.path.exists(destinazione):
+        os.makedirs(TILE_DIR, exist_ok=True)
+        miny, maxy = carica_layer(nome, PIRAMIDE_TOLLERANZE_M[-1]).to_crs("EPSG:4326").total_bounds[1::2]
+        latitudine = (miny + maxy) / 2
+        livelli = {}
+        proiettati = {}
+        for zoom in range(ZOOM_MIN_TILE, ZOOM_MAX_TILE + 1):
+            tolleranza = tolleranza_per_zoom(zoom, latitudine)
+            if tolleranza not in proiettati:
+                proiettati[tolleranza] = carica_layer(nome, tolleranza).reset_index(drop=True).to_crs("EPSG:3857")
+            livelli[zoom] = proiettati[tolleranza]
+        tmp = f"{destinazione}.{os.getpid()}.tmp"
+        scrivi_mbtiles(livelli, tmp, tileset)
+        os.replace(tmp, destinazione)
+        _rimuovi_versioni_precedenti(TILE_DIR, nome, digest, f"-v{VERSIONE_TILE}")
+
+    return tileset
+
+
+def esporta_plotlyjs():
+    """
+    Copia la libreria plotly.js inclusa nel pacchetto plotly tra i file
+    statici (serve al rendering TopoJSON, che disegna la mappa nel browser
+    senza accesso a CDN) e ne restituisce l'URL relativo.
+    """
+    import plotly
+    from plotly.offline import get_plotlyjs
+
+    nome_file = f"plotly-{plotly.__version__}.min.js"
+    destinazione = os.path.join(JS_STATIC_DIR, nome_file)
+    if not os.path.exists(destinazione):
+        os.makedirs(JS_STATIC_DIR, exist_ok=True)
+        tmp = f"{destinazione}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(get_plotlyjs())
+        os.replace(tmp, destinazione)
+    return f"app/static/js/{nome_file}"
+
+
+def ingest():
+    """
+    Converte tutte le sorgenti nella cache colonnare (in parallelo, vedi
+    prepara_sorgenti), costruisce la piramide di semplificazione dei layer,
+    esporta le geometrie statiche (GeoJSON e TopoJSON), taglia i layer in
+    tile vettoriali e calcola il crosswalk spaziale tra i livelli della
+    gerarchia. I passi che dipendono da una sorgente non preparata vengono
+    saltati; restituisce l'esito di ogni sorgente.
+    """
+    esiti = prepara_sorgenti(nome for nome in SORGENTI if sorgente_presente(nome))
+    pronte = {nome for nome, esito in esiti.items() if esito["errore"] is None}
+    for nome, (_, tipo) in SORGENTI.items():
+        if tipo == "geo" and nome in pronte:
+            for tolleranza in PIRAMIDE_TOLLERANZE_M:
+                prepara_piramide(nome, tolleranza)
+                esporta_geometria(nome, tolleranza)
+                esporta_topojson(nome, tolleranza)
+            esporta_mbtiles(nome)
+    for i, fine in enumerate(GERARCHIA_LAYER):
+        for grossa in GERARCHIA_LAYER[i + 1:]:
+            if fine in pronte and grossa in pronte:
+                carica_crosswalk(fine, grossa)
+    esporta_plotlyjs()
+    return esiti
+
+
+if __name__ == "__main__":
+    # Uso: python app/utils/data_cache.py
+    esiti = ingest()
+    for nome, esito in esiti.items():
+        if esito["errore"] is None:
+            print(f"{nome}: {os.path.relpath(esito['percorso'], DATA_DIR)} ({esito['durata_ms']:.0f} ms)")
+        else:
+            print(f"{nome}: ERRORE {esito['errore']!r} ({esito['durata_ms']:.0f} ms)")
+    sys.exit(1 if any(esito["errore"] is not None for esito in esiti.values()) else 0)
@@ -0,0 +1,141 @@
+# utils/elezioni.py
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+from utils.coalizioni import compila_schema, quote_coalizioni
+from utils.crosswalk import matrice_chiavi
+from utils.rollup import COLONNA_VOTI_VALIDI, colonne_conteggio
+
+# Elezioni disponibili: nome mostrato -> sorgente della cache (vedi
+# SORGENTI in utils/data_cache.py). Le elezioni senza file vengono ignorate.
+ELEZIONI = {
+    "Regionali 2024": "voti",
+    "Regionali 2020": "regionali_2020",
+    "Comunali 2021": "comunali_2021",
+    "Europee 2024": "europee_2024",
+}
+
+# Tabella di armonizzazione delle sezioni rinumerate o accorpate: per ogni
+# elezione, la sezione originale e la sezione di riferimento in cui
+# confluisce (con la quota dei voti, 1 se la colonna manca). Le sezioni non
+# elencate mantengono il proprio numero.
+COLONNA_ELEZIONE = "ELEZIONE"
+COLONNA_ORIGINALE = "SEZIONE_ORIGINALE"
+COLONNA_RIFERIMENTO = "SEZIONE"
+COLONNA_QUOTA = "QUOTA"
+
+# Separatore tra elezione e colonna nei nomi delle colonne dell'archivio
+SEPARATORE = " | "
+
+
+def colonna_elezione(elezione, colonna):
+    return f"{elezione}{SEPARATORE}{colonna}"
+
+
+def matrice_armonizzazione(chiavi, chiavi_comuni, righe=None):
+    """
+    Matrice sparsa (sezioni di un'elezione x sezioni comuni) che riporta
+    ogni sezione alla numerazione di riferimento. 'righe' è la parte della
+    tabella di armonizzazione relativa all'elezione (None = nessuna
+    rinumerazione); le quote di una sezione divisa tra più sezioni di
+    riferimento vengono normalizzate a 1.
+    """
+    matrice = matrice_chiavi(chiavi, chiavi_comuni)
+    if righe is not None and len(righe):
+        quote = righe[COLONNA_QUOTA] if COLONNA_QUOTA in righe.columns else pd.Series(1.0, index=righe.index)
+        origine = matrice_chiavi(righe[COLONNA_ORIGINALE], chiavi)
+        destinazione = matrice_chiavi(righe[COLONNA_RIFERIMENTO], chiavi_comuni)
+        # Le sezioni elencate perdono la corrispondenza per numero e
+        # prendono quella della tabella
+        rinumerate = np.zeros(len(chiavi))
+        rinumerate[origine.indices] = 1.0
+        matrice = sp.diags(1.0 - rinumerate) @ matrice + origine.T @ sp.diags(quote.to_numpy(dtype=float)) @ destinazione
+    matrice = sp.csr_matrix(matrice)
+    totali = np.asarray(matrice.sum(axis=1)).ravel()
+    scala = np.divide(1.0, totali, out=np.zeros_like(totali), where=totali > 0)
+    return sp.csr_matrix(sp.diags(scala) @ matrice)
+
+
+def costruisci_archivio(tabelle, chiave, armonizzazione=None, escluse=()):
+    """
+    Unisce più elezioni ('tabelle': elezione -> tabella dei voti per sezione)
+    in un'unica tabella colonnare indicizzata dalla sezione di riferimento,
+    con colonne "<elezione> | <colonna>" per i conteggi assoluti di ogni
+    elezione. Le sezioni rinumerate vengono riportate alla numerazione di
+    riferimento con la tabella di armonizzazione; le sezioni assenti in
+    un'elezione hanno conteggi mancanti (NaN), non zero. Le colonne
+    'escluse' (ad es. codici territoriali numerici) non sono conteggi.
+    """
+    def righe_elezione(elezione):
+        if armonizzazione is None:
+            return armonizzazione
+        return armonizzazione[armonizzazione[COLONNA_ELEZIONE] == elezione]
+
+    # Sezioni di riferimento: quelle di ogni elezione non rinumerate più
+    # quelle di destinazione della tabella di armonizzazione
+    sezioni = []
+    for elezione, tabella in tabelle.items():
+        righe = righe_elezione(elezione)
+        if righe is None:
+            sezioni.append(tabella[chiave])
+            continue
+        rinumerate = matrice_chiavi(tabella[chiave], righe[COLONNA_ORIGINALE]).getnnz(axis=1) > 0
+        sezioni.extend([tabella[chiave][~rinumerate], righe[COLONNA_RIFERIMENTO]])
+    comuni = pd.concat(sezioni).dropna()
+    comuni = pd.Index(comuni.drop_duplicates().sort_values().to_numpy(), name=chiave)
+
+    blocchi = []
+    for elezione, tabella in tabelle.items():
+        colonne = colonne_conteggio(tabella, (chiave, *escluse))
+        conteggi = tabella[colonne].groupby(tabella[chiave].to_numpy()).sum()
+        righe = righe_elezione(elezione)
+        matrice = matrice_armonizzazione(conteggi.index, comuni, righe)
+        valori = matrice.T @ np.nan_to_num(conteggi.to_numpy(dtype=float))
+        presenti = np.asarray(matrice.sum(axis=0)).ravel() > 0
+        valori[~presenti] = np.nan
+        blocchi.append(pd.DataFrame(valori, index=comuni, columns=[colonna_elezione(elezione, col) for col in colonne]))
+    return pd.concat(blocchi, axis=1)
+
+
+def elezioni_archivio(archivio):
+    """Elezioni presenti nell'archivio, nell'ordine delle colonne"""
+    return list(dict.fromkeys(col.split(SEPARATORE, 1)[0] for col in archivio.columns))
+
+
+def tabella_elezione(archivio, elezione):
+    """Conteggi di una sola elezione, con i nomi di colonna originali"""
+    prefisso = f"{elezione}{SEPARATORE}"
+    colonne = [col for col in archivio.columns if col.startswith(prefisso)]
+    return archivio[colonne].rename(columns=lambda col: col[len(prefisso):])
+
+
+def percentuali_elezione(totali, elezione, schema, partiti=()):
+    """
+    Quote delle coalizioni dello schema e percentuali dei partiti indicati
+    (ad es. "PD %") per un'elezione, da una tabella di totali con le
+    colonne dell'archivio (anche già aggregata su un livello superiore).
+    """
+    conteggi = tabella_elezione(totali, elezione)
+    validi = conteggi[COLONNA_VOTI_VALIDI]
+    risultato = quote_coalizioni(conteggi, compila_schema(schema, list(conteggi.columns)), validi)
+    validi = validi.where(validi > 0)
+    for col in partiti:
+        nome = col.replace("%", "").strip()
+        conteggio = next((c for c in conteggi.columns if c.strip() == nome), None)
+        if conteggio is not None:
+            risultato[col] = conteggi[conteggio] / validi * 100
+    return risultato
+
+
+def confronta_elezioni(totali, da, a, schema, partiti=()):
+    """
+    Variazione (in punti percentuali) tra l'elezione 'da' e l'elezione 'a'
+    per ogni unità: quote delle coalizioni, 'Diff' e percentuali dei partiti
+    presenti in entrambe. Calcolata sugli array già allineati, senza join.
+    """
+    prima = percentuali_elezione(totali, da, schema, partiti)
+    dopo = percentuali_elezione(totali, a, schema, partiti)
+    comuni = [col for col in dopo.columns if col in prima.columns]
+    return dopo[comuni] - prima[comuni]
@@ -0,0 +1,331 @@
+# utils/esportazione.py
+
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import re
+import sys
+import time
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+import plotly
+from plotly.offline import get_plotlyjs
+
+# kaleido è opzionale: serve solo per i formati statici (PNG, SVG)
+try:
+    import kaleido
+except ImportError:
+    kaleido = None
+
+# Eseguito come script: rende importabile il pacchetto utils
+if __package__ in (None, ""):
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.aggregazioni import aggiungi_quote_coalizioni, colonne_base_coalizioni, costruisci_indice
+from utils.chart_utils import grafico_barre_partiti, grafico_torta_csx
+from utils.coalizioni import SCHEMA_PREDEFINITO, SCHEMI_COALIZIONI, colonne_partiti, compila_schema, partiti_coalizione
+from utils.data_cache import DATA_DIR, carica_crosswalk, carica_layer, carica_voti, colonne_id, versione_sorgente
+from utils.map_utils import BACKEND_GEO, BACKEND_MAP, crea_mappa_plotly
+from utils.rollup import colonne_conteggio, rollup_spaziale, rollup_tabella, tabella_livello
+
+# Cartella predefinita delle esportazioni e file che registra, per ogni
+# file esportato, l'impronta dei dati e delle opzioni da cui è stato
+# generato
+USCITA_PREDEFINITA = os.path.join(DATA_DIR, "esportazioni")
+MANIFEST_ESPORTAZIONE = "esportazione.json"
+
+# Libreria plotly.js condivisa dalle pagine HTML esportate (con il numero di
+# versione nel nome: le pagine di versioni diverse non si mescolano)
+PLOTLYJS = f"plotly-{plotly.__version__}.min.js"
+
+FORMATI = ("html", "png", "svg")
+FORMATI_STATICI = ("png", "svg")
+
+# Layer -> livello territoriale (chiave di colonne_id), dal più grosso al
+# più fine
+LIVELLI = {"municipi": "municipio", "uu": "uu", "sezioni": "sezione"}
+
+# Moduli che disegnano le figure: se cambiano, le esportazioni vanno rifatte
+MODULI_FIGURE = ("chart_utils.py", "map_utils.py")
+
+# Dati condivisi dai processi del pool: preparati una sola volta nel
+# processo principale ed ereditati dai figli (fork) senza rileggerli; con
+# l'avvio "spawn" ogni processo li prepara dalla cache colonnare
+_contesto = None
+
+
+def carica_contesto(schema=SCHEMA_PREDEFINITO):
+    """
+    Prepara tutto ciò che serve a disegnare mappe e grafici, come la
+    dashboard: voti con le quote delle coalizioni dello schema, totali per
+    i grafici (rollup lungo le colonne territoriali del file voti, con gli
+    indici per unità) e totali per la mappa (rollup spaziale sulle chiavi
+    dei layer)
+    """
+    voti = carica_voti()
+    voti = aggiungi_quote_coalizioni(voti, compila_schema(SCHEMI_COALIZIONI[schema], colonne_base_coalizioni(voti)))
+    partiti_cols = colonne_partiti([col for col in voti.columns if "%" in col])
+
+    id_voti = colonne_id("voti")
+    colonne_voti = {
+        "sezioni": id_voti.get("sezione", "SEZIONE"),
+        "uu": id_voti.get("uu", "UNITA_URBANISTICA"),
+        "municipi": id_voti.get("municipio", "Municipio"),
+    }
+    gerarchia = tuple(colonne_voti.values())
+    rollup = rollup_tabella(voti, gerarchia[0], list(gerarchia[1:]), colonne_conteggio(voti, gerarchia))
+    coalizioni = compila_schema(SCHEMI_COALIZIONI[schema], rollup["colonne"])
+    grafici = {nome: tabella_livello(rollup, col, partiti_cols, coalizioni) for nome, col in colonne_voti.items()}
+
+    layer = {nome: carica_layer(nome) for nome in LIVELLI}
+    colonne_layer = {nome: colonne_id(nome)[livello] for nome, livello in LIVELLI.items()}
+    chiavi = {nome: layer[nome][colonne_layer[nome]] for nome in LIVELLI}
+    spaziale = rollup_spaziale(
+        voti, colonne_voti["sezioni"], colonne_conteggio(voti, (colonne_voti["sezioni"], colonne_voti["municipi"])),
+        ("sezioni", chiavi["sezioni"]),
+        [("uu", chiavi["uu"], carica_crosswalk("sezioni", "uu")), ("municipi", chiavi["municipi"], carica_crosswalk("uu", "municipi"))],
+    )
+    coalizioni_spaziale = compila_schema(SCHEMI_COALIZIONI[schema], spaziale["colonne"])
+
+    return {
+        "schema": schema,
+        "voti": voti,
+        "partiti_cols": partiti_cols,
+        "partiti_csx": partiti_coalizione(compila_schema(SCHEMI_COALIZIONI[schema], partiti_cols), "CSX"),
+        "colonne_voti": colonne_voti,
+        "grafici": grafici,
+        "indici": {nome: costruisci_indice(tabella) for nome, tabella in grafici.items()},
+        "layer": layer,
+        "colonne_layer": colonne_layer,
+        "mappe": {
+            nome: tabella_livello(spaziale, nome, partiti_cols, coalizioni_spaziale).rename_axis(colonne_layer[nome])
+            for nome in LIVELLI
+        },
+        "versioni_layer": {nome: versione_sorgente(nome) for nome in LIVELLI},
+    }
+
+
+def _nome_file(valore):
+    # Chiavi delle unità (numeri, nomi con spazi o apostrofi) come nomi di file
+    return re.sub(r"[^\w.-]+", "_", str(valore)).strip("_") or "_"
+
+
+def _impronta(*parti):
+    h = hashlib.sha256()
+    for parte in parti:
+        h.update(parte if isinstance(parte, bytes) else str(parte).encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def impronta_codice():
+    """Versione di plotly e contenuto dei moduli che disegnano le figure"""
+    cartella = os.path.dirname(os.path.abspath(__file__))
+    contenuti = []
+    for modulo in MODULI_FIGURE:
+        with open(os.path.join(cartella, modulo), "rb") as f:
+            contenuti.append(f.read())
+    return _impronta(plotly.__version__, *contenuti)
+
+
+def compiti(contesto, livelli, formati, opzioni):
+    """
+    Elenco dei file da esportare: per ogni livello la mappa e, per ogni
+    unità, i grafici a torta e a barre. Ogni compito ha l'impronta dei
+    soli dati da cui dipende (la tabella del livello per la mappa, la riga
+    dell'unità per i grafici), delle opzioni e del codice: un file è
+    rifatto solo se uno di questi cambia.
+    """
+    codice = impronta_codice()
+    elenco = []
+    for nome in livelli:
+        mappa = contesto["mappe"][nome]
+        impronta_mappa = _impronta(
+            codice, "mappa", opzioni["motore"], opzioni["colore"], opzioni["opacita"],
+            contesto["versioni_layer"][nome], pd.util.hash_pandas_object(mappa).to_numpy().tobytes(),
+            list(mappa.columns),
+        )
+        for formato in formati:
+            elenco.append(("mappa", nome, None, os.path.join(nome, f"mappa.{formato}"), impronta_mappa))
+
+        indice = contesto["indici"][nome]
+        colonne = list(indice["colonne"])
+        for valore, pos in indice["posizioni"].items():
+            if pd.isna(valore):
+                continue
+            riga = indice["valori"][pos].tobytes()
+            for grafico, partiti in (("torta", contesto["partiti_csx"]), ("barre", None)):
+                impronta = _impronta(codice, grafico, valore, colonne, partiti, riga)
+                for formato in formati:
+                    percorso = os.path.join(nome, grafico, f"{_nome_file(valore)}.{formato}")
+                    elenco.append((grafico, nome, valore, percorso, impronta))
+    return elenco
+
+
+def figura(contesto, tipo, nome, valore, opzioni):
+    """La figura di un compito, costruita con le funzioni della dashboard"""
+    if tipo == "mappa":
+        colonna_id = contesto["colonne_layer"][nome]
+        return crea_mappa_plotly(
+            contesto["layer"][nome], colonna_id, opzioni["colore"], opzioni["opacita"], contesto["voti"],
+            colonna_id, contesto["partiti_cols"], contesto["mappe"][nome], opzioni["motore"],
+        )
+    livello = contesto["colonne_voti"][nome]
+    indice = contesto["indici"][nome]
+    if tipo == "torta":
+        return grafico_torta_csx(contesto["voti"], livello, valore, indice, contesto["partiti_csx"])
+    return grafico_barre_partiti(contesto["voti"], livello, valore, indice)
+
+
+def scrivi_figura(fig, path, opzioni, plotlyjs=None):
+    """
+    Scrive la figura nel formato indicato dall'estensione. Le pagine HTML
+    caricano plotly.js dal percorso 'plotlyjs' (relativo alla pagina), una
+    sola copia per tutta l'esportazione.
+    """
+    tmp = f"{path}.{os.getpid()}.tmp"
+    if path.endswith(".html"):
+        fig.write_html(tmp, include_plotlyjs=plotlyjs or "cdn", full_html=True)
+    else:
+        fig.write_image(tmp, format=os.path.splitext(path)[1][1:], scale=opzioni["scala"])
+    os.replace(tmp, path)
+
+
+def _inizializza(schema):
+    global _contesto
+    if _contesto is None:
+        warnings.filterwarnings("ignore")
+        _contesto = carica_contesto(schema)
+
+
+def _esegui(argomenti):
+    # Eseguito nei processi del pool: restituisce il percorso relativo, la
+    # durata in ms e l'eventuale errore, senza interrompere gli altri file
+    (tipo, nome, valore, relativo, _), uscita, opzioni = argomenti
+    inizio = time.perf_counter()
+    try:
+        fig = figura(_contesto, tipo, nome, valore, opzioni)
+        if fig is None:
+            return relativo, 0.0, "nessun dato per l'unità"
+        path = os.path.join(uscita, relativo)
+        plotlyjs = os.path.relpath(os.path.join(uscita, PLOTLYJS), os.path.dirname(path)).replace(os.sep, "/")
+        scrivi_figura(fig, path, opzioni, plotlyjs)
+        return relativo, (time.perf_counter() - inizio) * 1000, None
+    except Exception as e:
+        return relativo, (time.perf_counter() - inizio) * 1000, repr(e)
+
+
+def _leggi_manifest(uscita):
+    try:
+        with open(os.path.join(uscita, MANIFEST_ESPORTAZIONE), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _scrivi_manifest(uscita, manifest):
+    path = os.path.join(uscita, MANIFEST_ESPORTAZIONE)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp, path)
+
+
+def esporta(uscita, livelli=tuple(LIVELLI), formati=("html",), schema=SCHEMA_PREDEFINITO, processi=None,
+            forza=False, motore=BACKEND_GEO, colore="#2563eb", opacita=0.6, scala=2):
+    """
+    Esporta mappe e grafici di tutti i livelli e di tutte le unità nella
+    cartella 'uscita' (un file per formato), in parallelo su un pool di
+    processi. I dati vengono preparati una sola volta e condivisi con i
+    processi; i file il cui contenuto non cambierebbe (stessa impronta di
+    dati, opzioni e codice nel manifest dell'esportazione) non vengono
+    rifatti, salvo con 'forza'. Restituisce il riepilogo: file scritti,
+    saltati ed errori (percorso -> messaggio).
+    """
+    global _contesto
+    if kaleido is None and any(formato in FORMATI_STATICI for formato in formati):
+        raise RuntimeError("I formati PNG e SVG richiedono il pacchetto kaleido (pip install kaleido)")
+
+    _contesto = carica_contesto(schema)
+    opzioni = {"motore": motore, "colore": colore, "opacita": opacita, "scala": scala}
+    manifest = _leggi_manifest(uscita)
+    elenco = compiti(_contesto, livelli, formati, opzioni)
+    da_fare = [
+        compito for compito in elenco
+        if forza or manifest.get(compito[3]) != compito[4] or not os.path.exists(os.path.join(uscita, compito[3]))
+    ]
+
+    for cartella in {os.path.dirname(compito[3]) for compito in da_fare}:
+        os.makedirs(os.path.join(uscita, cartella), exist_ok=True)
+    bundle = os.path.join(uscita, PLOTLYJS)
+    if "html" in formati and not os.path.exists(bundle):
+        with open(bundle, "w", encoding="utf-8") as f:
+            f.write(get_plotlyjs())
+
+    # Con fork i processi ereditano i dati già preparati; altrove li
+    # preparano dalla cache colonnare (file Arrow mappato in memoria)
+    metodo = "fork" if "fork" in multiprocessing.get_all_start_methods() else None
+    impronte = {compito[3]: compito[4] for compito in da_fare}
+    errori = {}
+    try:
+        with ProcessPoolExecutor(
+            max_workers=processi, mp_context=multiprocessing.get_context(metodo),
+            initializer=_inizializza, initargs=(schema,),
+        ) as pool:
+            argomenti = [(compito, uscita, opzioni) for compito in da_fare]
+            for relativo, _, errore in pool.map(_esegui, argomenti, chunksize=8):
+                if errore is None:
+                    manifest[relativo] = impronte[relativo]
+                else:
+                    errori[relativo] = errore
+                    manifest.pop(relativo, None)
+    finally:
+        # Anche se interrotta, l'esportazione successiva riparte dai file
+        # già scritti
+        os.makedirs(uscita, exist_ok=True)
+        _scrivi_manifest(uscita, manifest)
+
+    return {"totale": len(elenco), "scritti": len(da_fare) - len(errori), "saltati": len(elenco) - len(da_fare), "errori": errori}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Esporta mappe e grafici di tutti i livelli e di tutte le unità")
+    parser.add_argument("--uscita", default=USCITA_PREDEFINITA, help="cartella delle esportazioni")
+    parser.add_argument("--livelli", nargs="+", choices=list(LIVELLI), default=list(LIVELLI))
+    parser.add_argument("--formati", nargs="+", choices=FORMATI, default=["html"])
+    parser.add_argument("--schema", choices=list(SCHEMI_COALIZIONI), default=SCHEMA_PREDEFINITO, help="raggruppamento coalizioni")
+    parser.add_argument("--processi", type=int, default=None, help="processi del pool (predefinito: uno per core)")
+    parser.add_argument("--motore", choices=[BACKEND_GEO, BACKEND_MAP], default=BACKEND_GEO, help="motore della mappa")
+    parser.add_argument("--colore", default="#2563eb", help="colore delle aree senza dati")
+    parser.add_argument("--opacita", type=float, default=0.6)
+    parser.add_argument("--scala", type=float, default=2, help="fattore di scala delle immagini PNG")
+    parser.add_argument("--forza", action="store_true", help="rifà anche i file invariati")
+    args = parser.parse_args()
+
+    warnings.filterwarnings("ignore")
+    inizio = time.perf_counter()
+    try:
+        riepilogo = esporta(
+            args.uscita, args.livelli, args.formati, args.schema, args.processi,
+            args.forza, args.motore, args.colore, args.opacita, args.scala,
+        )
+    except RuntimeError as e:
+        parser.error(str(e))
+
+    for relativo, errore in sorted(riepilogo["errori"].items()):
+        print(f"{relativo}: {errore}")
+    print(
+        f"{riepilogo['scritti']} file scritti, {riepilogo['saltati']} invariati, {len(riepilogo['errori'])} errori "
+        f"su {riepilogo['totale']} in {time.perf_counter() - inizio:.1f} s ({os.path.relpath(args.uscita)})"
+    )
+    return 1 if riepilogo["errori"] else 0
+
+
+if __name__ == "__main__":
+    # Uso: python app/utils/esportazione.py [--formati html png svg]
+    #          [--livelli municipi uu sezioni] [--processi N] [--forza]
+    sys.exit(main())
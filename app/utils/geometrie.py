@@ -0,0 +1,95 @@
+# utils/geometrie.py
+
+import math
+
+import numpy as np
+import shapely
+
+# Piramide di semplificazione: tolleranze in metri (0 = risoluzione piena)
+PIRAMIDE_TOLLERANZE_M = (0, 10, 30, 100)
+
+# Dimensione di un pixel a zoom 0 all'equatore (web mercator). Lo zoom di
+# Plotly (MapLibre) e di pydeck si riferisce a tile da 512 px: il mondo a
+# zoom 0 è largo 512 px, non 256 come nelle tile raster classiche
+METRI_PER_PIXEL_Z0 = 78271.51696
+
+# Versione dell'algoritmo di semplificazione: fa parte del nome dei
+# livelli della piramide (e dei file derivati), rigenerati quando cambia
+VERSIONE_PIRAMIDE = 2
+
+# Un layer che non è una copertura valida viene riparato (vertici vicini
+# agganciati, sovrapposizioni assegnate a un solo poligono) solo se le
+# sovrapposizioni sono scarti di digitalizzazione: al massimo questa quota
+# dell'area totale. Oltre, i poligoni si sovrappongono davvero (ad es. le
+# sezioni, con ogni area coperta due volte) e vengono semplificati uno
+# per uno.
+MAX_SOVRAPPOSIZIONE_COPERTURA = 0.01
+AGGANCIO_COPERTURA_M = 1.0
+
+
+def ripara_copertura(geometrie):
+    """
+    Restituisce le geometrie (in metri) come copertura valida, con i bordi
+    condivisi identici e senza sovrapposizioni, oppure None se non lo sono
+    e non si possono riparare senza cambiarle in modo visibile.
+    """
+    geometrie = np.asarray(geometrie)
+    if shapely.coverage_is_valid(geometrie):
+        return geometrie
+    # coverage_clean richiede shapely >= 2.2 (GEOS >= 3.14)
+    if not hasattr(shapely, "coverage_clean"):
+        return None
+    valide = shapely.make_valid(geometrie)
+    area = shapely.area(valide).sum()
+    if not area or area - shapely.area(shapely.union_all(valide)) > MAX_SOVRAPPOSIZIONE_COPERTURA * area:
+        return None
+    try:
+        riparate = shapely.coverage_clean(valide, snapping_distance=AGGANCIO_COPERTURA_M)
+    except shapely.errors.GEOSException:
+        return None
+    if shapely.is_empty(riparate).any() or not shapely.coverage_is_valid(riparate):
+        return None
+    return riparate
+
+
+def semplifica_layer(gdf, tolleranza_m):
+    """
+    Semplifica le geometrie di un layer con una tolleranza in metri,
+    lavorando nella proiezione UTM locale. Se il layer è una copertura
+    (poligoni adiacenti senza sovrapposizioni, eventualmente dopo
+    ripara_copertura) i bordi condivisi vengono semplificati una sola volta
+    e restano coincidenti; altrimenti ogni poligono viene semplificato
+    preservandone la topologia.
+    L'ordine delle righe non cambia.
+    """
+    if tolleranza_m <= 0:
+        return gdf
+
+    crs_originale = gdf.crs
+    metrico = gdf.to_crs(gdf.estimate_utm_crs())
+    geometrie = metrico.geometry.values
+
+    # coverage_simplify richiede shapely >= 2.1 (GEOS >= 3.12)
+    copertura = ripara_copertura(geometrie) if hasattr(shapely, "coverage_simplify") else None
+    if copertura is not None:
+        semplificate = shapely.coverage_simplify(copertura, tolleranza_m)
+    else:
+        semplificate = shapely.simplify(geometrie, tolleranza_m, preserve_topology=True)
+
+    metrico = metrico.set_geometry(semplificate, crs=metrico.crs)
+    return metrico.to_crs(crs_originale)
+
+
+def metri_per_pixel(zoom, latitudine):
+    """Metri rappresentati da un pixel a un dato zoom e latitudine"""
+    return METRI_PER_PIXEL_Z0 * math.cos(math.radians(latitudine)) / (2 ** zoom)
+
+
+def tolleranza_per_zoom(zoom, latitudine):
+    """
+    Sceglie il livello della piramide più semplificato il cui errore resta
+    sotto la dimensione di un pixel: la semplificazione è invisibile e la
+    risoluzione piena si usa solo agli zoom più alti.
+    """
+    soglia = metri_per_pixel(zoom, latitudine)
+    return max(t for t in PIRAMIDE_TOLLERANZE_M if t <= soglia)
@@ -1,8 +1,68 @@
 # utils/map_utils.py
 
-import plotly.express as px
+import copy
+import json
+import math
+import re
+from string import Template
+
+import numpy as np
 import pandas as pd
+import plotly.express as px
 import plotly.graph_objects as go
+from shapely.geometry import mapping
+
+from utils.mvt import ZOOM_MAX_TILE, ZOOM_MIN_TILE
+from utils.rollup import colonne_conteggio, rollup_tabella, tabella_livello
+from utils.topojson import NOME_OGGETTO
+from utils.tracciamento import registra_errore, span
+
+# pydeck è opzionale: senza, il motore "deck" non è disponibile
+try:
+    import pydeck as pdk
+except ImportError:
+    pdk = None
+
+# Motori di rendering della mappa
+BACKEND_GEO = "geo"    # SVG con proiezione geografica (px.choropleth)
+BACKEND_MAP = "map"    # WebGL a tile (MapLibre) con stile offline
+BACKEND_DECK = "deck"  # WebGL con deck.gl tramite pydeck
+BACKEND_TOPO = "topo"  # WebGL (MapLibre) con geometria TopoJSON decodificata nel browser
+BACKEND_MVT = "mvt"    # WebGL con deck.gl e tile vettoriali dal server locale
+BACKENDS = (BACKEND_GEO, BACKEND_MAP, BACKEND_DECK, BACKEND_TOPO, BACKEND_MVT)
+
+# Oltre questo numero di poligoni il rendering SVG rende lenti pan e hover
+SOGLIA_WEBGL = 300
+
+# Oltre questo numero di poligoni (ad es. tutte le sezioni della regione)
+# la geometria non può più viaggiare intera: si usano le tile vettoriali
+SOGLIA_TILE = 5000
+
+# Stile MapLibre senza tile esterne: funziona anche offline
+STILE_MAP_OFFLINE = "white-bg"
+
+# Id del layer pydeck (le selezioni di Streamlit sono indicizzate per layer)
+# e colore dell'area evidenziata
+ID_LAYER_DECK = "unita"
+COLORE_EVIDENZIATA = [255, 200, 0, 220]
+
+# Scala divergente per la differenza CSX-CDX
+SCALA_DIFF = [
+    [0, "rgb(0, 0, 255)"],       # Blu forte per CDX molto avanti
+    [0.4, "rgb(180, 180, 255)"], # Blu chiaro per CDX poco avanti
+    [0.5, "rgb(255, 255, 255)"], # Bianco per parità
+    [0.6, "rgb(255, 180, 180)"], # Rosso chiaro per CSX poco avanti
+    [1, "rgb(255, 0, 0)"]        # Rosso forte per CSX molto avanti
+]
+_SCALA_DIFF_RGB = np.array([
+    [0, 0, 255], [180, 180, 255], [255, 255, 255], [255, 180, 180], [255, 0, 0]
+], dtype=float)
+_SCALA_DIFF_POS = np.array([0, 0.4, 0.5, 0.6, 1])
+
+def dimensione_payload(fig):
+    """Byte del JSON della figura inviato al browser"""
+    # La specifica TopoJSON è un dizionario, le altre figure hanno to_json()
+    return len(json.dumps(fig)) if isinstance(fig, dict) else len(fig.to_json())
 
 def formatta_percentuale(valore):
     """Formatta un valore numerico come percentuale con 1 decimale"""
@@ -10,146 +70,649 @@ def formatta_percentuale(valore):
         return "N/A"
     return f"{valore:.1f}%"
 
-def crea_mappa_plotly(gdf, colonna_id, colore, opacita, df_voti=None, join_col=None, partiti_cols=None):
+def scegli_backend(n_poligoni, backend=None, tile=False):
+    """
+    Restituisce il motore di rendering da usare: quello richiesto se
+    disponibile, altrimenti SVG sotto SOGLIA_WEBGL poligoni, WebGL sopra e
+    tile vettoriali oltre SOGLIA_TILE. Le tile vettoriali si usano solo se
+    il browser raggiunge il server delle tile ('tile'): altrimenti pydeck.
+    """
+    if backend is None and n_poligoni > SOGLIA_TILE:
+        backend = BACKEND_MVT
+    if backend == BACKEND_MVT and not tile:
+        backend = BACKEND_DECK
+    if backend in (BACKEND_DECK, BACKEND_MVT) and pdk is None:
+        backend = BACKEND_MAP
+    if backend in BACKENDS:
+        return backend
+    return BACKEND_MAP if n_poligoni > SOGLIA_WEBGL else BACKEND_GEO
+
+def crea_mappa_plotly(gdf, colonna_id, colore, opacita, df_voti=None, join_col=None, partiti_cols=None, aggregati=None, backend=None):
     """
-    Crea una mappa Plotly con i dati GeoJSON e informazioni sui voti.
+    Crea una mappa con i dati GeoJSON e informazioni sui voti.
+    Se 'aggregati' (tabella precalcolata indicizzata per join_col) è fornito,
+    i voti non vengono riaggregati. 'backend' sceglie il motore di rendering
+    (None = automatico in base al numero di poligoni).
     """
+    backend = scegli_backend(len(gdf), backend)
+    fig = costruisci_figura_mappa(gdf, colonna_id, df_voti, join_col, partiti_cols, aggregati, colore, backend=backend)
+    return applica_stile_mappa(fig, colore, opacita)
+
+def applica_stile_mappa(fig, colore, opacita):
+    """
+    Applica colore e opacità a una copia della figura, senza ricostruire
+    geometrie né join. Il colore riguarda solo le aree a colore fisso.
+    """
+    if isinstance(fig, dict):
+        # Specifica della mappa TopoJSON: basta aggiornare i parametri di stile
+        return dict(fig, colore=colore, opacita=opacita)
+
+    if pdk is not None and isinstance(fig, pdk.Deck):
+        # Copia superficiale: i dati del layer restano condivisi
+        deck = copy.copy(fig)
+        layer = copy.copy(fig.layers[0])
+        layer.opacity = opacita
+        # Dopo la creazione del layer l'espressione va marcata a mano come
+        # funzione per @deck.gl/json (pydeck lo fa solo nel costruttore)
+        espressione = _espressione_colore_mvt if layer.type == "MVTLayer" else _espressione_colore_deck
+        layer.get_fill_color = "@@=" + espressione(colore)
+        deck.layers = [layer]
+        return deck
+
+    fig = go.Figure(fig)
+    fig.update_traces(marker_opacity=opacita)
+    fig.update_traces(colorscale=[[0, colore], [1, colore]], selector=dict(showscale=False))
+    return fig
+
+def aggiorna_valori_mappa(fig, valori, url_tile=None, range_color=None, precedenti=None):
+    """
+    Sostituisce in una copia della figura solo i valori per area ('valori':
+    tabella con 'CSX %', 'CDX %' e 'Diff' nell'ordine delle geometrie del
+    layer), senza ricostruire geometrie, join né layout: al browser arriva
+    solo il nuovo vettore dei colori (e dei tooltip). Con range_color None
+    resta la scala della figura (se ne ha una), così i colori restano
+    confrontabili mentre i valori cambiano. Per il motore "mvt" serve
+    'url_tile' (come in costruisci_figura_mappa, con l'argomento 'base').
+    Con 'precedenti' (i valori già applicati a 'fig') vengono sostituiti
+    solo quelli delle aree che cambiano: con le tile vettoriali il server
+    registra solo queste aree sopra i valori della figura.
+    """
+    diff = valori['Diff'].to_numpy(dtype=float)
+    cambiate = np.ones(len(valori), dtype=bool) if precedenti is None else _aree_cambiate(valori, precedenti)
+
+    if isinstance(fig, dict):
+        if fig.get("z") is None:
+            return fig
+        testo = [_sostituisci_hover(riga, valori.iloc[i]) if cambiate[i] else riga for i, riga in enumerate(fig["testo"])]
+        z = [None if np.isnan(v) else round(float(v), 2) for v in diff]
+        return dict(fig, z=z, testo=testo, range=range_color or fig["range"])
+
+    if pdk is not None and isinstance(fig, pdk.Deck):
+        layer = fig.layers[0]
+        range_color = range_color or _range_simmetrico(valori['Diff'])
+        rgb = _colori_diff(np.nan_to_num(diff), range_color)
+        presenti = ~np.isnan(diff)
+        proprieta = pd.DataFrame({
+            "csx": valori['CSX %'].round(1).to_numpy(),
+            "cdx": valori['CDX %'].round(1).to_numpy(),
+            "diff": valori['Diff'].round(1).to_numpy(),
+        })
+        deck = copy.copy(fig)
+        layer = copy.copy(layer)
+        if layer.type == "MVTLayer":
+            if url_tile is None:
+                return fig
+            for canale, chiave in enumerate("rgb"):
+                proprieta[chiave] = pd.Series(rgb[:, canale]).where(presenti)
+            base = re.search(r"/([0-9a-f]{16})/\{z\}", layer.data)
+            try:
+                layer.data = url_tile(_proprieta_tile(proprieta, np.flatnonzero(cambiate)), base=base.group(1) if base else None)
+            except KeyError:
+                # Valori della figura non più registrati nel server: si
+                # registrano quelli di tutte le aree
+                layer.data = url_tile(_proprieta_tile(proprieta, np.arange(len(proprieta))))
+        else:
+            proprieta = proprieta.astype(object).where(proprieta.notna(), None)
+            proprieta["colore"] = [riga.tolist() if valido else None for riga, valido in zip(rgb, presenti)]
+            # Le geometrie delle feature restano condivise con la figura in cache
+            features = [
+                dict(feature, properties=dict(feature["properties"], **props)) if cambiata else feature
+                for feature, props, cambiata in zip(layer.data["features"], proprieta.to_dict("records"), cambiate)
+            ]
+            layer.data = dict(layer.data, features=features)
+        deck.layers = [layer]
+        return deck
+
+    fig = go.Figure(fig)
+    if not fig.data or getattr(fig.data[0], "z", None) is None:
+        return fig
+    traccia = fig.data[0]
+    # Le altre colonne di hover sono in customdata, nell'ordine del template
+    customdata = np.array(traccia.customdata, dtype=object) if traccia.customdata is not None else None
+    if customdata is not None:
+        for col, posizione in re.findall(r"<br>([^=<]+)=%\{customdata\[(\d+)\]", traccia.hovertemplate or ""):
+            if col in valori.columns:
+                customdata[cambiate, int(posizione)] = valori[col].to_numpy()[cambiate]
+    traccia.update(z=diff, customdata=customdata)
+    if range_color:
+        fig.update_layout(coloraxis_cmin=range_color[0], coloraxis_cmax=range_color[1])
+    return fig
+
+def _proprieta_tile(proprieta, posizioni):
+    """Proprietà delle aree in 'posizioni' per il server delle tile (id -> dizionario)"""
+    return {
+        int(i): {chiave: (int(v) if chiave in ("r", "g", "b") else v) for chiave, v in riga.items() if not pd.isna(v)}
+        for i, riga in zip(posizioni, proprieta.iloc[posizioni].to_dict("records"))
+    }
+
+def _aree_cambiate(valori, precedenti):
+    """Maschera delle aree con almeno un valore diverso da 'precedenti'"""
+    nuovi = valori.to_numpy(dtype=float)
+    vecchi = precedenti[valori.columns].to_numpy(dtype=float)
+    return ~((nuovi == vecchi) | (np.isnan(nuovi) & np.isnan(vecchi))).all(axis=1)
+
+def _sostituisci_hover(testo, riga):
+    """Aggiorna i campi CSX, CDX e Diff nel testo di hover di un'area"""
+    if not isinstance(testo, str):
+        return testo  # Area senza chiave: nessun tooltip
+    for col, valore in riga.items():
+        formattato = ("N/A" if pd.isna(valore) else f"{valore:+.1f}") if col == 'Diff' else formatta_percentuale(valore)
+        testo = re.sub(rf"<br>{re.escape(col)}: [^<]*", lambda _: f"<br>{col}: {formattato}", testo)
+    return testo
+
+def evidenzia_area(fig, id_area):
+    """
+    Evidenzia un'area (posizione nel layer) in una copia della figura: le
+    altre aree vengono attenuate (Plotly) oppure l'area viene colorata con
+    COLORE_EVIDENZIATA (deck.gl). Le mappe TopoJSON restano invariate.
+    """
+    if id_area is None or isinstance(fig, dict):
+        return fig
+
+    if pdk is not None and isinstance(fig, pdk.Deck):
+        deck = copy.copy(fig)
+        layer = copy.copy(fig.layers[0])
+        layer.highlight_color = COLORE_EVIDENZIATA
+        if layer.type == "MVTLayer":
+            layer.unique_id_property = "id"
+            layer.highlighted_feature_id = int(id_area)
+        else:
+            layer.highlighted_object_index = int(id_area)
+        deck.layers = [layer]
+        return deck
+
+    fig = go.Figure(fig)
+    fig.update_traces(selectedpoints=[int(id_area)], unselected_marker_opacity=0.3)
+    return fig
+
+def id_selezione_mappa(evento):
+    """
+    Id (posizione nel layer) dell'area scelta con un clic, dall'evento di
+    selezione di st.plotly_chart o st.pydeck_chart; None se nessuna
+    """
+    selezione = (evento or {}).get("selection") or {}
+    for punto in selezione.get("points", []):
+        if punto.get("point_index") is not None:
+            return int(punto["point_index"])
+        if punto.get("location") is not None:
+            return int(punto["location"])
+    for oggetto in (selezione.get("objects") or {}).get(ID_LAYER_DECK, []):
+        if (oggetto.get("properties") or {}).get("id") is not None:
+            return int(oggetto["properties"]["id"])
+    indici = (selezione.get("indices") or {}).get(ID_LAYER_DECK)
+    return int(indici[0]) if indici else None
+
+def area_selezionata_nel_browser(evento):
+    """
+    Id dell'area che il browser mostra già selezionata dopo un clic: Plotly
+    seleziona da sé il punto cliccato (come con selectedpoints), mentre
+    deck.gl mantiene l'area evidenziata nella figura (None)
+    """
+    selezione = (evento or {}).get("selection") or {}
+    return id_selezione_mappa(evento) if selezione.get("points") else None
+
+def prepara_dati_mappa(gdf, colonna_id, df_voti=None, join_col=None, partiti_cols=None, aggregati=None):
+    """
+    Unisce le geometrie (in WGS84) con i dati di voto aggregati.
+    Restituisce il GeoDataFrame unito, i campi di hover e la colonna da
+    usare per la colorazione (None se non disponibile).
+    """
+    # Converti a WGS84 se necessario
+    if gdf.crs and str(gdf.crs) != "EPSG:4326":
+        gdf = gdf.to_crs("EPSG:4326")
+
+    # Crea una copia per evitare di modificare l'originale
+    gdf_copy = gdf.copy()
+    gdf_copy = gdf_copy.reset_index(drop=True)  # Resetta l'indice per assicurare un indice sequenziale
+    gdf_copy['id_map'] = gdf_copy.index.astype(str)  # Crea una colonna per l'id
+    hover_data = {colonna_id: True}
+    color_col = None
+
+    # Unisci i dati di voto se disponibili
+    if df_voti is None or join_col is None:
+        return gdf_copy, hover_data, color_col
+
+    # Con gli aggregati precalcolati (indicizzati dalla chiave delle
+    # geometrie) la colonna di join può mancare nel file voti
+    if aggregati is None and join_col not in df_voti.columns:
+        registra_errore("join dei voti", f"colonna di join '{join_col}' non trovata in df_voti")
+        return gdf_copy, hover_data, color_col
+
     try:
-        # Converti a WGS84 se necessario
-        if gdf.crs and str(gdf.crs) != "EPSG:4326":
-            gdf = gdf.to_crs("EPSG:4326")
-        
-        # Unisci i dati di voto se disponibili
-        if df_voti is not None and join_col is not None:
-            # Crea una copia per evitare di modificare l'originale
-            gdf_copy = gdf.copy()
-            
-            # Preparazione dei dati per il join
-            if join_col not in df_voti.columns:
-                print(f"Colonna di join '{join_col}' non trovata in df_voti")
-                gdf_copy['id'] = range(len(gdf_copy))
-                hover_data = {colonna_id: True}
-                color_col = None
+        # Converte la colonna di join in string per le geometrie
+        gdf_copy[colonna_id] = gdf_copy[colonna_id].astype(str)
+
+        # Usa gli aggregati precalcolati se disponibili, altrimenti i totali
+        # esatti del livello (somma dei conteggi, percentuali sui voti validi)
+        if aggregati is None:
+            with span("rollup", livello=join_col, righe=len(df_voti)):
+                rollup = rollup_tabella(df_voti, join_col, [], colonne_conteggio(df_voti, (join_col,)))
+                aggregati = tabella_livello(rollup, join_col, partiti_cols or ())
+        grouped_df = aggregati.reset_index()
+
+        # Unisci con i dati geografici (left join: l'ordine delle geometrie
+        # e quindi 'id_map' restano invariati)
+        with span("merge", righe=len(gdf_copy), unita=len(grouped_df)) as attributi:
+            gdf_copy = gdf_copy.merge(grouped_df, how='left', left_on=colonna_id, right_on=join_col)
+
+        # Crea la differenza per la colorazione
+        if 'CSX %' in gdf_copy.columns and 'CDX %' in gdf_copy.columns:
+            gdf_copy['Diff'] = gdf_copy['CSX %'] - gdf_copy['CDX %']
+            attributi.update(diff_min=float(gdf_copy['Diff'].min()), diff_max=float(gdf_copy['Diff'].max()))
+            color_col = 'Diff'
+
+        # Crea dati per hover più leggibili
+        hover_data = {}
+
+        # Aggiungi le colonne di percentuali se disponibili
+        for col in ['CSX %', 'CDX %', 'Diff']:
+            if col in gdf_copy.columns:
+                hover_data[col] = ':.1f'
+
+        # Aggiungi solo le colonne principali dei partiti per non sovraccaricare il tooltip
+        partiti_principali = [
+            "PD %", "M5S %", "FdI %", "Lega %", "FI %"
+        ]
+        for col in partiti_principali:
+            if col in gdf_copy.columns:
+                hover_data[col] = ':.1f'
+
+    except Exception as e:
+        registra_errore("join dei voti", repr(e))
+        hover_data = {colonna_id: True}
+        color_col = None
+
+    return gdf_copy, hover_data, color_col
+
+def costruisci_figura_mappa(gdf, colonna_id, df_voti=None, join_col=None, partiti_cols=None, aggregati=None, colore="#2563eb", geojson_url=None, backend=BACKEND_GEO, zoom=None, topojson_url=None, url_tile=None):
+    """
+    Costruisce la figura della mappa (geometrie e dati di voto uniti) con il
+    motore indicato. Non dipende dall'opacità, quindi può essere messa in
+    cache e riusata.
+    Con 'geojson_url' la geometria non viene incorporata nella figura: il
+    browser la scarica una volta dall'URL (feature con 'id' = posizione nel
+    layer) e la figura contiene solo i valori e i campi di hover per id.
+    Il motore "deck" incorpora sempre le geometrie. 'zoom' fissa lo zoom
+    iniziale dei motori WebGL (None = inquadra tutto il layer).
+    Il motore "topo" richiede 'topojson_url' (altrimenti si usa "map") e
+    restituisce una specifica da disegnare con html_mappa_topojson.
+    Il motore "mvt" richiede 'url_tile' (altrimenti si usa "deck"): una
+    funzione che riceve le proprietà per feature (id -> dizionario), le
+    registra presso il server delle tile e restituisce il modello di URL
+    {z}/{x}/{y} delle tile con quei valori.
+    """
+    with span("figura_mappa", motore=backend, poligoni=len(gdf)) as attributi:
+        try:
+            gdf_copy, hover_data, color_col = prepara_dati_mappa(gdf, colonna_id, df_voti, join_col, partiti_cols, aggregati)
+
+            # Colora per differenza CSX-CDX solo se ci sono valori validi
+            colorata = bool(color_col) and gdf_copy[color_col].notna().any()
+
+            if backend == BACKEND_MVT and pdk is not None and url_tile is not None:
+                return _figura_mvt(gdf_copy, colonna_id, color_col if colorata else None, colore, url_tile, zoom)
+
+            if backend in (BACKEND_DECK, BACKEND_MVT) and pdk is not None:
+                return _figura_deck(gdf_copy, colonna_id, color_col if colorata else None, colore, zoom)
+
+            if backend == BACKEND_TOPO:
+                if topojson_url:
+                    return _figura_topojson(gdf_copy, colonna_id, hover_data, color_col if colorata else None, colore, topojson_url, zoom)
+                backend = BACKEND_MAP
+
+            # Geometria incorporata nella figura oppure scaricata dal browser via URL
+            if geojson_url:
+                geojson = geojson_url
+                featureidkey = 'id'
             else:
-                # Converte la colonna di join in string per entrambi i dataframe
-                gdf_copy[colonna_id] = gdf_copy[colonna_id].astype(str)
-                df_voti[join_col] = df_voti[join_col].astype(str)
-                
-                try:
-                    # Calcola percentuali CSX e CDX se non presenti
-                    if 'CSX %' not in df_voti.columns and partiti_cols:
-                        csx_cols = [col for col in partiti_cols if any(p in col for p in ["PD", "M5S", "AVS", "Orlando"])]
-                        df_voti['CSX %'] = df_voti[csx_cols].sum(axis=1)
-                    
-                    if 'CDX %' not in df_voti.columns and partiti_cols:
-                        cdx_cols = [col for col in partiti_cols if any(p in col for p in ["Bucci", "Lega", "FI", "FdI"])]
-                        df_voti['CDX %'] = df_voti[cdx_cols].sum(axis=1)
-                    
-                    # Raggruppa i dati per la colonna di join se necessario
-                    grouped_df = df_voti.groupby(join_col).mean().reset_index()
-                    
-                    # Unisci con i dati geografici
-                    gdf_copy = gdf_copy.merge(grouped_df, how='left', left_on=colonna_id, right_on=join_col)
-                    
-                    # Crea la differenza per la colorazione
-                    if 'CSX %' in gdf_copy.columns and 'CDX %' in gdf_copy.columns:
-                        gdf_copy['Diff'] = gdf_copy['CSX %'] - gdf_copy['CDX %']
-                        color_col = 'Diff'
-                    else:
-                        color_col = None
-                    
-                    # Crea dati per hover
-                    hover_data = {colonna_id: True}
-                    
-                    # Aggiungi le colonne di percentuali se disponibili
-                    for col in ['CSX %', 'CDX %']:
-                        if col in gdf_copy.columns:
-                            hover_data[col] = ':.1f'
-                    
-                    # Aggiungi le colonne dei partiti se disponibili
-                    if partiti_cols:
-                        for col in partiti_cols:
-                            if col in gdf_copy.columns:
-                                hover_data[col] = ':.1f'
-                    
-                except Exception as e:
-                    print(f"Errore nel join dei dati: {str(e)}")
-                    gdf_copy['id'] = range(len(gdf_copy))
-                    hover_data = {colonna_id: True}
-                    color_col = None
-        else:
-            # Se non ci sono dati di voto, usa il GeoDataFrame originale
-            gdf_copy = gdf.copy()
-            gdf_copy['id'] = range(len(gdf_copy))
-            hover_data = {colonna_id: True}
-            color_col = None
-        
-        # Crea una mappa con Plotly
-        if color_col and 'Diff' in gdf_copy.columns:
-            # Mappa colorata in base alla differenza CSX-CDX
-            # Verifica che ci siano effettivamente differenze da visualizzare
-            if gdf_copy['Diff'].notna().any():
-                fig = px.choropleth_mapbox(
-                    gdf_copy,
-                    geojson=gdf_copy.__geo_interface__,
-                    locations='id',
-                    color='Diff',  # Usa direttamente Diff
-                    color_continuous_scale=["blue", "white", "red"],
-                    range_color=[-30, 30],  # Scala da -30% a +30%
-                    hover_name=gdf_copy[colonna_id],
-                    hover_data=hover_data,
-                    mapbox_style="carto-positron",
-                    center={"lat": gdf_copy.geometry.centroid.y.mean(), "lon": gdf_copy.geometry.centroid.x.mean()},
-                    zoom=10,
-                    opacity=opacita
+                with span("__geo_interface__", poligoni=len(gdf_copy)):
+                    geojson = gdf_copy.__geo_interface__
+                featureidkey = 'properties.id_map'
+
+            argomenti = dict(
+                geojson=geojson,
+                featureidkey=featureidkey,  # Usa questa chiave per collegare i dati alla geometria
+                locations='id_map',
+                hover_name=gdf_copy[colonna_id],
+                hover_data=hover_data
+            )
+            if colorata:
+                # Usa una scala di colori divergente e range simmetrico adattato ai dati
+                argomenti.update(
+                    color=color_col,
+                    color_continuous_scale=SCALA_DIFF,
+                    range_color=_range_simmetrico(gdf_copy[color_col])
                 )
-                
+            else:
+                # Mappa con colore fisso
+                argomenti.update(color_discrete_sequence=[colore])
+
+            if backend == BACKEND_MAP:
+                fig = _figura_map(gdf_copy, argomenti, zoom)
+            else:
+                fig = _figura_geo(gdf_copy, argomenti)
+
+            if colorata:
                 # Aggiungi una title per la colorbar
                 fig.update_layout(
                     coloraxis_colorbar=dict(
                         title="Differenza % CSX-CDX",
-                        tickvals=[-30, -20, -10, 0, 10, 20, 30],
-                        ticktext=["-30%", "-20%", "-10%", "0%", "+10%", "+20%", "+30%"]
+                        tickvals=[-20, -10, 0, 10, 20],
+                        ticktext=["-20%", "-10%", "0%", "+10%", "+20%"]
                     )
                 )
-            else:
-                # Se non ci sono differenze valide, usa il colore predefinito
-                fig = px.choropleth_mapbox(
-                    gdf_copy,
-                    geojson=gdf_copy.__geo_interface__,
-                    locations='id',
-                    hover_name=gdf_copy[colonna_id],
-                    hover_data=hover_data,
-                    mapbox_style="carto-positron",
-                    center={"lat": gdf_copy.geometry.centroid.y.mean(), "lon": gdf_copy.geometry.centroid.x.mean()},
-                    zoom=10,
-                    opacity=opacita,
-                    color_discrete_sequence=[colore]
-                )
-        else:
-            # Mappa con colore fisso
-            fig = px.choropleth_mapbox(
-                gdf_copy,
-                geojson=gdf_copy.__geo_interface__,
-                locations='id',
-                hover_name=gdf_copy[colonna_id],
-                hover_data=hover_data,
-                mapbox_style="carto-positron",
-                center={"lat": gdf_copy.geometry.centroid.y.mean(), "lon": gdf_copy.geometry.centroid.x.mean()},
-                zoom=10,
-                opacity=opacita,
-                color_discrete_sequence=[colore]
+
+            # Aumenta le dimensioni della mappa
+            fig.update_layout(
+                margin={"r": 0, "t": 0, "l": 0, "b": 0},
+                height=600  # Altezza aumentata
             )
-        
-        # Aumenta le dimensioni della mappa
-        fig.update_layout(
-            margin={"r": 0, "t": 0, "l": 0, "b": 0},
-            height=600  # Altezza aumentata
-        )
-        
-        return fig
-    except Exception as e:
-        print(f"Errore nella creazione della mappa Plotly: {str(e)}")
-        fig = go.Figure()
-        fig.update_layout(title=f"Errore: {str(e)}")
-        return fig
+
+            return fig
+        except Exception as e:
+            attributi["errore"] = str(e)
+            registra_errore("mappa", repr(e))
+            fig = go.Figure()
+            fig.update_layout(title=f"Errore: {str(e)}")
+            return fig
+
+def _range_simmetrico(valori):
+    max_abs_diff = max(
+        abs(valori.min() if not pd.isna(valori.min()) else 0),
+        abs(valori.max() if not pd.isna(valori.max()) else 0)
+    )
+    if max_abs_diff == 0:
+        max_abs_diff = 10  # Valore di default se non ci sono differenze
+    # float di Python: le percentuali float32 non sono serializzabili in JSON
+    max_abs_diff = float(max_abs_diff)
+    return [-max_abs_diff, max_abs_diff]
+
+def centro_zoom(gdf):
+    """Centro e livello di zoom web-mercator che inquadrano il layer"""
+    minx, miny, maxx, maxy = gdf.total_bounds
+    centro = {"lat": (miny + maxy) / 2, "lon": (minx + maxx) / 2}
+    # Correzione della latitudine per l'estensione verticale
+    ampiezza = max(maxx - minx, (maxy - miny) / math.cos(math.radians(centro["lat"])), 1e-6)
+    zoom = max(0.0, min(18.0, math.log2(360 / ampiezza) - 0.3))
+    return centro, zoom
+
+def _figura_geo(gdf_copy, argomenti):
+    """Motore SVG: proiezione geografica di Plotly"""
+    fig = px.choropleth(gdf_copy, **argomenti)
+
+    # Configura la mappa per renderla simile a mapbox
+    fig.update_geos(
+        fitbounds="locations",
+        visible=False,
+        resolution=110,
+        showcountries=True,
+        countrycolor="Black",
+        showsubunits=True,
+        subunitcolor="Black"
+    )
+    return fig
+
+def _figura_map(gdf_copy, argomenti, zoom=None):
+    """Motore WebGL: MapLibre (o Mapbox GL con Plotly < 5.24), senza tile esterne"""
+    centro, zoom_adattato = centro_zoom(gdf_copy)
+    zoom = zoom_adattato if zoom is None else zoom
+    if hasattr(px, "choropleth_map"):
+        return px.choropleth_map(gdf_copy, map_style=STILE_MAP_OFFLINE, center=centro, zoom=zoom, **argomenti)
+    return px.choropleth_mapbox(gdf_copy, mapbox_style=STILE_MAP_OFFLINE, center=centro, zoom=zoom, **argomenti)
+
+def _colori_diff(valori, range_color):
+    """Colori RGB della scala divergente per un vettore di differenze"""
+    posizioni = (np.asarray(valori, dtype=float) - range_color[0]) / (range_color[1] - range_color[0])
+    posizioni = np.clip(posizioni, 0, 1)
+    rgb = np.column_stack([
+        np.interp(posizioni, _SCALA_DIFF_POS, _SCALA_DIFF_RGB[:, canale]) for canale in range(3)
+    ])
+    return rgb.round().astype(int)
+
+def _espressione_colore_deck(colore):
+    """Colore per feature, con 'colore' per le aree senza dati"""
+    colore = colore.lstrip("#")
+    rgb = [int(colore[i:i + 2], 16) for i in (0, 2, 4)]
+    return f"properties.colore || {rgb}"
+
+def _espressione_colore_mvt(colore):
+    """Come _espressione_colore_deck, con il colore in tre attributi r, g, b"""
+    colore = colore.lstrip("#")
+    rgb = [int(colore[i:i + 2], 16) for i in (0, 2, 4)]
+    return f"properties.r >= 0 ? [properties.r, properties.g, properties.b] : {rgb}"
+
+def _proprieta_deck(gdf_copy, colonna_id):
+    """Attributi per il tooltip di deck.gl: nome e percentuali arrotondate"""
+    proprieta = pd.DataFrame({"nome": gdf_copy[colonna_id].astype(str)})
+    for col, chiave in [('CSX %', 'csx'), ('CDX %', 'cdx'), ('Diff', 'diff')]:
+        if col in gdf_copy.columns:
+            proprieta[chiave] = gdf_copy[col].round(1)
+    return proprieta
+
+def _tooltip_deck(color_col):
+    if color_col:
+        return {"html": "<b>{nome}</b><br/>CSX: {csx}%<br/>CDX: {cdx}%<br/>Diff: {diff}"}
+    return {"text": "{nome}"}
+
+def _figura_deck(gdf_copy, colonna_id, color_col, colore, zoom=None):
+    """Motore deck.gl: GeoJsonLayer di pydeck senza mappa di base (offline)"""
+    proprieta = _proprieta_deck(gdf_copy, colonna_id)
+
+    colori = [None] * len(gdf_copy)
+    if color_col:
+        valori = gdf_copy[color_col]
+        rgb = _colori_diff(valori.fillna(0), _range_simmetrico(valori))
+        colori = [riga.tolist() if valida else None for riga, valida in zip(rgb, valori.notna())]
+    proprieta["colore"] = colori
+    # Stesso 'id' delle tile vettoriali: la posizione della feature nel layer
+    proprieta["id"] = np.arange(len(gdf_copy))
+
+    # NaN non è JSON valido per deck.gl
+    proprieta = proprieta.astype(object).where(proprieta.notna(), None)
+    with span("geojson_deck", poligoni=len(gdf_copy)):
+        features = [
+            {"type": "Feature", "geometry": mapping(geom), "properties": props}
+            for geom, props in zip(gdf_copy.geometry, proprieta.to_dict("records"))
+        ]
+
+    layer = pdk.Layer(
+        "GeoJsonLayer",
+        id=ID_LAYER_DECK,
+        data={"type": "FeatureCollection", "features": features},
+        pickable=True,
+        stroked=True,
+        filled=True,
+        get_fill_color=_espressione_colore_deck(colore),
+        get_line_color=[80, 80, 80],
+        line_width_min_pixels=0.5,
+    )
+    centro, zoom_adattato = centro_zoom(gdf_copy)
+    zoom = zoom_adattato if zoom is None else zoom
+    return pdk.Deck(
+        layers=[layer],
+        initial_view_state=pdk.ViewState(latitude=centro["lat"], longitude=centro["lon"], zoom=zoom),
+        map_style=None,
+        map_provider=None,
+        tooltip=_tooltip_deck(color_col),
+    )
+
+def _figura_mvt(gdf_copy, colonna_id, color_col, colore, url_tile, zoom=None):
+    """
+    Motore a tile vettoriali: MVTLayer di pydeck che scarica dal server
+    locale solo le tile dell'area visibile. La figura non contiene
+    geometrie: le proprietà per feature (tooltip e colore) vengono unite
+    alle tile dal server.
+    """
+    proprieta = _proprieta_deck(gdf_copy, colonna_id)
+    if color_col:
+        valori = gdf_copy[color_col]
+        rgb = _colori_diff(valori.fillna(0), _range_simmetrico(valori))
+        for canale, chiave in enumerate("rgb"):
+            proprieta[chiave] = pd.Series(rgb[:, canale]).where(valori.notna())
+
+    # Nessun attributo per i valori mancanti (NaN non è codificabile)
+    valori_feature = {
+        i: {chiave: (int(v) if chiave in ("r", "g", "b") else v) for chiave, v in riga.items() if not pd.isna(v)}
+        for i, riga in enumerate(proprieta.to_dict("records"))
+    }
+
+    layer = pdk.Layer(
+        "MVTLayer",
+        id=ID_LAYER_DECK,
+        data=url_tile(valori_feature),
+        min_zoom=ZOOM_MIN_TILE,
+        max_zoom=ZOOM_MAX_TILE,
+        binary=False,
+        # Decodifica nel thread principale: i worker di loaders.gl
+        # verrebbero scaricati da una CDN
+        load_options={"worker": False},
+        pickable=True,
+        stroked=True,
+        filled=True,
+        get_fill_color=_espressione_colore_mvt(colore),
+        get_line_color=[80, 80, 80],
+        line_width_min_pixels=0.5,
+    )
+    centro, zoom_adattato = centro_zoom(gdf_copy)
+    zoom = zoom_adattato if zoom is None else zoom
+    return pdk.Deck(
+        layers=[layer],
+        initial_view_state=pdk.ViewState(latitude=centro["lat"], longitude=centro["lon"], zoom=zoom),
+        map_style=None,
+        map_provider=None,
+        tooltip=_tooltip_deck(color_col),
+    )
+
+def _testo_hover(gdf_copy, colonna_id, hover_data):
+    """Testo del tooltip per ogni area, con i campi di hover formattati"""
+    righe = "<b>" + gdf_copy[colonna_id].astype(str) + "</b>"
+    for col, formato in hover_data.items():
+        if col == colonna_id or col not in gdf_copy.columns:
+            continue
+        if formato == ':.1f':
+            valori = gdf_copy[col].map(formatta_percentuale if col != 'Diff' else lambda v: "N/A" if pd.isna(v) else f"{v:+.1f}")
+        else:
+            valori = gdf_copy[col].astype(str)
+        righe = righe + f"<br>{col}: " + valori
+    return righe.tolist()
+
+def _figura_topojson(gdf_copy, colonna_id, hover_data, color_col, colore, topojson_url, zoom=None):
+    """
+    Motore TopoJSON: la specifica contiene solo id, valori e tooltip; la
+    geometria (archi condivisi e coordinate quantizzate) viene scaricata una
+    volta dal browser e decodificata lato client.
+    """
+    centro, zoom_adattato = centro_zoom(gdf_copy)
+    z = None
+    range_color = None
+    if color_col:
+        valori = gdf_copy[color_col]
+        z = [None if pd.isna(v) else round(float(v), 2) for v in valori]
+        range_color = _range_simmetrico(valori)
+    return {
+        "tipo": BACKEND_TOPO,
+        "url": topojson_url,
+        "oggetto": NOME_OGGETTO,
+        "locations": gdf_copy['id_map'].tolist(),
+        "z": z,
+        "range": range_color,
+        "scala": SCALA_DIFF,
+        "testo": _testo_hover(gdf_copy, colonna_id, hover_data),
+        "colore": colore,
+        "opacita": 1.0,
+        "centro": centro,
+        "zoom": zoom_adattato if zoom is None else zoom,
+        "stile": STILE_MAP_OFFLINE,
+        "altezza": 600,
+    }
+
+_HTML_TOPOJSON = Template("""
+<div id="mappa" style="height: ${altezza}px;"></div>
+<script>
+const spec = ${spec};
+const plotlyUrl = ${plotly_url};
+
+// plotly.js viene iniettato come script inline: funziona anche se il server
+// statico non dichiara il MIME type JavaScript
+function caricaPlotly() {
+  if (window.Plotly) return Promise.resolve();
+  return fetch(plotlyUrl).then(r => r.text()).then(codice => {
+    const script = document.createElement("script");
+    script.text = codice;
+    document.head.appendChild(script);
+  });
+}
+
+// Decodifica TopoJSON -> GeoJSON (archi per differenze, indici negativi = arco invertito)
+function decodifica(topo, nome) {
+  const [sx, sy] = topo.transform.scale, [tx, ty] = topo.transform.translate;
+  const archi = topo.arcs.map(arco => {
+    let x = 0, y = 0;
+    return arco.map(([dx, dy]) => { x += dx; y += dy; return [x * sx + tx, y * sy + ty]; });
+  });
+  const anello = indici => {
+    const punti = [];
+    indici.forEach((i, k) => {
+      const arco = i < 0 ? archi[~i].slice().reverse() : archi[i];
+      punti.push(...(k ? arco.slice(1) : arco));
+    });
+    return punti;
+  };
+  const geometria = g => g.type === "Polygon" ? {type: "Polygon", coordinates: g.arcs.map(anello)}
+    : g.type === "MultiPolygon" ? {type: "MultiPolygon", coordinates: g.arcs.map(p => p.map(anello))} : null;
+  return {
+    type: "FeatureCollection",
+    features: topo.objects[nome].geometries.map(g => ({type: "Feature", id: g.id, properties: {}, geometry: geometria(g)}))
+  };
+}
+
+Promise.all([caricaPlotly(), fetch(spec.url).then(r => r.json())]).then(([_, topo]) => {
+  const colorata = spec.z !== null;
+  const trace = {
+    type: "choroplethmap",
+    geojson: decodifica(topo, spec.oggetto),
+    featureidkey: "id",
+    locations: spec.locations,
+    z: colorata ? spec.z : spec.locations.map(() => 1),
+    text: spec.testo,
+    hovertemplate: "%{text}<extra></extra>",
+    marker: {opacity: spec.opacita, line: {width: 0.5}},
+    showscale: colorata,
+    colorscale: colorata ? spec.scala : [[0, spec.colore], [1, spec.colore]],
+    zmin: colorata ? spec.range[0] : 0,
+    zmax: colorata ? spec.range[1] : 1,
+    colorbar: {title: {text: "Differenza % CSX-CDX"}}
+  };
+  Plotly.newPlot("mappa", [trace], {
+    map: {style: spec.stile, center: spec.centro, zoom: spec.zoom},
+    margin: {r: 0, t: 0, l: 0, b: 0},
+    height: spec.altezza
+  }, {responsive: true});
+});
+</script>
+""")
+
+def html_mappa_topojson(spec, plotly_url):
+    """HTML autonomo (per st.components.v1.html) che disegna una mappa TopoJSON"""
+    def js(valore):
+        return json.dumps(valore).replace("</", "<\\/")
+    return _HTML_TOPOJSON.substitute(altezza=spec["altezza"], spec=js(spec), plotly_url=js(plotly_url))
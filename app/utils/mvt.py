@@ -0,0 +1,325 @@
+# utils/mvt.py
+
+import gzip
+import json
+import sqlite3
+import struct
+
+import numpy as np
+import shapely
+
+# Estensione delle coordinate intere di una tile e margine di ritaglio (in
+# unità tile) che evita bordi visibili tra tile adiacenti
+ESTENSIONE = 4096
+MARGINE = 64
+
+# Semilato del piano web mercator (EPSG:3857) in metri
+ORIGINE_MERCATORE = 20037508.342789244
+
+# Nome del layer vettoriale nelle tile
+NOME_LAYER = "layer"
+
+# Livelli di zoom tagliati in tile: dall'intera regione al dettaglio di
+# quartiere (oltre ZOOM_MAX_TILE il client ingrandisce le tile dell'ultimo
+# livello)
+ZOOM_MIN_TILE = 8
+ZOOM_MAX_TILE = 14
+
+# Tipi di geometria e comandi della specifica Mapbox Vector Tile 2.1
+_TIPO_POLIGONO = 3
+_MOVE_TO, _LINE_TO, _CLOSE_PATH = 1, 2, 7
+
+
+# --- Protobuf: scrittura e lettura minimali dei soli tipi usati dalle MVT ---
+
+def _varint(n):
+    byte = bytearray()
+    while True:
+        parte = n & 0x7F
+        n >>= 7
+        if n:
+            byte.append(parte | 0x80)
+        else:
+            byte.append(parte)
+            return bytes(byte)
+
+
+def _zigzag(n):
+    return (n << 1) ^ (n >> 63)
+
+
+def _campo_varint(numero, valore):
+    return _varint(numero << 3) + _varint(valore)
+
+
+def _campo_bytes(numero, dati):
+    return _varint((numero << 3) | 2) + _varint(len(dati)) + dati
+
+
+def _campo_packed(numero, valori):
+    return _campo_bytes(numero, b"".join(_varint(v) for v in valori))
+
+
+def _leggi_varint(buf, pos):
+    risultato = spostamento = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        risultato |= (byte & 0x7F) << spostamento
+        if not byte & 0x80:
+            return risultato, pos
+        spostamento += 7
+
+
+def _campi(buf):
+    """Scorre i campi di un messaggio protobuf: (numero, valore)"""
+    pos = 0
+    while pos < len(buf):
+        chiave, pos = _leggi_varint(buf, pos)
+        numero, tipo = chiave >> 3, chiave & 7
+        if tipo == 0:
+            valore, pos = _leggi_varint(buf, pos)
+        elif tipo == 2:
+            lunghezza, pos = _leggi_varint(buf, pos)
+            valore, pos = bytes(buf[pos:pos + lunghezza]), pos + lunghezza
+        elif tipo == 1:
+            valore, pos = bytes(buf[pos:pos + 8]), pos + 8
+        elif tipo == 5:
+            valore, pos = bytes(buf[pos:pos + 4]), pos + 4
+        else:
+            raise ValueError(f"Tipo di campo protobuf non supportato: {tipo}")
+        yield numero, valore
+
+
+def _codifica_valore(valore):
+    if isinstance(valore, str):
+        return _campo_bytes(1, valore.encode("utf-8"))
+    if isinstance(valore, (bool, np.bool_)):
+        return _campo_varint(7, int(valore))
+    if isinstance(valore, (int, np.integer)):
+        return _campo_varint(6, _zigzag(int(valore)))
+    return _varint((3 << 3) | 1) + struct.pack("<d", float(valore))
+
+
+def codifica_tile(features, nome=NOME_LAYER):
+    """
+    Codifica una tile con un solo layer. 'features' è una lista di tuple
+    (id, geometria, proprietà) dove la geometria è la sequenza di comandi
+    MVT già codificata (campo packed) e le proprietà un dizionario; i valori
+    None vengono omessi.
+    """
+    chiavi, valori = {}, {}
+    messaggi = []
+    for id_feature, geometria, proprieta in features:
+        tag = []
+        for chiave, valore in proprieta.items():
+            if valore is None:
+                continue
+            tag.append(chiavi.setdefault(chiave, len(chiavi)))
+            codificato = _codifica_valore(valore)
+            tag.append(valori.setdefault(codificato, len(valori)))
+        messaggi.append(_campo_bytes(2, (
+            _campo_varint(1, id_feature)
+            + (_campo_packed(2, tag) if tag else b"")
+            + _campo_varint(3, _TIPO_POLIGONO)
+            + _campo_bytes(4, geometria)
+        )))
+
+    layer = (
+        _campo_varint(15, 2)
+        + _campo_bytes(1, nome.encode("utf-8"))
+        + b"".join(messaggi)
+        + b"".join(_campo_bytes(3, chiave.encode("utf-8")) for chiave in chiavi)
+        + b"".join(_campo_bytes(4, valore) for valore in valori)
+        + _campo_varint(5, ESTENSIONE)
+    )
+    return _campo_bytes(3, layer)
+
+
+def leggi_features(tile):
+    """
+    Estrae da una tile (non compressa) le feature del primo layer come
+    tuple (id, geometria codificata), senza decodificare le coordinate.
+    """
+    for numero, layer in _campi(tile):
+        if numero != 3:
+            continue
+        features = []
+        for campo, feature in _campi(layer):
+            if campo != 2:
+                continue
+            id_feature, geometria = 0, b""
+            for n, valore in _campi(feature):
+                if n == 1:
+                    id_feature = valore
+                elif n == 4:
+                    geometria = valore
+            features.append((id_feature, geometria))
+        return features
+    return []
+
+
+# --- Geometria: ritaglio per tile e codifica dei comandi ---
+
+def dimensione_tile(zoom):
+    """Lato di una tile in metri web mercator"""
+    return 2 * ORIGINE_MERCATORE / (2 ** zoom)
+
+
+def limiti_tile(zoom, x, y):
+    """Estensione (minx, miny, maxx, maxy) di una tile XYZ in EPSG:3857"""
+    lato = dimensione_tile(zoom)
+    minx = -ORIGINE_MERCATORE + x * lato
+    maxy = ORIGINE_MERCATORE - y * lato
+    return minx, maxy - lato, minx + lato, maxy
+
+
+def _comandi_anello(punti, cursore, esterno):
+    """
+    Comandi di un anello in coordinate tile intere. Gli anelli esterni hanno
+    area positiva (senso orario con y verso il basso), i fori negativa.
+    Restituisce None per gli anelli degeneri dopo l'arrotondamento.
+    """
+    punti = punti[np.r_[True, np.any(np.diff(punti, axis=0) != 0, axis=1)]]
+    if len(punti) > 1 and (punti[0] == punti[-1]).all():
+        punti = punti[:-1]
+    if len(punti) < 3:
+        return None
+    x, y = punti[:, 0], punti[:, 1]
+    area = np.sum(x * np.roll(y, -1) - np.roll(x, -1) * y)
+    if area == 0:
+        return None
+    if (area > 0) != esterno:
+        punti = punti[::-1]
+
+    delta = np.diff(np.vstack([cursore, punti]), axis=0)
+    zigzag = ((delta << 1) ^ (delta >> 63)).tolist()
+    comandi = [_MOVE_TO | (1 << 3), *zigzag[0], _LINE_TO | ((len(punti) - 1) << 3)]
+    for dx, dy in zigzag[1:]:
+        comandi.append(dx)
+        comandi.append(dy)
+    comandi.append(_CLOSE_PATH | (1 << 3))
+    return comandi, punti[-1]
+
+
+def codifica_geometria(geom, limiti):
+    """
+    Converte una geometria poligonale (EPSG:3857, già ritagliata) nella
+    sequenza di comandi MVT della tile con i limiti indicati.
+    Restituisce b"" se dopo l'arrotondamento non resta nulla.
+    """
+    minx, _, maxx, maxy = limiti
+    scala = ESTENSIONE / (maxx - minx)
+    cursore = np.zeros(2, dtype=np.int64)
+    comandi = []
+    poligoni = [g for g in shapely.get_parts(geom) if g.geom_type == "Polygon"]
+    for poligono in poligoni:
+        for i, anello in enumerate([poligono.exterior, *poligono.interiors]):
+            coordinate = np.asarray(anello.coords)[:, :2]
+            punti = np.column_stack([
+                np.round((coordinate[:, 0] - minx) * scala),
+                np.round((maxy - coordinate[:, 1]) * scala),
+            ]).astype(np.int64)
+            risultato = _comandi_anello(punti, cursore, esterno=i == 0)
+            if risultato is None:
+                if i == 0:
+                    break  # Senza anello esterno i fori non hanno senso
+                continue
+            parziali, cursore = risultato
+            comandi.extend(parziali)
+    return b"".join(_varint(c) for c in comandi)
+
+
+def taglia_livello(gdf, zoom):
+    """
+    Ritaglia un layer (in EPSG:3857) nelle tile di un livello di zoom.
+    Restituisce un dizionario (x, y) -> lista di (id, geometria codificata)
+    con id = posizione della riga nel layer. Le tile vuote sono omesse.
+    """
+    geometrie = np.asarray(gdf.geometry.values)
+    albero = shapely.STRtree(geometrie)
+    lato = dimensione_tile(zoom)
+    margine = lato * MARGINE / ESTENSIONE
+    minx, miny, maxx, maxy = gdf.total_bounds
+    x0 = int((minx + ORIGINE_MERCATORE) // lato)
+    x1 = int((maxx + ORIGINE_MERCATORE) // lato)
+    y0 = int((ORIGINE_MERCATORE - maxy) // lato)
+    y1 = int((ORIGINE_MERCATORE - miny) // lato)
+
+    tile = {}
+    for x in range(x0, x1 + 1):
+        for y in range(y0, y1 + 1):
+            limiti = limiti_tile(zoom, x, y)
+            ritaglio = (limiti[0] - margine, limiti[1] - margine, limiti[2] + margine, limiti[3] + margine)
+            indici = np.sort(albero.query(shapely.box(*ritaglio)))
+            if not len(indici):
+                continue
+            ritagliate = shapely.clip_by_rect(geometrie[indici], *ritaglio)
+            features = []
+            for i, geom in zip(indici.tolist(), ritagliate):
+                if geom is None or geom.is_empty:
+                    continue
+                codificata = codifica_geometria(geom, limiti)
+                if codificata:
+                    features.append((i, codificata))
+            if features:
+                tile[(x, y)] = features
+    return tile
+
+
+# --- MBTiles: archivio SQLite delle tile (compresse gzip, righe TMS) ---
+
+def scrivi_mbtiles(livelli, path, nome):
+    """
+    Scrive un archivio MBTiles con le tile di tutti i livelli di zoom.
+    'livelli' è un dizionario zoom -> layer (EPSG:3857) da usare a quello
+    zoom (tipicamente il livello della piramide di semplificazione adatto).
+    Le tile contengono solo geometria e 'id'; gli attributi possono essere
+    aggiunti al momento della richiesta (vedi utils/tile_server.py).
+    """
+    connessione = sqlite3.connect(path)
+    try:
+        connessione.executescript("""
+            CREATE TABLE metadata (name TEXT, value TEXT);
+            CREATE TABLE tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB);
+            CREATE UNIQUE INDEX tile_index ON tiles (zoom_level, tile_column, tile_row);
+        """)
+        for zoom, gdf in sorted(livelli.items()):
+            for (x, y), features in taglia_livello(gdf, zoom).items():
+                dati = codifica_tile([(i, geometria, {"id": i}) for i, geometria in features])
+                connessione.execute(
+                    "INSERT INTO tiles VALUES (?, ?, ?, ?)",
+                    (zoom, x, (2 ** zoom) - 1 - y, gzip.compress(dati, mtime=0)),
+                )
+
+        zoom_min, zoom_max = min(livelli), max(livelli)
+        minx, miny, maxx, maxy = next(iter(livelli.values())).to_crs("EPSG:4326").total_bounds
+        metadati = {
+            "name": nome,
+            "format": "pbf",
+            "type": "overlay",
+            "minzoom": str(zoom_min),
+            "maxzoom": str(zoom_max),
+            "bounds": f"{minx},{miny},{maxx},{maxy}",
+            "center": f"{(minx + maxx) / 2},{(miny + maxy) / 2},{zoom_min}",
+            "json": json.dumps({"vector_layers": [{
+                "id": NOME_LAYER,
+                "fields": {"id": "Number"},
+                "minzoom": zoom_min,
+                "maxzoom": zoom_max,
+            }]}),
+        }
+        connessione.executemany("INSERT INTO metadata VALUES (?, ?)", metadati.items())
+        connessione.commit()
+    finally:
+        connessione.close()
+
+
+def leggi_metadati(path):
+    """Metadati di un archivio MBTiles come dizionario"""
+    connessione = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        return dict(connessione.execute("SELECT name, value FROM metadata"))
+    finally:
+        connessione.close()
+
@@ -0,0 +1,201 @@
+# utils/rollup.py
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+from utils.coalizioni import SCHEMA_PREDEFINITO, SCHEMI_COALIZIONI, compila_schema, quote_coalizioni
+from utils.crosswalk import matrice_chiavi
+
+# Denominatore delle percentuali di lista
+COLONNA_VOTI_VALIDI = "TOT_VOTI_VALIDI_LISTA"
+
+
+def colonne_conteggio(df_voti, escluse=()):
+    """
+    Colonne con conteggi assoluti (votanti, schede, voti di lista): tutte le
+    colonne numeriche che non sono percentuali né chiavi territoriali.
+    """
+    return [
+        col for col in df_voti.select_dtypes(include=['number']).columns
+        if "%" not in col and col != "Diff" and col not in escluse
+    ]
+
+
+def matrice_genitori(chiavi_figli, chiavi_genitori, figli, genitori):
+    """
+    Matrice sparsa (unità figlie x unità genitrici) ricavata dalle coppie
+    (figlio, genitore) delle righe di una tabella: ogni figlio è ripartito
+    tra i genitori in proporzione alle righe che li collegano (di norma un
+    solo genitore con peso 1).
+    """
+    righe = matrice_chiavi(chiavi_figli, figli)
+    colonne = matrice_chiavi(chiavi_genitori, genitori)
+    coppie = sp.csr_matrix(righe.T @ colonne)
+    totali = np.asarray(coppie.sum(axis=1)).ravel()
+    scala = np.divide(1.0, totali, out=np.zeros_like(totali), where=totali > 0)
+    return sp.csr_matrix(sp.diags(scala) @ coppie)
+
+
+def _indice_chiavi(chiavi):
+    # Chiavi in stringa come negli aggregati; le chiavi mancanti restano NaN
+    serie = pd.Series(chiavi).reset_index(drop=True)
+    return pd.Index(serie.astype(str).where(serie.notna()))
+
+
+def costruisci_rollup(chiavi_base, conteggi_base, gerarchia):
+    """
+    Costruisce l'albero dei totali. 'conteggi_base' (unità base x colonne)
+    contiene i conteggi assoluti del livello più fine, 'gerarchia' è la
+    lista dei livelli superiori come tuple (nome, chiavi, matrice, figlio):
+    la matrice ripartisce le unità del livello 'figlio' (None = il livello
+    precedente nella lista) su quelle del livello, con pesi 0/1 per
+    un'appartenenza netta o quote di area per il crosswalk spaziale.
+    Ogni livello è la somma dei figli, mai una nuova scansione delle unità
+    base; più livelli possono avere lo stesso figlio.
+    """
+    nome_base = chiavi_base.name or "base"
+    rollup = {
+        "livelli": [nome_base],
+        "colonne": list(conteggi_base.columns),
+        "chiavi": {nome_base: _indice_chiavi(chiavi_base)},
+        "genitori": {},
+        "totali": {nome_base: np.nan_to_num(conteggi_base.to_numpy(dtype=float))},
+    }
+    for nome, chiavi, matrice, figlio in gerarchia:
+        figlio = figlio or rollup["livelli"][-1]
+        matrice = sp.csr_matrix(matrice)
+        rollup["livelli"].append(nome)
+        rollup["chiavi"][nome] = _indice_chiavi(chiavi)
+        rollup["genitori"][nome] = (figlio, matrice)
+        rollup["totali"][nome] = matrice.T @ rollup["totali"][figlio]
+    return rollup
+
+
+def rollup_tabella(df_voti, chiave_base, livelli, colonne):
+    """
+    Rollup dai conteggi di una tabella (ad es. una riga per sezione) lungo
+    le sue colonne territoriali, dalla più fine alla più grossa. Se un
+    livello non è annidato nel precedente (un'unità divisa tra più
+    genitori) si aggiunge il livello intermedio delle celle "figlio |
+    genitore": i totali restano esatti per entrambi i livelli.
+    """
+    righe = df_voti[chiave_base]
+    conteggi = df_voti[colonne].groupby(righe.to_numpy()).sum()
+    conteggi.index.name = chiave_base
+    base = conteggi.index.to_series()
+
+    gerarchia = []
+    precedente = chiave_base
+    for livello in livelli:
+        genitori = df_voti[livello]
+        chiavi = genitori.dropna().drop_duplicates()
+        annidato = genitori.groupby(df_voti[precedente].to_numpy()).nunique().max() <= 1
+        if annidato:
+            figli = df_voti[precedente].dropna().drop_duplicates() if precedente != chiave_base else base
+            gerarchia.append((livello, chiavi, matrice_genitori(df_voti[precedente], genitori, figli, chiavi), precedente))
+        else:
+            nome_celle = f"{precedente} | {livello}"
+            celle = df_voti[precedente].astype(str) + " | " + genitori.astype(str)
+            chiavi_celle = celle.drop_duplicates()
+            gerarchia.append((nome_celle, chiavi_celle, matrice_genitori(righe, celle, base, chiavi_celle), chiave_base))
+            gerarchia.append((livello, chiavi, matrice_genitori(celle, genitori, chiavi_celle, chiavi), nome_celle))
+        precedente = livello
+    return costruisci_rollup(base, conteggi, gerarchia)
+
+
+def rollup_spaziale(df_voti, chiave_base, colonne, base, superiori):
+    """
+    Rollup per la mappa, indicizzato dalle chiavi dei layer invece che
+    dalle colonne territoriali della tabella: le righe sono assegnate per
+    chiave (ad es. il numero di sezione) alle feature del layer 'base'
+    (nome, chiavi) e i livelli 'superiori' (nome, chiavi, matrice) sono
+    sommati ciascuno dal precedente con le matrici di sovrapposizione
+    (crosswalk)
+    """
+    conteggi = df_voti[colonne].groupby(df_voti[chiave_base].to_numpy()).sum()
+    nome, chiavi = base
+    gerarchia = [(nome, chiavi, matrice_chiavi(conteggi.index, chiavi), None)]
+    gerarchia += [(nome, chiavi, matrice, None) for nome, chiavi, matrice in superiori]
+    return costruisci_rollup(conteggi.index.to_series(name=chiave_base), conteggi, gerarchia)
+
+
+def aggiorna_unita(rollup, chiave, conteggi):
+    """
+    Sostituisce i conteggi di un'unità base (dizionario colonna -> valore,
+    le colonne assenti restano invariate) e aggiorna solo i suoi antenati
+    sommando la differenza, pesata dalle quote di appartenenza.
+    Restituisce False se l'unità non è presente.
+    """
+    nome_base = rollup["livelli"][0]
+    posizioni = np.flatnonzero(rollup["chiavi"][nome_base] == str(chiave))
+    if not len(posizioni):
+        return False
+    i = posizioni[0]
+
+    vecchi = rollup["totali"][nome_base][i]
+    nuovi = vecchi.copy()
+    for j, col in enumerate(rollup["colonne"]):
+        if col in conteggi and not pd.isna(conteggi[col]):
+            nuovi[j] = float(conteggi[col])
+    delta = nuovi - vecchi
+    rollup["totali"][nome_base][i] = nuovi
+
+    # Quote dell'unità aggiornata nelle unità di ogni livello (i livelli
+    # sono in ordine: i figli precedono sempre i genitori)
+    quote = {nome_base: {i: 1.0}}
+    for livello in rollup["livelli"][1:]:
+        figlio, matrice = rollup["genitori"][livello]
+        antenati = {}
+        for unita, peso in quote[figlio].items():
+            inizio, fine = matrice.indptr[unita], matrice.indptr[unita + 1]
+            for genitore, quota in zip(matrice.indices[inizio:fine], matrice.data[inizio:fine]):
+                antenati[genitore] = antenati.get(genitore, 0.0) + peso * quota
+        for genitore, peso in antenati.items():
+            rollup["totali"][livello][genitore] += peso * delta
+        quote[livello] = antenati
+    return True
+
+
+def _colonna_conteggio(colonna_percentuale, colonne):
+    # "Lega %" -> "Lega " (i nomi nel file voti possono avere spazi finali)
+    nome = colonna_percentuale.replace("%", "").strip()
+    return next((col for col in colonne if col.strip() == nome), None)
+
+
+def aggiungi_percentuali(totali, colonne_percentuali=(), coalizioni=None):
+    """
+    Ricava le percentuali da una tabella di conteggi assoluti: ogni colonna
+    percentuale richiesta (ad es. "PD %") è il rapporto tra il conteggio
+    omonimo e i voti validi di lista. Aggiunge le quote delle coalizioni
+    dello schema compilato 'coalizioni' (predefinito se None) e 'Diff'.
+    Le unità senza voti validi hanno percentuali mancanti.
+    """
+    if COLONNA_VOTI_VALIDI not in totali.columns:
+        return totali
+
+    validi = totali[COLONNA_VOTI_VALIDI].where(totali[COLONNA_VOTI_VALIDI] > 0)
+    percentuali = {}
+    for col in colonne_percentuali:
+        conteggio = _colonna_conteggio(col, totali.columns)
+        if conteggio is not None:
+            percentuali[col] = totali[conteggio] / validi * 100
+
+    if coalizioni is None:
+        colonne = [col for col in totali.columns if "%" not in col]
+        coalizioni = compila_schema(SCHEMI_COALIZIONI[SCHEMA_PREDEFINITO], colonne)
+    quote = quote_coalizioni(totali, coalizioni, totali[COLONNA_VOTI_VALIDI])
+    # Una coalizione può avere il nome di un partito (ad es. "M5S" da solo):
+    # la quota della coalizione prevale sulla percentuale omonima
+    return totali.assign(**{**percentuali, **dict(quote.items())})
+
+
+def tabella_livello(rollup, livello, colonne_percentuali=(), coalizioni=None):
+    """
+    Tabella dei totali di un livello, indicizzata dalla chiave in stringa,
+    con le percentuali ricavate al momento dai conteggi (aggiungi_percentuali).
+    """
+    tabella = pd.DataFrame(rollup["totali"][livello], columns=rollup["colonne"], index=rollup["chiavi"][livello])
+    tabella.index.name = livello
+    tabella = tabella[tabella.index.notna() & ~tabella.index.duplicated()]
+    return aggiungi_percentuali(tabella, colonne_percentuali, coalizioni)
@@ -0,0 +1,104 @@
+# utils/schema_dati.py
+
+import numpy as np
+import pandas as pd
+
+# Regole per riconoscere le colonne identificative dei livelli territoriali:
+# livello -> (nomi preferiti, sottostringhe da cercare nel nome in
+# maiuscolo). Per i layer, se nessuna regola vale, si usa la prima colonna
+# che non sia la geometria.
+REGOLE_ID_LAYER = {
+    "municipi": {"municipio": (["MUNICIPIO", "Municipio", "municipio", "NOME_MUNIC", "NOME_MUNICIPIO"], ["MUNI", "NOME"])},
+    "sezioni": {"sezione": (["SEZIONE", "Sezione", "sezione", "SEZ", "NUM_SEZIONE"], ["SEZ", "NUM"])},
+    "uu": {"uu": (["UNITA_URBANISTICA", "Unita_Urbanistica", "NOME_UU"], ["UNIT", "NOME", "UU"])},
+}
+REGOLE_ID_TABELLA = {
+    "municipio": (["Municipio"], ["MUNI"]),
+    "sezione": (["SEZIONE"], ["SEZ"]),
+    "uu": (["UNITA_URBANISTICA"], ["UNIT", "UU", "URBANISTICA"]),
+}
+COLONNE_NON_ID = ("geometry", "_umap_options")
+
+
+def _trova_colonna(colonne, preferite, sottostringhe):
+    for col in preferite:
+        if col in colonne:
+            return col
+    for col in colonne:
+        if col not in COLONNE_NON_ID and any(s in col.upper() for s in sottostringhe):
+            return col
+    return None
+
+
+def rileva_colonne_id(nome, colonne, tipo):
+    """
+    Colonne identificative di una sorgente (livello -> colonna), secondo
+    le regole del layer 'nome' oppure, per le tabelle, quelle dei voti.
+    I livelli senza colonna riconosciuta non compaiono.
+    """
+    colonne = list(colonne)
+    trovate = {}
+    if tipo == "geo":
+        for livello, regola in REGOLE_ID_LAYER.get(nome, {}).items():
+            col = _trova_colonna(colonne, *regola)
+            if col is None:
+                col = next((c for c in colonne if c not in COLONNE_NON_ID), None)
+            if col is not None:
+                trovate[livello] = col
+        return trovate
+    for livello, regola in REGOLE_ID_TABELLA.items():
+        col = _trova_colonna(colonne, *regola)
+        if col is not None:
+            trovate[livello] = col
+    return trovate
+
+
+def _chiave_intera(serie):
+    # Chiavi numeriche a valori interi (ad es. 276.0) diventano interi a 32
+    # bit, nullable se qualche valore manca; le altre restano invariate
+    numeri = pd.to_numeric(serie, errors="coerce")
+    presenti = numeri.dropna()
+    if len(presenti) < serie.notna().sum() or not np.all(np.mod(presenti, 1) == 0):
+        return serie
+    return numeri.astype("Int32" if numeri.isna().any() else "int32")
+
+
+def tipizza_tabella(tabella, colonne_id):
+    """
+    Applica lo schema compatto a una tabella appena letta dalla sorgente:
+    - percentuali (colonne con "%") in float32, i valori non numerici
+      diventano NaN;
+    - chiavi territoriali numeriche in interi;
+    - conteggi interi in int32;
+    - colonne di testo (nomi di municipi, unità urbanistiche, ...) in
+      categorie.
+    Viene applicato una sola volta, all'ingest: chi legge la cache trova già
+    i tipi corretti e non deve copiare né convertire le colonne.
+    """
+    tabella = tabella.copy()
+    tabella.columns = [str(col) for col in tabella.columns]
+    chiavi = set(colonne_id.values())
+    for col in tabella.columns:
+        serie = tabella[col]
+        if "%" in col:
+            tabella[col] = pd.to_numeric(serie, errors="coerce").astype("float32")
+        elif col in chiavi and not pd.api.types.is_string_dtype(serie):
+            tabella[col] = _chiave_intera(serie)
+        elif pd.api.types.is_integer_dtype(serie) and serie.abs().max() < np.iinfo("int32").max:
+            tabella[col] = serie.astype("int32")
+        elif pd.api.types.is_string_dtype(serie) or pd.api.types.is_object_dtype(serie):
+            tabella[col] = serie.astype("category")
+    return tabella
+
+
+def tipizza_layer(gdf, colonne_id):
+    """
+    Schema dei layer geografici: le chiavi numeriche (ad es. il numero di
+    sezione, spesso letto come decimale) diventano interi. Gli altri
+    attributi restano invariati.
+    """
+    gdf = gdf.copy()
+    for col in colonne_id.values():
+        if not pd.api.types.is_string_dtype(gdf[col]):
+            gdf[col] = _chiave_intera(gdf[col])
+    return gdf
@@ -0,0 +1,155 @@
+# utils/scrutinio.py
+
+import json
+import os
+import random
+import sys
+import threading
+import time
+
+import numpy as np
+
+# Eseguito come script: rende importabile il pacchetto utils
+if __package__ in (None, ""):
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.rollup import aggiorna_unita, tabella_livello
+
+# Intervallo (secondi) tra due letture del flusso dei risultati
+INTERVALLO_SCRUTINIO = 5
+
+
+class FeedJsonl:
+    """
+    Legge in coda un file JSONL a sola aggiunta: un oggetto per riga con la
+    chiave della sezione e i suoi conteggi assoluti. Ogni lettura restituisce
+    solo le righe complete aggiunte dopo la precedente (una riga ancora in
+    scrittura viene letta la volta successiva). Se il file viene ricreato o
+    troncato la lettura riparte dall'inizio.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.posizione = 0
+        self.scartate = 0
+        self._inode = None
+
+    def leggi(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return []
+        if stat.st_ino != self._inode or stat.st_size < self.posizione:
+            self._inode = stat.st_ino
+            self.posizione = 0
+        if stat.st_size == self.posizione:
+            return []
+
+        with open(self.path, "rb") as f:
+            f.seek(self.posizione)
+            dati = f.read(stat.st_size - self.posizione)
+        fine = dati.rfind(b"\n") + 1
+        self.posizione += fine
+
+        record = []
+        for riga in dati[:fine].splitlines():
+            if not riga.strip():
+                continue
+            try:
+                valore = json.loads(riga)
+            except ValueError:
+                self.scartate += 1
+                continue
+            if isinstance(valore, dict):
+                record.append(valore)
+            else:
+                self.scartate += 1
+        return record
+
+
+def _chiave_sezione(valore):
+    # 276, 276.0 e "276" indicano la stessa sezione delle chiavi del rollup
+    if isinstance(valore, float) and valore.is_integer():
+        valore = int(valore)
+    return str(valore).strip()
+
+
+def rollup_vuoto(rollup):
+    """
+    Copia di un rollup con tutti i totali a zero: stessa gerarchia (chiavi e
+    matrici condivise), da riempire con i risultati man mano che arrivano.
+    """
+    return dict(rollup, totali={livello: np.zeros_like(totali) for livello, totali in rollup["totali"].items()})
+
+
+class Scrutinio:
+    """
+    Stato dello scrutinio in diretta, condiviso da tutte le sessioni. Parte
+    da rollup vuoti con la gerarchia di quelli dei dati completi e applica
+    ogni risultato di sezione letto dal flusso come differenza sui soli
+    antenati della sezione (aggiorna_unita), senza ricalcolare gli
+    aggregati. Un risultato ripetuto per la stessa sezione la sostituisce.
+    """
+
+    def __init__(self, feed, rollups, chiave):
+        self.feed = feed
+        self.chiave = chiave
+        self.rollups = {nome: rollup_vuoto(rollup) for nome, rollup in rollups.items()}
+        self.scrutinate = set()
+        self.versione = 0
+        self._lock = threading.Lock()
+
+    @property
+    def totale_sezioni(self):
+        rollup = next(iter(self.rollups.values()))
+        return len(rollup["chiavi"][rollup["livelli"][0]])
+
+    def aggiorna(self):
+        """
+        Applica i nuovi risultati del flusso e restituisce la versione dello
+        stato (aumenta a ogni lettura con risultati nuovi)
+        """
+        with self._lock:
+            record = self.feed.leggi()
+            for risultato in record:
+                if risultato.get(self.chiave) is None:
+                    self.feed.scartate += 1
+                    continue
+                chiave = _chiave_sezione(risultato[self.chiave])
+                applicato = False
+                for rollup in self.rollups.values():
+                    applicato = aggiorna_unita(rollup, chiave, risultato) or applicato
+                if applicato:
+                    self.scrutinate.add(chiave)
+                else:
+                    self.feed.scartate += 1
+            if record:
+                self.versione += 1
+            return self.versione
+
+    def tabella(self, rollup, livello, colonne_percentuali=(), coalizioni=None):
+        """Tabella di un livello (vedi tabella_livello) con i risultati finora"""
+        with self._lock:
+            stato = dict(self.rollups[rollup], totali={livello: self.rollups[rollup]["totali"][livello].copy()})
+        return tabella_livello(stato, livello, colonne_percentuali, coalizioni)
+
+
+def simula_feed(tabella, chiave, path, intervallo=1.0):
+    """
+    Riproduce lo scrutinio di una tabella di voti già completa: aggiunge al
+    file JSONL i risultati delle sezioni in ordine casuale, uno ogni
+    'intervallo' secondi
+    """
+    colonne = [col for col in tabella.select_dtypes(include=["number"]).columns if "%" not in col]
+    righe = tabella[[chiave, *[col for col in colonne if col != chiave]]].to_dict("records")
+    random.shuffle(righe)
+    for riga in righe:
+        with open(path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(riga, default=float) + "\n")
+        time.sleep(intervallo)
+
+
+if __name__ == "__main__":
+    # Uso: python app/utils/scrutinio.py [secondi tra due sezioni]
+    from utils.data_cache import FEED_SCRUTINIO, carica_voti
+    simula_feed(carica_voti(), "SEZIONE", FEED_SCRUTINIO, float(sys.argv[1]) if len(sys.argv) > 1 else 1.0)
@@ -0,0 +1,249 @@
+# utils/tile_server.py
+
+import gzip
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+from utils.mvt import codifica_tile, leggi_features, leggi_metadati
+
+# Indirizzo su cui ascolta il server delle tile (predefinito: solo locale)
+HOST_TILE = os.environ.get("DASHBOARD_HOST_TILE", "127.0.0.1")
+PORTA_TILE = int(os.environ.get("DASHBOARD_PORTA_TILE", "8765"))
+
+# URL base delle tile come lo raggiunge il browser quando la dashboard non
+# gira sulla sua stessa macchina (ad es. in un pod): un percorso sulla
+# stessa origine della pagina (ad es. "/tiles", inoltrato a questo server
+# da un reverse proxy) oppure un URL pubblico. Senza, le tile sono
+# raggiungibili solo da un browser sulla macchina del server.
+URL_PUBBLICO_TILE = os.environ.get("DASHBOARD_URL_TILE") or None
+
+# Numero di tile con valori già uniti tenute in memoria
+MAX_TILE_IN_CACHE = 2048
+
+# Insiemi di valori registrati tenuti in memoria (ogni scenario ne
+# registra uno nuovo: i più vecchi vengono scartati)
+MAX_VALORI_REGISTRATI = 256
+
+# Insiemi di valori fissati (quelli delle figure della mappa in cache, al
+# massimo 12 in app/main.py, con margine): il meno usato oltre il limite
+# torna tra i valori registrati ordinari
+MAX_VALORI_FISSATI = 24
+
+# /<tileset>[/<valori>]/<z>/<x>/<y>.pbf oppure /<tileset>.json (TileJSON)
+_PERCORSO_TILE = re.compile(r"^/(?P<tileset>[\w.-]+?)(?:/(?P<valori>[0-9a-f]{16}))?/(?P<z>\d+)/(?P<x>\d+)/(?P<y>\d+)\.pbf$")
+_PERCORSO_TILEJSON = re.compile(r"^/(?P<tileset>[\w.-]+?)\.json$")
+
+
+class ServerTile(ThreadingHTTPServer):
+    """
+    Server HTTP locale che legge le tile vettoriali dagli archivi MBTiles di
+    una directory. Le tile contengono solo geometria e 'id'; i valori da
+    mostrare (registrati con registra_valori) vengono uniti alle feature
+    al momento della richiesta riscrivendo solo gli attributi, senza
+    ritagliare di nuovo la geometria.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, directory, host=HOST_TILE, porta=PORTA_TILE, url_pubblico=URL_PUBBLICO_TILE):
+        super().__init__((host, porta), _GestoreTile)
+        self.directory = directory
+        self.url_pubblico = url_pubblico.rstrip("/") if url_pubblico else None
+        # Percorso dell'URL pubblico, se il proxy lo inoltra senza toglierlo
+        self.prefisso = urlsplit(self.url_pubblico).path if self.url_pubblico else ""
+        self._valori = OrderedDict()
+        self._fissati = OrderedDict()
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        """URL base delle tile per il browser"""
+        if self.url_pubblico:
+            return self.url_pubblico
+        host, porta = self.server_address[:2]
+        return f"http://{host}:{porta}"
+
+    def _valori_registrati(self, chiave):
+        # Da chiamare con self._lock acquisito
+        if chiave in self._fissati:
+            self._fissati.move_to_end(chiave)
+            return self._fissati[chiave]
+        if chiave in self._valori:
+            self._valori.move_to_end(chiave)
+            return self._valori[chiave]
+        return None
+
+    def registra_valori(self, valori, base=None, fissa=False):
+        """
+        Registra le proprietà per feature (dizionario id -> dizionario) e
+        restituisce la chiave da inserire nell'URL delle tile. La chiave
+        dipende dal contenuto, quindi il browser non riusa tile con valori
+        diversi. Con 'base' (chiave di valori già registrati) basta passare
+        le proprietà che cambiano: le altre restano quelle della base (se la
+        base non è più registrata solleva KeyError).
+        Con 'fissa' i valori restano registrati finché sono tra gli
+        MAX_VALORI_FISSATI fissati usati più di recente (ad es. quelli di
+        una figura in cache, che li usa a ogni rerun); gli altri sono
+        scartati quando sono i meno usati.
+        """
+        with self._lock:
+            precedenti = self._valori_registrati(base) if base else {}
+        if precedenti is None:
+            raise KeyError(base)
+        if precedenti:
+            valori = {i: {**precedenti.get(i, {}), **valori.get(i, {})} for i in precedenti.keys() | valori.keys()}
+        testo = json.dumps(valori, sort_keys=True, default=str)
+        chiave = hashlib.sha256(testo.encode("utf-8")).hexdigest()[:16]
+        with self._lock:
+            if fissa:
+                self._fissati.setdefault(chiave, valori)
+                self._fissati.move_to_end(chiave)
+                self._valori.pop(chiave, None)
+                if len(self._fissati) > MAX_VALORI_FISSATI:
+                    self._aggiungi_valori(*self._fissati.popitem(last=False))
+            elif chiave not in self._fissati:
+                self._aggiungi_valori(chiave, valori)
+        return chiave
+
+    def _aggiungi_valori(self, chiave, valori):
+        # Da chiamare con self._lock acquisito
+        self._valori.setdefault(chiave, valori)
+        self._valori.move_to_end(chiave)
+        if len(self._valori) > MAX_VALORI_REGISTRATI:
+            self._valori.popitem(last=False)
+
+    def url_tile(self, tileset, chiave_valori=None):
+        """Modello di URL {z}/{x}/{y} per un archivio e un insieme di valori"""
+        valori = f"/{chiave_valori}" if chiave_valori else ""
+        return f"{self.url}/{tileset}{valori}/{{z}}/{{x}}/{{y}}.pbf"
+
+    def _archivio(self, tileset):
+        path = os.path.join(self.directory, f"{tileset}.mbtiles")
+        return path if os.path.exists(path) else None
+
+    def leggi_tile(self, tileset, z, x, y, chiave_valori=None):
+        """
+        Restituisce la tile compressa gzip (None se vuota o fuori dal layer),
+        con i valori registrati uniti alle feature se 'chiave_valori' è data.
+        """
+        chiave = (tileset, chiave_valori, z, x, y)
+        with self._lock:
+            if chiave in self._cache:
+                self._cache.move_to_end(chiave)
+                return self._cache[chiave]
+
+        path = self._archivio(tileset)
+        if path is None:
+            return None
+        connessione = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        try:
+            riga = connessione.execute(
+                "SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+                (z, x, (2 ** z) - 1 - y),
+            ).fetchone()
+        finally:
+            connessione.close()
+        dati = riga[0] if riga else None
+
+        with self._lock:
+            valori = self._valori_registrati(chiave_valori) if chiave_valori else None
+        if dati is not None and valori is not None:
+            features = leggi_features(gzip.decompress(dati))
+            dati = gzip.compress(codifica_tile([
+                (i, geometria, {"id": i, **valori.get(i, {})}) for i, geometria in features
+            ]), compresslevel=5, mtime=0)
+
+        with self._lock:
+            self._cache[chiave] = dati
+            if len(self._cache) > MAX_TILE_IN_CACHE:
+                self._cache.popitem(last=False)
+        return dati
+
+    def tilejson(self, tileset):
+        """Descrizione TileJSON di un archivio (None se non esiste)"""
+        path = self._archivio(tileset)
+        if path is None:
+            return None
+        metadati = leggi_metadati(path)
+        return {
+            "tilejson": "3.0.0",
+            "name": metadati.get("name", tileset),
+            "tiles": [self.url_tile(tileset)],
+            "minzoom": int(metadati["minzoom"]),
+            "maxzoom": int(metadati["maxzoom"]),
+            "bounds": [float(v) for v in metadati["bounds"].split(",")],
+            "vector_layers": json.loads(metadati.get("json", "{}")).get("vector_layers", []),
+        }
+
+
+class _GestoreTile(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        percorso = self.path.split("?", 1)[0]
+        if self.server.prefisso and percorso.startswith(f"{self.server.prefisso}/"):
+            percorso = percorso[len(self.server.prefisso):]
+        corrispondenza = _PERCORSO_TILE.match(percorso)
+        if corrispondenza:
+            dati = self.server.leggi_tile(
+                corrispondenza["tileset"],
+                int(corrispondenza["z"]),
+                int(corrispondenza["x"]),
+                int(corrispondenza["y"]),
+                corrispondenza["valori"],
+            )
+            if dati is None:
+                # Tile vuota: nessuna geometria in quest'area
+                self._rispondi(204)
+            else:
+                self._rispondi(200, dati, "application/vnd.mapbox-vector-tile", {"Content-Encoding": "gzip"})
+            return
+
+        corrispondenza = _PERCORSO_TILEJSON.match(percorso)
+        descrizione = corrispondenza and self.server.tilejson(corrispondenza["tileset"])
+        if descrizione:
+            self._rispondi(200, json.dumps(descrizione).encode("utf-8"), "application/json")
+        else:
+            self._rispondi(404)
+
+    def _rispondi(self, stato, corpo=b"", tipo=None, intestazioni=None):
+        self.send_response(stato)
+        # La pagina di Streamlit ha un'origine diversa dal server delle tile
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.send_header("Cache-Control", "public, max-age=86400")
+        if tipo:
+            self.send_header("Content-Type", tipo)
+        for nome, valore in (intestazioni or {}).items():
+            self.send_header(nome, valore)
+        self.send_header("Content-Length", str(len(corpo)))
+        self.end_headers()
+        if corpo:
+            self.wfile.write(corpo)
+
+    def log_message(self, formato, *args):
+        # Nessun log per ogni tile richiesta
+        pass
+
+
+def avvia_server_tile(directory, host=HOST_TILE, porta=PORTA_TILE, url_pubblico=URL_PUBBLICO_TILE):
+    """
+    Avvia il server delle tile in un thread in background e lo restituisce.
+    Se la porta è occupata (ad es. da un'altra istanza) ne usa una libera:
+    con un URL pubblico la porta deve essere quella inoltrata dal proxy,
+    quindi l'errore viene propagato.
+    """
+    try:
+        server = ServerTile(directory, host, porta, url_pubblico)
+    except OSError:
+        if url_pubblico:
+            raise
+        server = ServerTile(directory, host, 0, url_pubblico)
+    threading.Thread(target=server.serve_forever, name="server-tile", daemon=True).start()
+    return server
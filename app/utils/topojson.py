@@ -0,0 +1,144 @@
+# utils/topojson.py
+
+import json
+
+import numpy as np
+
+# Griglia di quantizzazione: 1e5 passi sull'estensione del layer
+# (per Genova circa 0.4 m, sotto la precisione utile della mappa)
+QUANTIZZAZIONE = 100000
+
+# Nome dell'oggetto che contiene le geometrie nella topologia
+NOME_OGGETTO = "layer"
+
+
+def _anelli_quantizzati(geom, origine, scala):
+    """
+    Restituisce i poligoni di una geometria come liste di anelli, ciascuno
+    una lista di punti interi (senza il punto di chiusura).
+    """
+    if geom is None or geom.is_empty:
+        return []
+    poligoni = geom.geoms if geom.geom_type == "MultiPolygon" else [geom]
+    risultato = []
+    for poligono in poligoni:
+        anelli = []
+        for anello in [poligono.exterior, *poligono.interiors]:
+            coordinate = np.asarray(anello.coords)[:, :2]
+            punti = np.round((coordinate - origine) * scala).astype(np.int64)
+            # Elimina i punti consecutivi coincidenti dopo la quantizzazione
+            punti = punti[np.r_[True, np.any(np.diff(punti, axis=0) != 0, axis=1)]]
+            if len(punti) > 1 and (punti[0] == punti[-1]).all():
+                punti = punti[:-1]
+            if len(punti) >= 3:
+                anelli.append([tuple(p) for p in punti.tolist()])
+        if anelli:
+            risultato.append(anelli)
+    return risultato
+
+
+def _giunzioni(anelli):
+    """
+    Individua i punti di giunzione: punti condivisi da più anelli con vicini
+    diversi, dove un bordo comune inizia o finisce.
+    """
+    vicini = {}
+    giunzioni = set()
+    for anello in anelli:
+        n = len(anello)
+        for i, punto in enumerate(anello):
+            coppia = (anello[i - 1], anello[(i + 1) % n])
+            precedente = vicini.get(punto)
+            if precedente is None:
+                vicini[punto] = coppia
+            elif precedente != coppia and precedente != coppia[::-1]:
+                giunzioni.add(punto)
+    return giunzioni
+
+
+def _taglia_anello(anello, giunzioni):
+    """Divide un anello in archi che iniziano e finiscono su giunzioni"""
+    n = len(anello)
+    posizioni = [i for i, punto in enumerate(anello) if punto in giunzioni]
+    if not posizioni:
+        # Anello senza giunzioni: un unico arco chiuso, ruotato in forma
+        # canonica (dal punto minimo) così da riconoscere lo stesso anello
+        # percorso da un altro poligono
+        inizio = anello.index(min(anello))
+        ruotato = anello[inizio:] + anello[:inizio]
+        return [ruotato + [ruotato[0]]]
+
+    inizio = posizioni[0]
+    ruotato = anello[inizio:] + anello[:inizio] + [anello[inizio]]
+    tagli = sorted((i - inizio) % n for i in posizioni) + [n]
+    return [ruotato[a:b + 1] for a, b in zip(tagli, tagli[1:])]
+
+
+def codifica_topojson(gdf, quantizzazione=QUANTIZZAZIONE):
+    """
+    Codifica le geometrie di un layer (WGS84) come TopoJSON: coordinate
+    quantizzate su una griglia intera, archi condivisi tra poligoni
+    adiacenti memorizzati una sola volta e codificati per differenze.
+    Ogni geometria ha come 'id' la posizione della riga nel layer.
+    """
+    x0, y0, x1, y1 = gdf.total_bounds
+    origine = np.array([x0, y0])
+    scala = np.array([
+        (quantizzazione - 1) / (x1 - x0) if x1 > x0 else 1.0,
+        (quantizzazione - 1) / (y1 - y0) if y1 > y0 else 1.0,
+    ])
+
+    poligoni_per_geometria = [_anelli_quantizzati(geom, origine, scala) for geom in gdf.geometry]
+    giunzioni = _giunzioni([anello for poligoni in poligoni_per_geometria for poligono in poligoni for anello in poligono])
+
+    archi = []
+    indice_archi = {}
+
+    def indici_anello(anello):
+        indici = []
+        for arco in _taglia_anello(anello, giunzioni):
+            chiave = tuple(arco)
+            if chiave in indice_archi:
+                indici.append(indice_archi[chiave])
+                continue
+            inverso = tuple(reversed(arco))
+            if inverso in indice_archi:
+                indici.append(~indice_archi[inverso])
+                continue
+            indice_archi[chiave] = len(archi)
+            indici.append(len(archi))
+            archi.append(arco)
+        return indici
+
+    geometrie = []
+    for i, poligoni in enumerate(poligoni_per_geometria):
+        if not poligoni:
+            geometrie.append({"type": None, "id": str(i)})
+        elif len(poligoni) == 1:
+            geometrie.append({"type": "Polygon", "id": str(i), "arcs": [indici_anello(a) for a in poligoni[0]]})
+        else:
+            geometrie.append({
+                "type": "MultiPolygon",
+                "id": str(i),
+                "arcs": [[indici_anello(a) for a in poligono] for poligono in poligoni],
+            })
+
+    # Codifica per differenze: primo punto assoluto, poi spostamenti
+    archi_delta = []
+    for arco in archi:
+        punti = np.asarray(arco, dtype=np.int64)
+        punti[1:] = np.diff(punti, axis=0)
+        archi_delta.append(punti.tolist())
+
+    return {
+        "type": "Topology",
+        "transform": {"scale": (1 / scala).tolist(), "translate": origine.tolist()},
+        "objects": {NOME_OGGETTO: {"type": "GeometryCollection", "geometries": geometrie}},
+        "arcs": archi_delta,
+    }
+
+
+def scrivi_topojson(gdf, path, quantizzazione=QUANTIZZAZIONE):
+    """Scrive la topologia di un layer in formato JSON compatto"""
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(codifica_topojson(gdf, quantizzazione), f, separators=(",", ":"))
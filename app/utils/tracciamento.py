@@ -0,0 +1,176 @@
+# utils/tracciamento.py
+
+import contextvars
+import datetime
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Dimensione oltre la quale il log delle tracce viene ruotato (il file
+# precedente resta come <log>.1)
+MAX_BYTE_LOG = 10 << 20
+
+# Misure costose (ad es. la dimensione del payload, che richiede di
+# serializzare di nuovo la figura) anche senza il pannello dei tempi
+DETTAGLIO_DA_AMBIENTE = os.environ.get("DASHBOARD_TRACCE_DETTAGLIATE") == "1"
+
+_traccia_corrente = contextvars.ContextVar("traccia_corrente", default=None)
+_lock_log = threading.Lock()
+_log = logging.getLogger("dashboard")
+
+
+class Traccia:
+    """
+    Tempi di un'esecuzione dello script (o di un frammento): l'elenco degli
+    span aperti durante l'esecuzione, nell'ordine di apertura, con durata,
+    profondità di annidamento e attributi (dimensioni, motore, errori...).
+    """
+
+    def __init__(self, nome, dettagliata=False, **attributi):
+        self.nome = nome
+        self.dettagliata = dettagliata or DETTAGLIO_DA_AMBIENTE
+        self.attributi = attributi
+        self.span = []
+        self.inizio = datetime.datetime.now(datetime.timezone.utc)
+        self.durata_ms = None
+        self._t0 = time.perf_counter()
+        self._profondita = 0
+
+    @property
+    def chiusa(self):
+        return self.durata_ms is not None
+
+    def record(self):
+        return {
+            "ts": self.inizio.isoformat(timespec="milliseconds"),
+            "nome": self.nome,
+            "durata_ms": self.durata_ms,
+            **self.attributi,
+            "span": self.span,
+        }
+
+
+def traccia_attiva():
+    """La traccia dell'esecuzione in corso, None se non ce n'è una aperta"""
+    traccia = _traccia_corrente.get()
+    return None if traccia is None or traccia.chiusa else traccia
+
+
+def dettagliata():
+    """Indica se vanno registrate anche le misure costose"""
+    traccia = traccia_attiva()
+    return traccia is not None and traccia.dettagliata
+
+
+@contextmanager
+def span(nome, **attributi):
+    """
+    Misura il blocco come span della traccia attiva e restituisce il
+    dizionario dei suoi attributi, da completare nel blocco. Senza una
+    traccia attiva (ad es. nei benchmark) non registra nulla.
+    """
+    traccia = traccia_attiva()
+    if traccia is None:
+        yield {}
+        return
+    voce = {
+        "nome": nome,
+        "livello": traccia._profondita,
+        "inizio_ms": round((time.perf_counter() - traccia._t0) * 1000, 3),
+        "durata_ms": None,
+        "attributi": dict(attributi),
+    }
+    traccia.span.append(voce)
+    traccia._profondita += 1
+    t0 = time.perf_counter()
+    try:
+        yield voce["attributi"]
+    except Exception as e:
+        voce["attributi"]["errore"] = repr(e)
+        raise
+    finally:
+        voce["durata_ms"] = round((time.perf_counter() - t0) * 1000, 3)
+        traccia._profondita -= 1
+
+
+def registra_errore(contesto, errore):
+    """
+    Registra un errore gestito (che non interrompe l'esecuzione): nel log
+    di Python e, con una traccia attiva, tra gli errori della traccia
+    """
+    messaggio = f"{contesto}: {errore}"
+    _log.warning(messaggio)
+    traccia = traccia_attiva()
+    if traccia is not None:
+        traccia.attributi.setdefault("errori", []).append(messaggio)
+
+
+def avvia_traccia(nome, dettagliata=False, **attributi):
+    """Apre una nuova traccia e la rende quella attiva"""
+    traccia = Traccia(nome, dettagliata, **attributi)
+    _traccia_corrente.set(traccia)
+    return traccia
+
+
+def termina_traccia(traccia, path=None):
+    """Chiude la traccia e, con 'path', la aggiunge al log JSON-lines"""
+    if traccia.chiusa:
+        return traccia
+    traccia.durata_ms = round((time.perf_counter() - traccia._t0) * 1000, 3)
+    if path:
+        scrivi_traccia(traccia, path)
+    return traccia
+
+
+@contextmanager
+def traccia(nome, path=None, dettagliata=False, **attributi):
+    """
+    Span della traccia attiva oppure, se non ce n'è una (ad es. quando
+    Streamlit riesegue solo un frammento), una nuova traccia registrata
+    nel log alla fine del blocco
+    """
+    if traccia_attiva() is not None:
+        with span(nome, **attributi) as voce:
+            yield voce
+        return
+    nuova = avvia_traccia(nome, dettagliata, **attributi)
+    try:
+        yield nuova.attributi
+    finally:
+        termina_traccia(nuova, path)
+
+
+def scrivi_traccia(traccia, path):
+    """Aggiunge una traccia al log (una riga JSON per esecuzione)"""
+    riga = json.dumps(traccia.record(), default=str, ensure_ascii=False) + "\n"
+    with _lock_log:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            if os.path.getsize(path) > MAX_BYTE_LOG:
+                os.replace(path, f"{path}.1")
+        except OSError:
+            pass
+        with open(path, "a", encoding="utf-8") as f:
+            f.write(riga)
+
+
+def leggi_tracce(path, ultime=500):
+    """Le ultime tracce del log, dalla più vecchia alla più recente"""
+    try:
+        with open(path, "rb") as f:
+            f.seek(0, os.SEEK_END)
+            # Le tracce sono di pochi KB: basta leggere la coda del file
+            f.seek(max(0, f.tell() - ultime * 8192))
+            righe = f.read().splitlines()[-ultime:]
+    except OSError:
+        return []
+    tracce = []
+    for riga in righe:
+        try:
+            tracce.append(json.loads(riga))
+        except ValueError:
+            continue
+    return tracce
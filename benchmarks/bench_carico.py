@@ -0,0 +1,328 @@
+# benchmarks/bench_carico.py
+#
+# Test di carico della dashboard senza browser: avvia un vero server
+# (streamlit run, un solo processo come un pod) e lo fa usare a N client
+# websocket simultanei che parlano il protocollo del frontend (BackMsg con
+# lo stato dei widget, ForwardMsg fino a script_finished). Le sessioni
+# condividono quindi le cache del server e competono per lo stesso
+# interprete. Ogni sessione cambia a caso il tipo di mappa, l'unità
+# selezionata, opacità, zoom e variazioni dello scenario, con una pausa
+# casuale tra un'azione e l'altra; i widget dentro un frammento rieseguono
+# solo il frammento, come nel browser.
+#
+# Per ogni numero di sessioni simultanee riporta la latenza dei rerun
+# (dall'invio dell'azione all'ultimo messaggio dell'esecuzione: p50, p95,
+# massimo), la memoria aggiunta per sessione (RSS del server) e la
+# saturazione della CPU (tempo CPU del server sul tempo trascorso, in core
+# e in percentuale dei core disponibili). Si ferma quando il p95 supera la
+# soglia: l'ultimo livello sotto soglia è la capacità stimata del pod.
+#
+# Uso: python benchmarks/bench_carico.py [--sessioni 1 2 4 8 16]
+#          [--durata SECONDI] [--pausa SECONDI] [--soglia-p95 MS] [--seed N]
+
+import argparse
+import asyncio
+import os
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import urllib.request
+
+from streamlit.proto.BackMsg_pb2 import BackMsg
+from streamlit.proto.ForwardMsg_pb2 import ForwardMsg
+from streamlit.proto.Slider_pb2 import Slider
+from streamlit.proto.WidgetStates_pb2 import WidgetState
+from websockets.asyncio.client import connect
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app", "main.py")
+
+# Etichette dei widget usati dalle sessioni simulate
+MAPPA = "Scegli la mappa:"
+UNITA = ("Seleziona un municipio", "Seleziona una sezione elettorale", "Seleziona un'unità urbanistica")
+OPACITA = "Opacità"
+ZOOM = "Zoom mappa"
+VARIAZIONE = "Variazione "
+
+# Esiti di un'esecuzione che la chiudono
+FINE_ESECUZIONE = {
+    ForwardMsg.FINISHED_SUCCESSFULLY,
+    ForwardMsg.FINISHED_FRAGMENT_RUN_SUCCESSFULLY,
+    ForwardMsg.FINISHED_WITH_COMPILE_ERROR,
+}
+
+
+def porta_libera():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def avvia_server(porta, timeout):
+    """Avvia streamlit run sulla dashboard e attende che risponda"""
+    server = subprocess.Popen(
+        [
+            sys.executable, "-m", "streamlit", "run", APP_PATH,
+            "--server.headless", "true",
+            "--server.address", "127.0.0.1",
+            "--server.port", str(porta),
+            "--server.fileWatcherType", "none",
+            "--browser.gatherUsageStats", "false",
+        ],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    scadenza = time.monotonic() + timeout
+    while time.monotonic() < scadenza:
+        if server.poll() is not None:
+            raise RuntimeError(f"streamlit run terminato con codice {server.returncode}")
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{porta}/_stcore/health", timeout=1):
+                return server
+        except OSError:
+            time.sleep(0.2)
+    server.terminate()
+    raise RuntimeError("il server non risponde")
+
+
+def rss_byte(pid):
+    """Memoria residente di un processo (Linux: /proc)"""
+    try:
+        with open(f"/proc/{pid}/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return float("nan")
+
+
+def tempo_cpu(pid):
+    """Tempo CPU (utente + sistema) di un processo in secondi (Linux: /proc)"""
+    try:
+        with open(f"/proc/{pid}/stat", "r") as f:
+            campi = f.read().rsplit(")", 1)[1].split()
+        return (int(campi[11]) + int(campi[12])) / os.sysconf("SC_CLK_TCK")
+    except OSError:
+        return float("nan")
+
+
+def percentile(valori, p):
+    if not valori:
+        return float("nan")
+    ordinati = sorted(valori)
+    return ordinati[min(len(ordinati) - 1, int(round(p / 100 * (len(ordinati) - 1))))]
+
+
+class Sessione:
+    """
+    Un client della dashboard: tiene i widget dell'ultima pagina ricevuta
+    (etichetta -> (proto, tipo, frammento)) e gli stati impostati, che invia
+    a ogni rerun come fa il frontend
+    """
+
+    def __init__(self, ws, rng, timeout):
+        self.ws = ws
+        self.rng = rng
+        self.timeout = timeout
+        self.widget = {}
+        self.stati = {}
+
+    async def esegui(self, frammento=""):
+        """
+        Chiede un'esecuzione (dell'intero script o di un frammento) e legge
+        i messaggi fino alla sua fine; restituisce gli errori mostrati
+        """
+        messaggio = BackMsg()
+        messaggio.rerun_script.query_string = ""
+        messaggio.rerun_script.page_script_hash = ""
+        messaggio.rerun_script.fragment_id = frammento
+        messaggio.rerun_script.widget_states.widgets.extend(self.stati.values())
+        await self.ws.send(messaggio.SerializeToString())
+
+        widget, errori = {}, []
+        while True:
+            risposta = ForwardMsg()
+            risposta.ParseFromString(await asyncio.wait_for(self.ws.recv(), self.timeout))
+            tipo = risposta.WhichOneof("type")
+            if tipo == "script_finished" and risposta.script_finished in FINE_ESECUZIONE:
+                break
+            if tipo != "delta" or risposta.delta.WhichOneof("type") != "new_element":
+                continue
+            elemento = risposta.delta.new_element
+            genere = elemento.WhichOneof("type")
+            if genere == "exception":
+                errori.append(elemento.exception.message)
+            elif genere in ("selectbox", "slider"):
+                proto = getattr(elemento, genere)
+                widget[proto.label] = (proto, genere, risposta.delta.fragment_id)
+
+        # Un frammento rimanda solo i propri widget
+        self.widget = {**self.widget, **widget} if frammento else widget
+        return errori
+
+    async def svuota(self, secondi):
+        """Attende 'secondi' scartando i messaggi non richiesti"""
+        scadenza = time.monotonic() + secondi
+        while (resto := scadenza - time.monotonic()) > 0:
+            try:
+                await asyncio.wait_for(self.ws.recv(), resto)
+            except asyncio.TimeoutError:
+                break
+
+    def _trova(self, etichette, prefisso=False):
+        for etichetta, voce in self.widget.items():
+            if etichetta in etichette or (prefisso and etichetta.startswith(etichette)):
+                return voce
+        return None
+
+    def azioni_disponibili(self):
+        """Azioni possibili nella pagina corrente: nome -> (widget, valori)"""
+        azioni = {
+            "mappa": (self._trova((MAPPA,)), None),
+            "unita": (self._trova(UNITA), None),
+            "opacita": (self._trova((OPACITA,)), [round(0.1 * i, 1) for i in range(11)]),
+            "zoom": (self._trova((ZOOM,)), None),
+            "scenario": (self._trova(VARIAZIONE, prefisso=True), [-20, -10, 0, 0, 10, 20]),
+        }
+        return {
+            nome: (voce, valori if valori is not None else list(voce[0].options))
+            for nome, (voce, valori) in azioni.items()
+            if voce is not None
+        }
+
+    def azione_casuale(self):
+        """
+        Imposta un widget a caso e restituisce il nome dell'azione e il
+        frammento da rieseguire ("" = tutto lo script); la selezione
+        dell'unità pesa il doppio, come nell'uso reale. Senza widget (ad es.
+        dopo un errore) la sessione viene solo rieseguita.
+        """
+        azioni = self.azioni_disponibili()
+        if not azioni:
+            return "rerun", ""
+        nomi = list(azioni) + (["unita"] if "unita" in azioni else [])
+        nome = self.rng.choice(nomi)
+        (proto, genere, frammento), valori = azioni[nome]
+        valore = self.rng.choice(valori)
+        stato = WidgetState(id=proto.id)
+        if genere == "selectbox":
+            stato.string_value = valore
+        elif proto.type == Slider.SELECT_SLIDER:
+            stato.string_array_value.data[:] = [valore]
+        else:
+            stato.double_array_value.data[:] = [float(valore)]
+        self.stati[proto.id] = stato
+        return nome, frammento
+
+
+async def apri_sessione(url, seed, timeout):
+    """Connette un client e ne esegue la prima pagina (fuori misura)"""
+    ws = await connect(url, subprotocols=["streamlit"], max_size=None, open_timeout=timeout)
+    sessione = Sessione(ws, random.Random(seed), timeout)
+    await sessione.esegui()
+    return sessione
+
+
+async def usa_sessione(sessione, pausa, stop, latenze, errori):
+    """Esegue azioni casuali fino allo stop"""
+    while not stop.is_set():
+        azione, frammento = sessione.azione_casuale()
+        inizio = time.perf_counter()
+        try:
+            errori += [f"{azione}: {e}" for e in await sessione.esegui(frammento)]
+        except Exception as e:
+            errori.append(f"{azione}: {e!r}")
+        else:
+            latenze.append((azione, time.perf_counter() - inizio))
+        # La pausa vale anche dopo un errore: una sessione che fallisce non
+        # deve martellare il server
+        if pausa:
+            await sessione.svuota(sessione.rng.expovariate(1 / pausa))
+
+
+async def livello(url, pid, n_sessioni, durata, pausa, seed, timeout):
+    """Esegue n_sessioni sessioni simultanee sullo stesso server per 'durata' secondi"""
+    rss_iniziale = rss_byte(pid)
+    sessioni = await asyncio.gather(*(apri_sessione(url, seed + i, timeout) for i in range(n_sessioni)))
+    memoria_sessione = (rss_byte(pid) - rss_iniziale) / n_sessioni
+
+    stop = asyncio.Event()
+    latenze, errori = [], []
+    cpu_iniziale, inizio = tempo_cpu(pid), time.perf_counter()
+    attivita = [asyncio.create_task(usa_sessione(s, pausa, stop, latenze, errori)) for s in sessioni]
+    await asyncio.sleep(durata)
+    stop.set()
+    await asyncio.gather(*attivita)
+    trascorso = time.perf_counter() - inizio
+    core = (tempo_cpu(pid) - cpu_iniziale) / trascorso
+    for s in sessioni:
+        await s.ws.close()
+
+    millisecondi = [durata_s * 1000 for _, durata_s in latenze]
+    return {
+        "sessioni": n_sessioni,
+        "rerun": len(latenze),
+        "rerun_s": len(latenze) / trascorso,
+        "p50": percentile(millisecondi, 50),
+        "p95": percentile(millisecondi, 95),
+        "max": max(millisecondi, default=float("nan")),
+        "memoria_mb": memoria_sessione / 2**20,
+        "core": core,
+        "cpu_pct": core / (os.cpu_count() or 1) * 100,
+        "per_azione": {
+            azione: statistics.median(d * 1000 for a, d in latenze if a == azione)
+            for azione in sorted({a for a, _ in latenze})
+        },
+        "errori": errori,
+    }
+
+
+async def carico(args, url, pid):
+    # Prima sessione fuori misura: riempie le cache del server come in un
+    # pod già avviato
+    sessione = await apri_sessione(url, args.seed, args.timeout)
+    await sessione.ws.close()
+
+    print(f"{'sessioni':>8}{'rerun':>8}{'rerun/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'max ms':>9}{'MB/sess':>9}{'core':>7}{'CPU %':>7}  errori")
+    capacita = None
+    for n_sessioni in args.sessioni:
+        r = await livello(url, pid, n_sessioni, args.durata, args.pausa, args.seed, args.timeout)
+        print(
+            f"{r['sessioni']:>8}{r['rerun']:>8}{r['rerun_s']:>9.1f}{r['p50']:>9.0f}{r['p95']:>9.0f}{r['max']:>9.0f}"
+            f"{r['memoria_mb']:>9.1f}{r['core']:>7.2f}{r['cpu_pct']:>7.0f}  {len(r['errori'])}"
+        )
+        print("          mediana per azione (ms): " + ", ".join(f"{a} {ms:.0f}" for a, ms in r["per_azione"].items()))
+        for errore in r["errori"][:3]:
+            print(f"          errore: {errore}")
+        if r["p95"] > args.soglia_p95:
+            break
+        capacita = n_sessioni
+
+    if capacita is None:
+        print(f"\nLatenza p95 oltre {args.soglia_p95:.0f} ms già con {args.sessioni[0]} sessioni")
+    else:
+        print(f"\nCapacità stimata: {capacita} sessioni simultanee con p95 sotto {args.soglia_p95:.0f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Test di carico della dashboard con sessioni simulate")
+    parser.add_argument("--sessioni", type=int, nargs="+", default=[1, 2, 4, 8, 16])
+    parser.add_argument("--durata", type=float, default=30.0, help="secondi di carico per ogni livello")
+    parser.add_argument("--pausa", type=float, default=1.0, help="pausa media tra due azioni di una sessione (secondi)")
+    parser.add_argument("--soglia-p95", type=float, default=2000.0, help="latenza p95 (ms) oltre la quale ci si ferma")
+    parser.add_argument("--timeout", type=float, default=300.0, help="tempo massimo di un rerun (secondi)")
+    parser.add_argument("--porta", type=int, default=None, help="porta del server (predefinito: una libera)")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    porta = args.porta or porta_libera()
+    server = avvia_server(porta, args.timeout)
+    try:
+        asyncio.run(carico(args, f"ws://127.0.0.1:{porta}/_stcore/stream", server.pid))
+    finally:
+        server.terminate()
+        server.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,207 @@
+# benchmarks/bench_hot_paths.py
+#
+# Misura i percorsi caldi della dashboard fuori da Streamlit, su dati
+# sintetici (vedi sintetici.py) da 100 a 100.000 sezioni: lettura della
+# tabella dei voti dalla cache Arrow, quote delle coalizioni, costruzione
+# della mappa per ogni livello e grafici per unità. Per ogni funzione e
+# livello registra il tempo (il migliore delle ripetizioni, il meno
+# disturbato dal resto del sistema), il picco di memoria allocata da
+# Python durante la chiamata (tracemalloc) e la dimensione del JSON della
+# figura inviato al browser.
+#
+# I risultati possono essere salvati come baseline (baseline.json in questa
+# cartella) e confrontati con le esecuzioni successive: le misure che
+# peggiorano oltre la soglia vengono segnalate e il processo termina con
+# codice 1.
+#
+# Uso: python benchmarks/bench_hot_paths.py [--sezioni 100 1000 ...]
+#          [--ripetizioni N] [--backend geo|map|deck] [--salva-baseline]
+#          [--soglia 1.5]
+
+import argparse
+import gc
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+import warnings
+
+import pyarrow.feather as feather
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+
+from sintetici import genera_dataset
+from utils.aggregazioni import aggiungi_quote_coalizioni, colonne_base_coalizioni, costruisci_indice
+from utils.chart_utils import grafico_barre_partiti, grafico_torta_csx
+from utils.coalizioni import SCHEMA_PREDEFINITO, SCHEMI_COALIZIONI, colonne_partiti, compila_schema, partiti_coalizione
+from utils.data_cache import leggi_arrow
+from utils.map_utils import crea_mappa_plotly, dimensione_payload
+from utils.rollup import colonne_conteggio, rollup_tabella, tabella_livello
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+DIMENSIONI = (100, 1000, 10000, 100000)
+
+# Livello -> (layer, colonna id nel layer, colonna nel file voti), come
+# nell'app
+LIVELLI = {
+    "sezioni": ("sezioni", "SEZIONE", "SEZIONE"),
+    "uu": ("uu", "NOME_UU", "UNITA_URBANISTICA"),
+    "municipi": ("municipi", "NOME_MUNIC", "MUNICIPIO"),
+}
+
+# Misure confrontate con la baseline; i tempi sotto la soglia assoluta
+# (rumore di misura) non vengono segnalati
+METRICHE = ("tempo_ms", "picco_kb", "json_kb")
+MINIMO_ASSOLUTO = {"tempo_ms": 5.0, "picco_kb": 256.0, "json_kb": 1.0}
+
+
+def misura(funzione, ripetizioni):
+    """
+    Esegue la funzione 'ripetizioni' volte e una volta sotto tracemalloc
+    (che la rallenta, per questo a parte): restituisce il tempo migliore
+    in ms, il picco di memoria in KB e il risultato
+    """
+    # Come timeit: raccolta dei cicli disattivata durante le misure, così le
+    # pause del garbage collector non finiscono nella chiamata misurata
+    tempi = []
+    gc.collect()
+    gc.disable()
+    try:
+        for _ in range(ripetizioni):
+            inizio = time.perf_counter()
+            risultato = funzione()
+            tempi.append(time.perf_counter() - inizio)
+    finally:
+        gc.enable()
+
+    tracemalloc.start()
+    funzione()
+    picco = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return min(tempi) * 1000, picco / 1024, risultato
+
+
+def esegui(n_sezioni, ripetizioni, backend, cartella):
+    """Misura tutti i percorsi caldi su un dataset di n_sezioni sezioni"""
+    layer, voti = genera_dataset(n_sezioni)
+    partiti_cols = colonne_partiti([col for col in voti.columns if "%" in col])
+    # Partiti della torta: quelli del centrosinistra, come nella dashboard
+    partiti_csx = partiti_coalizione(compila_schema(SCHEMI_COALIZIONI[SCHEMA_PREDEFINITO], partiti_cols), "CSX")
+    risultati = {}
+
+    def registra(funzione, livello, misure, fig=None):
+        tempo, picco, _ = misure
+        json_byte = None if fig is None else dimensione_payload(fig)
+        risultati[f"{funzione}|{livello}|{n_sezioni}"] = {
+            "tempo_ms": round(tempo, 3),
+            "picco_kb": round(picco, 1),
+            "json_kb": None if json_byte is None else round(json_byte / 1024, 1),
+        }
+
+    # Lettura della tabella dei voti dalla cache Arrow (carica_dati)
+    path = os.path.join(cartella, f"voti-{n_sezioni}.arrow")
+    feather.write_feather(voti, path, compression="uncompressed")
+    registra("carica_dati", "-", misura(lambda: leggi_arrow(path), ripetizioni))
+
+    # Quote delle coalizioni (lo schema compilato è in cache nell'app)
+    compilato = compila_schema(SCHEMI_COALIZIONI[SCHEMA_PREDEFINITO], colonne_base_coalizioni(voti))
+    registra("calcola_percentuali_coalizioni", "-", misura(lambda: aggiungi_quote_coalizioni(voti, compilato), ripetizioni))
+
+    # Aggregati e indici per livello (in cache nell'app, non misurati)
+    gerarchia = [join_col for _, _, join_col in LIVELLI.values()]
+    rollup = rollup_tabella(voti, gerarchia[0], gerarchia[1:], colonne_conteggio(voti, gerarchia))
+    coalizioni = compila_schema(SCHEMI_COALIZIONI[SCHEMA_PREDEFINITO], rollup["colonne"])
+    cubo = {join_col: tabella_livello(rollup, join_col, partiti_cols, coalizioni) for join_col in gerarchia}
+
+    for livello, (nome, colonna_id, join_col) in LIVELLI.items():
+        gdf = layer[nome]
+        misure = misura(
+            lambda: crea_mappa_plotly(gdf, colonna_id, "#2563eb", 0.7, voti, join_col, partiti_cols, cubo[join_col], backend),
+            ripetizioni,
+        )
+        registra("crea_mappa_plotly", livello, misure, misure[2])
+
+        indice = costruisci_indice(cubo[join_col])
+        unita = cubo[join_col].index[0]
+        misure = misura(lambda: grafico_torta_csx(voti, join_col, unita, indice, partiti_csx), ripetizioni)
+        registra("grafico_torta_csx", livello, misure, misure[2])
+        misure = misura(lambda: grafico_barre_partiti(voti, join_col, unita, indice), ripetizioni)
+        registra("grafico_barre_partiti", livello, misure, misure[2])
+
+    return risultati
+
+
+def leggi_baseline():
+    try:
+        with open(BASELINE_PATH, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {"ambiente": {}, "risultati": {}}
+
+
+def salva_baseline(baseline, risultati):
+    baseline["ambiente"] = {"python": platform.python_version(), "sistema": platform.platform()}
+    baseline["risultati"].update(risultati)
+    with open(BASELINE_PATH, "w", encoding="utf-8") as f:
+        json.dump(baseline, f, indent=2, sort_keys=True)
+        f.write("\n")
+
+
+def regressioni(misure, riferimento, soglia):
+    """Metriche peggiorate oltre la soglia (rapporto) rispetto alla baseline"""
+    peggiorate = []
+    for metrica in METRICHE:
+        valore, base = misure.get(metrica), (riferimento or {}).get(metrica)
+        if valore is None or base is None:
+            continue
+        if valore > base * soglia and valore - base > MINIMO_ASSOLUTO[metrica]:
+            peggiorate.append(f"{metrica} {base:g} -> {valore:g}")
+    return peggiorate
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark dei percorsi caldi della dashboard su dati sintetici")
+    parser.add_argument("--sezioni", type=int, nargs="+", default=list(DIMENSIONI))
+    parser.add_argument("--ripetizioni", type=int, default=5)
+    parser.add_argument("--backend", default=None, help="motore della mappa (predefinito: automatico come nell'app)")
+    parser.add_argument("--salva-baseline", action="store_true", help="registra i risultati come nuova baseline")
+    parser.add_argument("--soglia", type=float, default=1.5, help="rapporto oltre il quale una misura è una regressione")
+    args = parser.parse_args()
+
+    warnings.filterwarnings("ignore")
+    baseline = leggi_baseline()
+    risultati = {}
+    segnalate = []
+
+    print(f"{'sezioni':>8}  {'funzione':<32}{'livello':<10}{'ms':>10}{'picco KB':>12}{'JSON KB':>10}  confronto")
+    with tempfile.TemporaryDirectory() as cartella:
+        for n_sezioni in args.sezioni:
+            for chiave, misure in esegui(n_sezioni, args.ripetizioni, args.backend, cartella).items():
+                funzione, livello, _ = chiave.split("|")
+                riferimento = baseline["risultati"].get(chiave)
+                peggiorate = regressioni(misure, riferimento, args.soglia)
+                if peggiorate:
+                    segnalate.append((chiave, peggiorate))
+                confronto = "nuova" if riferimento is None else ("REGRESSIONE" if peggiorate else "ok")
+                json_kb = "-" if misure["json_kb"] is None else f"{misure['json_kb']:.1f}"
+                print(f"{n_sezioni:>8}  {funzione:<32}{livello:<10}{misure['tempo_ms']:>10.1f}{misure['picco_kb']:>12.1f}{json_kb:>10}  {confronto}")
+                risultati[chiave] = misure
+
+    if args.salva_baseline:
+        salva_baseline(baseline, risultati)
+        print(f"\nBaseline salvata in {os.path.relpath(BASELINE_PATH)}")
+        return 0
+
+    if segnalate:
+        print(f"\nRegressioni (soglia {args.soglia:g}x):")
+        for chiave, peggiorate in segnalate:
+            print(f"  {chiave}: {', '.join(peggiorate)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
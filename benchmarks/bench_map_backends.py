@@ -0,0 +1,91 @@
+# benchmarks/bench_map_backends.py
+#
+# Confronta i motori di rendering della mappa (SVG geo, WebGL MapLibre,
+# pydeck, TopoJSON, tile vettoriali) per ogni layer: tempo di costruzione della figura e
+# dimensione del payload JSON inviato al browser, con geometria incorporata
+# o via URL. Confronta inoltre i file di geometria statica GeoJSON e
+# TopoJSON (byte trasferiti e tempo di parsing).
+#
+# Uso: python benchmarks/bench_map_backends.py [--ripetizioni N]
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+import warnings
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+
+from utils.data_cache import DATA_DIR, TILE_DIR, esporta_geometria, esporta_mbtiles, esporta_topojson
+from utils.esportazione import LIVELLI, carica_contesto
+from utils.map_utils import BACKEND_DECK, BACKEND_MVT, BACKEND_TOPO, BACKENDS, costruisci_figura_mappa, dimensione_payload, pdk
+from utils.tile_server import avvia_server_tile
+
+def misura(backend, gdf, colonna_id, voti, join_col, aggregati, geojson_url, topojson_url, url_tile, ripetizioni):
+    tempi = []
+    for _ in range(ripetizioni):
+        inizio = time.perf_counter()
+        fig = costruisci_figura_mappa(
+            gdf, colonna_id, df_voti=voti, join_col=join_col, aggregati=aggregati,
+            geojson_url=geojson_url, topojson_url=topojson_url, url_tile=url_tile, backend=backend
+        )
+        tempi.append(time.perf_counter() - inizio)
+    return statistics.median(tempi), dimensione_payload(fig)
+
+
+def misura_file(url, ripetizioni):
+    path = os.path.join(DATA_DIR, "..", url)
+    with open(path, "r", encoding="utf-8") as f:
+        testo = f.read()
+    tempi = []
+    for _ in range(ripetizioni):
+        inizio = time.perf_counter()
+        json.loads(testo)
+        tempi.append(time.perf_counter() - inizio)
+    return len(testo.encode("utf-8")), statistics.median(tempi)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Confronta i motori di rendering della mappa")
+    parser.add_argument("--ripetizioni", type=int, default=3)
+    args = parser.parse_args()
+
+    warnings.filterwarnings("ignore")
+    # Layer, colonne identificative (rilevate all'ingest) e totali per la
+    # mappa indicizzati dalle chiavi dei layer, come nella dashboard
+    contesto = carica_contesto()
+    server = avvia_server_tile(TILE_DIR, porta=0)
+
+    print(f"{'layer':<10}{'motore':<8}{'geometria':<12}{'poligoni':>9}{'build ms':>10}{'payload KB':>12}")
+    for nome in LIVELLI:
+        gdf, colonna_id = contesto["layer"][nome], contesto["colonne_layer"][nome]
+        for backend in BACKENDS:
+            if backend in (BACKEND_DECK, BACKEND_MVT) and pdk is None:
+                continue
+            # pydeck incorpora sempre le geometrie, TopoJSON le scarica sempre
+            # via URL, le tile vettoriali arrivano dal server locale
+            if backend == BACKEND_DECK:
+                modalita = [("incorporata", None, None, None)]
+            elif backend == BACKEND_TOPO:
+                modalita = [("url", None, esporta_topojson(nome), None)]
+            elif backend == BACKEND_MVT:
+                tileset = esporta_mbtiles(nome)
+                modalita = [("tile", None, None, lambda valori: server.url_tile(tileset, server.registra_valori(valori)))]
+            else:
+                modalita = [("incorporata", None, None, None), ("url", esporta_geometria(nome), None, None)]
+            for etichetta, geojson_url, topojson_url, url_tile in modalita:
+                durata, payload = misura(backend, gdf, colonna_id, contesto["voti"], colonna_id, contesto["mappe"][nome], geojson_url, topojson_url, url_tile, args.ripetizioni)
+                print(f"{nome:<10}{backend:<8}{etichetta:<12}{len(gdf):>9}{durata * 1000:>10.1f}{payload / 1024:>12.1f}")
+
+    print()
+    print(f"{'layer':<10}{'formato':<10}{'KB':>10}{'parse ms':>10}")
+    for nome in LIVELLI:
+        for formato, url in [("geojson", esporta_geometria(nome)), ("topojson", esporta_topojson(nome))]:
+            byte, parsing = misura_file(url, args.ripetizioni)
+            print(f"{nome:<10}{formato:<10}{byte / 1024:>10.1f}{parsing * 1000:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+# benchmarks/sintetici.py
+#
+# Generatori di dati sintetici con la stessa struttura dei file in data/:
+# tre layer che coprono un'area senza buchi né sovrapposizioni (sezioni,
+# unità urbanistiche, municipi) e la tabella dei voti per sezione, per un
+# numero qualsiasi di sezioni. Servono a misurare come scalano i percorsi
+# caldi della dashboard senza dipendere dai dati reali.
+
+import os
+import sys
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+from scipy.spatial import cKDTree
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+
+from utils.coalizioni import SCHEMA_PREDEFINITO, SCHEMI_COALIZIONI
+from utils.schema_dati import rileva_colonne_id, tipizza_layer, tipizza_tabella
+
+# Riquadro (UTM 32N, metri) di dimensioni simili al comune di Genova
+RIQUADRO = (480000.0, 4470000.0, 515000.0, 4485000.0)
+CRS_METRICO = "EPSG:32632"
+
+# Sezioni per unità urbanistica e unità urbanistiche per municipio, come nei
+# dati reali (circa 650 sezioni, 70 unità urbanistiche, 9 municipi)
+SEZIONI_PER_UU = 9
+UU_PER_MUNICIPIO = 8
+
+# Partiti della tabella sintetica: quelli dello schema predefinito
+PARTITI = [partito for membri in SCHEMI_COALIZIONI[SCHEMA_PREDEFINITO].values() for partito in membri]
+
+
+def _tassellazione(punti, riquadro):
+    # Celle di Voronoi dei punti, ritagliate sul riquadro e nell'ordine dei
+    # punti: una copertura valida, come i layer amministrativi
+    area = shapely.box(*riquadro)
+    celle = shapely.voronoi_polygons(shapely.multipoints(punti), extend_to=area, ordered=True)
+    return shapely.intersection(shapely.get_parts(celle), area)
+
+
+def genera_layer(n_sezioni, seed=0):
+    """
+    Genera i tre layer annidati per n_sezioni sezioni: le sezioni sono celle
+    di Voronoi di punti casuali, unità urbanistiche e municipi celle di
+    sottoinsiemi degli stessi punti (ogni sezione appartiene all'unità
+    del punto più vicino). Restituisce i GeoDataFrame (in WGS84, come
+    dopo l'ingest) e, per ogni sezione, l'unità e il municipio.
+    """
+    rng = np.random.default_rng(seed)
+    minx, miny, maxx, maxy = RIQUADRO
+    punti = np.column_stack([rng.uniform(minx, maxx, n_sezioni), rng.uniform(miny, maxy, n_sezioni)])
+    n_uu = max(1, n_sezioni // SEZIONI_PER_UU)
+    n_municipi = max(1, n_uu // UU_PER_MUNICIPIO)
+
+    uu_sezione = cKDTree(punti[:n_uu]).query(punti)[1]
+    municipio_uu = cKDTree(punti[:n_municipi]).query(punti[:n_uu])[1]
+
+    nomi_uu = np.array([f"UU {i + 1:05d}" for i in range(n_uu)])
+    nomi_municipi = np.array([f"Municipio {i + 1}" for i in range(n_municipi)])
+    layer = {
+        "sezioni": gpd.GeoDataFrame(
+            {"SEZIONE": np.arange(1, n_sezioni + 1, dtype=float)},
+            geometry=_tassellazione(punti, RIQUADRO), crs=CRS_METRICO,
+        ),
+        "uu": gpd.GeoDataFrame({"NOME_UU": nomi_uu}, geometry=_tassellazione(punti[:n_uu], RIQUADRO), crs=CRS_METRICO),
+        "municipi": gpd.GeoDataFrame(
+            {"COD_MUNICI": np.arange(1, n_municipi + 1), "NOME_MUNIC": nomi_municipi},
+            geometry=_tassellazione(punti[:n_municipi], RIQUADRO), crs=CRS_METRICO,
+        ),
+    }
+    for nome, gdf in layer.items():
+        layer[nome] = tipizza_layer(gdf.to_crs("EPSG:4326"), rileva_colonne_id(nome, gdf.columns, "geo"))
+
+    appartenenza = pd.DataFrame({
+        "SEZIONE": np.arange(1, n_sezioni + 1),
+        "UNITA_URBANISTICA": nomi_uu[uu_sezione],
+        "COD_MUNICIPIO": municipio_uu[uu_sezione] + 1,
+        "MUNICIPIO": nomi_municipi[municipio_uu[uu_sezione]],
+    })
+    return layer, appartenenza
+
+
+def genera_voti(appartenenza, seed=0):
+    """
+    Genera la tabella dei voti per sezione con le colonne del file reale
+    (conteggi, totali di coalizione e percentuali dei partiti), già con lo
+    schema dei tipi applicato all'ingest
+    """
+    rng = np.random.default_rng(seed)
+    n = len(appartenenza)
+    iscritti = rng.integers(400, 1200, n)
+    votanti = rng.binomial(iscritti, 0.45)
+    bianche = rng.binomial(votanti, 0.01)
+    nulle = rng.binomial(votanti, 0.02)
+    validi = votanti - bianche - nulle
+    # Quote dei partiti diverse per sezione attorno a una media comune
+    quote = rng.dirichlet(np.linspace(1, 3, len(PARTITI))[::-1] * 10, n)
+    voti = np.vstack([rng.multinomial(v, q) for v, q in zip(validi, quote)])
+
+    tabella = appartenenza.assign(
+        CIRCOSCRIZIONE=appartenenza["UNITA_URBANISTICA"],
+        ISCRITTI_TOT=iscritti,
+        TOT_VOTI_VALIDI_LISTA=validi,
+        SCH_BIANCHE=bianche,
+        SCH_NULLE=nulle,
+        VOTI_CONTESTATI=np.zeros(n, dtype=int),
+    )
+    for j, partito in enumerate(PARTITI):
+        tabella[partito] = voti[:, j]
+    for coalizione in ("CDX", "CSX"):
+        tabella[coalizione] = tabella[SCHEMI_COALIZIONI[SCHEMA_PREDEFINITO][coalizione]].sum(axis=1)
+    for col in ("CDX", "CSX", *PARTITI):
+        tabella[f"{col} %"] = tabella[col] / np.maximum(validi, 1) * 100
+    return tipizza_tabella(tabella, rileva_colonne_id("voti", tabella.columns, "tabella"))
+
+
+def genera_dataset(n_sezioni, seed=0):
+    """Layer e tabella dei voti sintetici per n_sezioni sezioni"""
+    layer, appartenenza = genera_layer(n_sezioni, seed)
+    return layer, genera_voti(appartenenza, seed)
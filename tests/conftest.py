@@ -0,0 +1,12 @@
+# tests/conftest.py
+#
+# Rende importabile il pacchetto utils (come fa app/main.py) e indica il
+# percorso della dashboard per i test con streamlit.testing.
+
+import os
+import sys
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app")
+sys.path.insert(0, APP_DIR)
+
+APP_PATH = os.path.join(APP_DIR, "main.py")
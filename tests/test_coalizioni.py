@@ -0,0 +1,33 @@
+# tests/test_coalizioni.py
+
+import warnings
+
+import numpy as np
+import pandas as pd
+import pytest
+from streamlit.testing.v1 import AppTest
+
+from conftest import APP_PATH
+from utils.coalizioni import SCHEMI_COALIZIONI, compila_schema
+from utils.rollup import COLONNA_VOTI_VALIDI, aggiungi_percentuali
+
+
+def test_coalizione_con_nome_di_partito():
+    # "M5S" è sia un partito sia, in "CSX senza M5S", una coalizione
+    totali = pd.DataFrame({COLONNA_VOTI_VALIDI: [100.0, 0.0], "PD": [30.0, 0.0], "M5S": [10.0, 0.0], "Lega": [40.0, 0.0]})
+    coalizioni = compila_schema(SCHEMI_COALIZIONI["CSX senza M5S"], list(totali.columns))
+    tabella = aggiungi_percentuali(totali, ["PD %", "M5S %", "Lega %"], coalizioni)
+    assert list(tabella.columns).count("M5S %") == 1
+    assert tabella["M5S %"].iloc[0] == pytest.approx(10.0)
+    assert tabella["CSX %"].iloc[0] == pytest.approx(30.0)
+    assert np.isnan(tabella["CSX %"].iloc[1])
+
+
+@pytest.mark.parametrize("schema", list(SCHEMI_COALIZIONI))
+def test_ogni_schema_si_carica_nella_dashboard(schema):
+    warnings.filterwarnings("ignore")
+    at = AppTest.from_file(APP_PATH, default_timeout=300).run()
+    selettore = next(s for s in at.sidebar.selectbox if s.label == "Raggruppamento coalizioni")
+    selettore.set_value(schema).run()
+    assert not at.exception, [e.value for e in at.exception]
+    assert not at.error, [e.value for e in at.error]
@@ -0,0 +1,64 @@
+# tests/test_geometrie.py
+#
+# Corrispondenza zoom -> tolleranza della piramide di semplificazione con
+# lo zoom di Plotly/MapLibre e pydeck (tile da 512 px) e semplificazione
+# delle coperture con bordi digitalizzati in modo diverso.
+
+import math
+
+import geopandas as gpd
+import pytest
+import shapely
+from shapely.geometry import Polygon, box
+
+from utils.geometrie import metri_per_pixel, ripara_copertura, semplifica_layer, tolleranza_per_zoom
+
+LATITUDINE_GENOVA = 44.41
+
+# Circonferenza equatoriale dello sferoide web mercator
+CIRCONFERENZA_M = 2 * math.pi * 6378137
+
+
+def test_mondo_largo_512_pixel_a_zoom_0():
+    assert metri_per_pixel(0, 0) * 512 == pytest.approx(CIRCONFERENZA_M)
+
+
+@pytest.mark.parametrize(
+    "zoom, tolleranza",
+    [(8, 100), (9, 100), (10, 30), (11, 10), (12, 10), (13, 0), (14, 0), (16, 0)],
+)
+def test_tolleranza_per_zoom(zoom, tolleranza):
+    assert tolleranza_per_zoom(zoom, LATITUDINE_GENOVA) == tolleranza
+
+
+def _aree_adiacenti():
+    # Due aree con il bordo comune digitalizzato due volte: a zig-zag di
+    # 0.3 m nella prima, diritto nella seconda (sovrapposizioni e buchi
+    # sotto il metro)
+    bordo = [(500000 + 1000 + 0.3 * ((i + 1) % 2), 4900000 + 1000 - 50 * i) for i in range(21)]
+    sinistra = Polygon([(500000, 4900000), (500000, 4901000), *bordo])
+    destra = box(500000 + 1000.1, 4900000, 500000 + 2000, 4901000)
+    return gpd.GeoDataFrame({"id": [1, 2]}, geometry=[sinistra, destra], crs="EPSG:32632")
+
+
+@pytest.mark.skipif(not hasattr(shapely, "coverage_clean"), reason="richiede shapely >= 2.2")
+def test_copertura_riparata_resta_senza_sovrapposizioni():
+    layer = _aree_adiacenti()
+    assert not shapely.coverage_is_valid(layer.geometry.values)
+    semplificato = semplifica_layer(layer, 100)
+    sinistra, destra = semplificato.geometry
+    assert sinistra.intersection(destra).area == pytest.approx(0, abs=1e-6)
+    assert list(semplificato["id"]) == [1, 2]
+
+
+def test_poligoni_sovrapposti_semplificati_uno_per_uno():
+    # Un'area che ne contiene un'altra non è una copertura
+    layer = gpd.GeoDataFrame(
+        {"id": [1, 2]},
+        geometry=[box(500000, 4900000, 502000, 4902000), box(500500, 4900500, 501000, 4901000)],
+        crs="EPSG:32632",
+    )
+    assert ripara_copertura(layer.geometry.values) is None
+    semplificato = semplifica_layer(layer, 100)
+    assert not semplificato.geometry.is_empty.any()
+    assert semplificato.geometry.area.tolist() == pytest.approx(layer.geometry.area.tolist())
@@ -0,0 +1,84 @@
+# tests/test_mappa.py
+#
+# Mappa senza aggregati precalcolati: i totali dell'unità sono la somma
+# dei conteggi delle sue righe, non la media delle percentuali.
+# Aggiornamento dei valori di una figura già inviata: cambiano solo le aree
+# con valori nuovi.
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pytest
+from shapely.geometry import box
+
+from utils.map_utils import BACKEND_MAP, BACKEND_MVT, aggiorna_valori_mappa, costruisci_figura_mappa
+from utils.rollup import COLONNA_VOTI_VALIDI
+
+
+def _layer():
+    return gpd.GeoDataFrame({"UNITA": ["A", "B"]}, geometry=[box(8.9, 44.4, 8.91, 44.41), box(8.91, 44.4, 8.92, 44.41)], crs="EPSG:4326")
+
+
+def _valori(diff):
+    return pd.DataFrame({"CSX %": [50 + d / 2 for d in diff], "CDX %": [50 - d / 2 for d in diff], "Diff": diff})
+
+
+def test_mappa_pesata_sui_voti_validi():
+    layer = _layer()
+    voti = pd.DataFrame({
+        "UNITA": ["A", "A", "B"],
+        COLONNA_VOTI_VALIDI: [100, 900, 200],
+        "PD": [80, 90, 100],
+        "FdI": [20, 810, 100],
+    })
+    fig = costruisci_figura_mappa(layer, "UNITA", df_voti=voti, join_col="UNITA", partiti_cols=["PD %", "FdI %"], backend=BACKEND_MAP)
+    diff = np.asarray(fig.data[0].z, dtype=float)
+    # A: CSX 170/1000, CDX 830/1000 (la media delle percentuali darebbe 45 - 55)
+    assert diff[0] == pytest.approx(17.0 - 83.0)
+    assert diff[1] == pytest.approx(0.0)
+
+
+def test_aggiornamento_solo_aree_cambiate():
+    prima = _valori([10.0, np.nan])
+    dopo = _valori([10.0, -4.0])
+    fig = aggiorna_valori_mappa(costruisci_figura_mappa(_layer(), "UNITA", backend=BACKEND_MAP), prima)
+    fig = aggiorna_valori_mappa(fig, dopo, precedenti=prima)
+    assert np.asarray(fig.data[0].z, dtype=float).tolist() == [10.0, -4.0]
+
+
+class _UrlTile:
+    """Registra i valori passati al server delle tile (base opzionale)"""
+
+    def __init__(self, registrate=()):
+        self.chiamate = []
+        self.registrate = set(registrate)
+
+    def __call__(self, valori, base=None):
+        if base is not None and base not in self.registrate:
+            raise KeyError(base)
+        self.chiamate.append((valori, base))
+        chiave = f"{len(self.chiamate):016x}"
+        self.registrate.add(chiave)
+        return f"http://localhost/tileset/{chiave}/{{z}}/{{x}}/{{y}}.pbf"
+
+
+def test_tile_registrano_solo_aree_cambiate():
+    url_tile = _UrlTile()
+    fig = costruisci_figura_mappa(_layer(), "UNITA", backend=BACKEND_MVT, url_tile=url_tile)
+    prima, dopo = _valori([10.0, 2.0]), _valori([10.0, -4.0])
+    fig = aggiorna_valori_mappa(fig, prima, url_tile)
+    aggiorna_valori_mappa(fig, dopo, url_tile, precedenti=prima)
+    valori, base = url_tile.chiamate[-1]
+    assert list(valori) == [1] and valori[1]["diff"] == -4.0
+    assert base == f"{len(url_tile.chiamate) - 1:016x}"
+
+
+def test_tile_senza_base_registrano_tutte_le_aree():
+    url_tile = _UrlTile()
+    fig = costruisci_figura_mappa(_layer(), "UNITA", backend=BACKEND_MVT, url_tile=url_tile)
+    prima, dopo = _valori([10.0, 2.0]), _valori([10.0, -4.0])
+    fig = aggiorna_valori_mappa(fig, prima, url_tile)
+    url_tile.registrate.clear()
+    aggiorna_valori_mappa(fig, dopo, url_tile, precedenti=prima)
+    valori, base = url_tile.chiamate[-1]
+    assert sorted(valori) == [0, 1] and base is None
@@ -0,0 +1,33 @@
+# tests/test_selezione_mappa.py
+
+import json
+import warnings
+
+from streamlit.testing.v1 import AppTest
+
+from conftest import APP_PATH
+from utils.map_utils import area_selezionata_nel_browser
+
+
+def test_evidenziata_segue_il_municipio_scelto():
+    # Nel layer i municipi sono identificati dal nome, nel file voti dal
+    # codice: l'area evidenziata deve essere quella del municipio scelto
+    warnings.filterwarnings("ignore")
+    at = AppTest.from_file(APP_PATH, default_timeout=300).run()
+    aree = {}
+    for scelta in ("4 - Media Val Bisagno", "5 - Valpolcevera"):
+        next(s for s in at.selectbox if s.label == "Seleziona un municipio").set_value(scelta).run()
+        assert not at.exception, [e.value for e in at.exception]
+        figura = json.loads(at.get("plotly_chart")[0].proto.spec)
+        aree[scelta] = figura["data"][0]["selectedpoints"]
+    assert aree["4 - Media Val Bisagno"] != aree["5 - Valpolcevera"]
+
+
+def test_area_gia_selezionata_nel_browser():
+    # Plotly seleziona da sé il punto cliccato, deck.gl no: la mappa va
+    # ridisegnata solo nel secondo caso
+    clic_plotly = {"selection": {"points": [{"point_index": 3}], "point_indices": [3]}}
+    clic_deck = {"selection": {"indices": {"mappa": [3]}, "objects": {}}}
+    assert area_selezionata_nel_browser(clic_plotly) == 3
+    assert area_selezionata_nel_browser(clic_deck) is None
+    assert area_selezionata_nel_browser(None) is None
@@ -0,0 +1,78 @@
+# tests/test_tile_server.py
+#
+# Server delle tile: URL raggiungibile dal browser dietro un proxy e valori
+# delle figure in cache mai scartati dalla LRU.
+
+import json
+import urllib.request
+
+import pytest
+
+from utils import tile_server
+from utils.data_cache import TILE_DIR, esporta_mbtiles
+from utils.map_utils import BACKEND_DECK, BACKEND_MVT, scegli_backend
+from utils.tile_server import ServerTile, avvia_server_tile
+
+
+@pytest.fixture
+def tileset():
+    return esporta_mbtiles("municipi")
+
+
+def test_url_pubblico_con_prefisso(tileset):
+    server = avvia_server_tile(TILE_DIR, porta=0, url_pubblico="https://dashboard.example/tiles/")
+    try:
+        assert server.url_tile(tileset).startswith(f"https://dashboard.example/tiles/{tileset}/")
+        # Il proxy inoltra il percorso con il prefisso: il server lo toglie
+        host, porta = server.server_address[:2]
+        with urllib.request.urlopen(f"http://{host}:{porta}/tiles/{tileset}.json") as risposta:
+            assert json.load(risposta)["tiles"][0].startswith("https://dashboard.example/tiles/")
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_valori_fissati_non_scartati(monkeypatch):
+    monkeypatch.setattr(tile_server, "MAX_VALORI_REGISTRATI", 2)
+    server = ServerTile(TILE_DIR, porta=0)
+    try:
+        fissata = server.registra_valori({0: {"diff": 1.0}}, fissa=True)
+        temporanee = [server.registra_valori({0: {"diff": float(i)}}) for i in range(2, 6)]
+        with server._lock:
+            assert server._valori_registrati(fissata) == {0: {"diff": 1.0}}
+            assert server._valori_registrati(temporanee[0]) is None
+        # Un aggiornamento a partire dai valori fissati li trova ancora
+        chiave = server.registra_valori({1: {"diff": 2.0}}, base=fissata)
+        with server._lock:
+            assert server._valori_registrati(chiave) == {0: {"diff": 1.0}, 1: {"diff": 2.0}}
+    finally:
+        server.server_close()
+
+
+def test_base_non_registrata():
+    server = ServerTile(TILE_DIR, porta=0)
+    try:
+        with pytest.raises(KeyError):
+            server.registra_valori({0: {"diff": 1.0}}, base="0" * 16)
+    finally:
+        server.server_close()
+
+
+def test_valori_fissati_limitati(monkeypatch):
+    monkeypatch.setattr(tile_server, "MAX_VALORI_FISSATI", 2)
+    server = ServerTile(TILE_DIR, porta=0)
+    try:
+        fissate = [server.registra_valori({0: {"diff": float(i)}}, fissa=True) for i in range(3)]
+        assert list(server._fissati) == fissate[1:]
+        # Il fissato meno recente torna tra i valori ordinari
+        with server._lock:
+            assert server._valori_registrati(fissate[0]) == {0: {"diff": 0.0}}
+    finally:
+        server.server_close()
+
+
+def test_mvt_solo_con_tile_raggiungibili():
+    assert scegli_backend(10000, BACKEND_MVT, tile=False) == BACKEND_DECK
+    assert scegli_backend(10000, tile=False) == BACKEND_DECK
+    assert scegli_backend(10000, tile=True) == BACKEND_MVT
+    assert scegli_backend(10000, BACKEND_MVT, tile=True) == BACKEND_MVT